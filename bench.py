@@ -0,0 +1,350 @@
+import asyncio
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import configargparse
+from anyio import create_task_group, TASK_STATUS_IGNORED
+
+from mock_server import MockChatServer, make_bench_message, parse_bench_message
+
+logger = logging.getLogger('bench')
+
+READ_SCENARIOS = ('listener', 'start_chat')
+SEND_SCENARIOS = ('sender', 'sender_pool')
+SCENARIOS = READ_SCENARIOS + SEND_SCENARIOS
+CHILD_TIMEOUT = 30
+DELIVERY_TIMEOUT = 5
+POLL_INTERVAL = 0.01
+
+
+def percentile(sorted_values, share):
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(int(len(sorted_values) * share), len(sorted_values) - 1)], 3)
+
+
+def summarize(latencies_ns, elapsed):
+    latencies = sorted(latency / 1e6 for latency in latencies_ns)
+    return {
+        'messages': len(latencies),
+        'messages_per_second': round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        'latency_p50_ms': percentile(latencies, 0.5),
+        'latency_p90_ms': percentile(latencies, 0.9),
+        'latency_p99_ms': percentile(latencies, 0.99),
+    }
+
+
+class LatencyRecorder:
+    def __init__(self, replayed_address=None):
+        self.latencies = []
+        self.first_sent_at = None
+        self.last_received_at = None
+        self.startup_ns = None
+        # the read address of a replayed run, its messages were sent while recording
+        self.replayed_address = replayed_address
+        self.latency_known = True
+        self.created_at = time.monotonic_ns()
+
+    def add(self, text, received_at=None):
+        from messenger import connection
+
+        parsed = parse_bench_message(text)
+        if not parsed:
+            return
+        received_at = received_at or time.monotonic_ns()
+        _, sent_at = parsed
+        if self.replayed_address:
+            # latency counts from the moment the replay delivers what the server sent at sent_at,
+            # as fast as possible replays have no such moment and only their pace is measured
+            sent_at = connection.replay.local_time(sent_at, self.replayed_address)
+            if sent_at is None:
+                self.latency_known = False
+                sent_at = self.created_at
+        self.first_sent_at = min(self.first_sent_at or sent_at, sent_at)
+        self.last_received_at = max(self.last_received_at or received_at, received_at)
+        self.latencies.append(received_at - sent_at)
+
+    def summary(self):
+        elapsed = 0
+        if self.latencies:
+            elapsed = (self.last_received_at - self.first_sent_at) / 1e9
+        result = summarize(self.latencies, elapsed)
+        if not self.latency_known:
+            for key in ('latency_p50_ms', 'latency_p90_ms', 'latency_p99_ms'):
+                result[key] = None
+        if self.startup_ns is not None:
+            result['startup_ms'] = round(self.startup_ns / 1e6, 1)
+        return result
+
+
+def prefill_history(count):
+    from messenger.history_store import HistoryStore
+
+    log_path = tempfile.mkdtemp()
+    store = HistoryStore(log_path)
+    for sequence in range(count):
+        store.append(f'history: old message {sequence}')
+    store.close()
+    return log_path
+
+
+async def wait_for_count(recorder, count, timeout):
+    # messages broadcast while the client reconnects are lost, so do not wait for them forever
+    deadline = time.monotonic() + timeout
+    while len(recorder.latencies) < count and time.monotonic() < deadline:
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def wait_for_delivery(server, count, timeout=DELIVERY_TIMEOUT):
+    # the server may still be reading what the client wrote right before it exited
+    deadline = time.monotonic() + timeout
+    while server.connections and len(server.received) < count and time.monotonic() < deadline:
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def bench_listener(args, recorder):
+    from listener import listen_chat
+    from messenger.batch_writer import BatchWriter
+    from messenger.history_store import HistoryStore
+    from messenger.queues import MonitoredQueue
+
+    class RecordingBatchWriter(BatchWriter):
+        def write_batch(self, messages):
+            super().write_batch(messages)
+            written_at = time.monotonic_ns()
+            for message in messages:
+                recorder.add(message.text, written_at)
+
+    # the same pipeline as listener.py, latency is measured when a message is written to history
+    store = HistoryStore(tempfile.mkdtemp())
+    saving_queue = MonitoredQueue('saving', 10000)
+    async with create_task_group() as tg:
+        await tg.start(RecordingBatchWriter(store).run, saving_queue)
+        tg.start_soon(listen_chat, args.host, args.port, saving_queue)
+        await wait_for_count(recorder, args.count, args.timeout)
+        tg.cancel_scope.cancel()
+    store.close()
+
+
+async def bench_start_chat(args, recorder):
+    import start_chat
+    from messenger import gui
+    from messenger.conversation import FRAME_INTERVAL
+    from messenger.credentials import get_credentials
+    from messenger.rendering import LineFormatter, format_messages
+    from messenger.tk_loop import FrameScheduler
+
+    class HeadlessView:
+        # stands in for ConversationView, a line counts when a frame inserts it into the panel
+        def append(self, items):
+            shown_at = time.monotonic_ns()
+            if recorder.startup_ns is None:
+                recorder.startup_ns = shown_at - args.spawned_at
+            for item in items:
+                recorder.add(item.text, shown_at)
+
+    class HeadlessLabel(dict):
+        # the status panel only sets label['text'], frames key updates by label
+        __hash__ = object.__hash__
+
+    async def draw(messages_queue, sending_queue, status_updates_queue, token_error_event, history=None,
+                   tk_mode=None, search_index=None, history_limit=0, task_status=TASK_STATUS_IGNORED):
+        # the stages of gui.draw without the Tk window: formatting, frames and the status panel
+        formatter = LineFormatter()
+        rendered_queue = asyncio.Queue(maxsize=2)
+        scheduler = FrameScheduler(FRAME_INTERVAL)
+        status_labels = [HeadlessLabel() for _ in range(gui.STATUS_LABELS)]
+        async with create_task_group() as tg:
+            await tg.start(scheduler.run)
+            await tg.start(format_messages, formatter, messages_queue, rendered_queue, gui.BATCH_SIZE)
+            await tg.start(gui.update_conversation_history, HeadlessView(), rendered_queue, scheduler)
+            await tg.start(gui.update_status_panel, status_labels, status_updates_queue, scheduler, formatter)
+            task_status.started()
+
+    # start_chat.py reads the token from the account store in the working directory
+    os.chdir(tempfile.mkdtemp())
+    get_credentials().put('bench', args.token)
+    chat_args = ['--host', args.host, '--port', args.port, '--sender_port', args.sender_port,
+                 '--log_path', args.log_path]
+    if args.record:
+        chat_args += ['--record', args.record]
+    if args.replay:
+        chat_args += ['--replay', args.replay, '--replay_speed', str(args.replay_speed)]
+    # the real startup path: history, search index, outbox, credentials and the client
+    async with create_task_group() as tg:
+        tg.start_soon(start_chat.run_chat, start_chat.create_parser().parse_args(chat_args), draw)
+        await wait_for_count(recorder, args.count, args.timeout)
+        tg.cancel_scope.cancel()
+
+
+async def bench_sender(args, recorder):
+    import sender
+    from messenger.credentials import get_credentials
+
+    # sender.py reads the token from the account store in the working directory
+    os.chdir(tempfile.mkdtemp())
+    get_credentials().put('bench', args.token)
+    for sequence in range(args.count):
+        await sender.send_message_from_cli(args.host, args.sender_port, make_bench_message(sequence))
+
+
+async def bench_sender_pool(args, recorder):
+    from messenger.sender_pool import SenderPool
+
+    async with SenderPool(args.host, args.sender_port) as pool, create_task_group() as tg:
+        for sequence in range(args.count):
+            tg.start_soon(pool.send, args.token, make_bench_message(sequence))
+
+
+async def run_child(args):
+    from messenger.replay import configure as configure_traffic
+
+    traffic_recorder = None
+    # start_chat.run_chat records and replays the traffic itself
+    if args.child != 'start_chat':
+        traffic_recorder = configure_traffic(args.record, args.replay, args.replay_speed)
+    recorder = LatencyRecorder(f'{args.host}:{args.port}' if args.replay else None)
+    started_at = time.monotonic()
+    await globals()[f'bench_{args.child}'](args, recorder)
+    if traffic_recorder:
+        traffic_recorder.close()
+    result = recorder.summary() if args.child in READ_SCENARIOS else {}
+    result['wall_seconds'] = round(time.monotonic() - started_at, 3)
+    result['rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps(result))
+
+
+async def run_child_process(scenario, child_args):
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started_at = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), '--child', scenario, *child_args,
+        '--spawned_at', str(time.monotonic_ns()),
+        stdout=asyncio.subprocess.PIPE,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    output, _ = await process.communicate()
+    process_seconds = time.monotonic() - started_at
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    cpu_seconds = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    result['scenario'] = scenario
+    result['cpu_seconds'] = round(cpu_seconds, 3)
+    result['cpu_percent'] = round(100 * cpu_seconds / process_seconds, 1)
+    return result
+
+
+async def run_scenario(scenario, args):
+    is_read_scenario = scenario in READ_SCENARIOS
+    server = MockChatServer(
+        rate=args.rate if is_read_scenario else 0,
+        latency=args.latency,
+        disconnect_every=args.disconnect_every,
+        duration=args.duration,
+    )
+    token = server.add_account(scenario)
+    count = int(args.rate * args.duration) if is_read_scenario else args.send_count
+    ready = asyncio.Event()
+    serving = asyncio.create_task(server.serve(ready))
+    await ready.wait()
+
+    child_args = [
+        '--host', server.host, '--port', str(server.port), '--sender_port', str(server.sender_port),
+        '--token', token, '--timeout', str(args.duration + CHILD_TIMEOUT),
+    ]
+    if scenario == 'start_chat':
+        # startup is measured against a long history, like the one of a regular user
+        child_args += ['--log_path', prefill_history(args.history_messages)]
+    recording_path = None
+    if is_read_scenario and args.replay_speed is not None:
+        recording_path = os.path.join(tempfile.mkdtemp(), f'{scenario}.rec')
+        child_args += ['--record', recording_path]
+
+    result = await run_child_process(scenario, child_args + ['--count', str(count)])
+    if not is_read_scenario:
+        await wait_for_delivery(server, count)
+        recorder = LatencyRecorder()
+        # a message resent after a lost confirmation arrives twice, only its first copy counts
+        delivered = {}
+        for _, text, received_at in server.received:
+            delivered.setdefault(text, received_at)
+        for text, received_at in delivered.items():
+            recorder.add(text, received_at)
+        result.update(recorder.summary())
+    serving.cancel()
+    result['lost'] = count - result['messages']
+    results = [result]
+
+    if recording_path:
+        # the same bytes again without the server, differences between runs come from the client only
+        replay_args = [argument if argument != '--record' else '--replay' for argument in child_args]
+        replay_args += ['--replay_speed', str(args.replay_speed), '--count', str(result['messages'])]
+        if scenario == 'start_chat':
+            # the first run has saved the bench messages into its history, they must not be counted again
+            replay_args[replay_args.index('--log_path') + 1] = prefill_history(args.history_messages)
+        results.append(await run_child_process(scenario, replay_args))
+        results[-1]['scenario'] = f'{scenario}_replay'
+    return results
+
+
+def print_results(results):
+    columns = ['scenario', 'messages', 'lost', 'messages_per_second', 'latency_p50_ms', 'latency_p90_ms',
+               'latency_p99_ms', 'startup_ms', 'cpu_percent', 'rss_kb']
+    print(' | '.join(columns))
+    for result in results:
+        values = []
+        for column in columns:
+            value = result.get(column)
+            values.append(f'{value:.2f}' if isinstance(value, float) else str(value))
+        print(' | '.join(values))
+
+
+async def main(args):
+    results = []
+    for scenario in args.scenario or SCENARIOS:
+        logger.info(f'run {scenario}')
+        results.extend(await run_scenario(scenario, args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    parser = configargparse.ArgParser(description='Benchmark chat clients against the local mock server')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='scenario to run, all by default')
+    parser.add_argument('--rate', type=float, default=2000, help='messages per second the server broadcasts')
+    parser.add_argument('--duration', type=float, default=5, help='seconds the server broadcasts')
+    parser.add_argument('--send_count', type=int, default=1000, help='messages to send in sender scenarios')
+    parser.add_argument('--latency', type=float, default=0, help='server delay before every answer, seconds')
+    parser.add_argument('--disconnect_every', type=float, default=0, help='server drops connections every N seconds')
+    parser.add_argument('--history_messages', type=int, default=100000,
+                        help='messages in history when start_chat starts')
+    parser.add_argument('--replay_speed', type=float,
+                        help='record read scenarios and replay them at this speed, 0 for as fast as possible')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    parser.add_argument('--child', choices=SCENARIOS, help=configargparse.SUPPRESS)
+    parser.add_argument('--host', help=configargparse.SUPPRESS)
+    parser.add_argument('--port', help=configargparse.SUPPRESS)
+    parser.add_argument('--sender_port', help=configargparse.SUPPRESS)
+    parser.add_argument('--token', help=configargparse.SUPPRESS)
+    parser.add_argument('--count', type=int, help=configargparse.SUPPRESS)
+    parser.add_argument('--timeout', type=float, help=configargparse.SUPPRESS)
+    parser.add_argument('--log_path', help=configargparse.SUPPRESS)
+    parser.add_argument('--spawned_at', type=int, help=configargparse.SUPPRESS)
+    parser.add_argument('--record', help=configargparse.SUPPRESS)
+    parser.add_argument('--replay', help=configargparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        logging.basicConfig(level=logging.WARNING)
+        asyncio.run(run_child(args))
+    else:
+        logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(name)s:%(message)s')
+        asyncio.run(main(args))
@@ -0,0 +1,49 @@
+import logging
+import os
+
+import configargparse
+
+from messenger.history_store import HistoryStore, HistoryLocked
+from messenger.retention import apply_retention, needs_reindex, policy_from_args
+from messenger.search_index import SearchIndex, IndexLocked, INDEX_FILENAME
+
+
+def compact_history(log_path, policy):
+    # segments are renamed and offsets change, so nobody may write the history meanwhile
+    store = HistoryStore(log_path)
+    try:
+        report = apply_retention(store, policy)
+        index_path = os.path.join(log_path, INDEX_FILENAME)
+        if needs_reindex(report) and os.path.exists(index_path):
+            index = SearchIndex(index_path, load=False)
+            try:
+                index.rebuild(store)
+            finally:
+                index.close()
+    finally:
+        store.close()
+    return report
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(name)s:%(message)s')
+
+    parser = configargparse.ArgParser(
+        default_config_files=['settings/settings.ini'],
+        ignore_unknown_config_file_keys=True,
+        description='Drop and compact old dvmn chat history',
+    )
+    parser.add_argument('-c', '--config', is_config_file=True, help='config file path')
+    parser.add_argument('--log_path', required=True, help='path to chat history directory')
+    parser.add_argument('--max_history_age', type=float, help='remove history segments older than this many days')
+    parser.add_argument('--max_history_size', type=int, help='remove oldest segments while history is bigger, bytes')
+    parser.add_argument('--compact_after', type=float,
+                        help='compress segments older than this many days and drop empty and watchdog lines')
+    args = parser.parse_args()
+
+    try:
+        report = compact_history(args.log_path, policy_from_args(args))
+    except (HistoryLocked, IndexLocked) as e:
+        parser.error(f'{e}, stop it or limit history with its own --max_history_age and --compact_after')
+    print(f'removed segments: {report.removed}, compacted segments: {report.compacted}, '
+          f'dropped lines: {report.dropped}, freed bytes: {report.freed}')
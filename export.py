@@ -0,0 +1,61 @@
+import logging
+import time
+
+import configargparse
+
+from messenger.export import (ExportFormat, open_writer, read_columnar, records_from_legacy,
+                              records_from_store)
+from messenger.history_store import HistoryStore
+
+
+def export_history(records, output, export_format):
+    writer = open_writer(output, export_format)
+    exported = 0
+    started_at = time.monotonic()
+    try:
+        for record in records:
+            writer.write(record)
+            exported += 1
+    finally:
+        writer.close()
+    logging.debug(f'exported {exported} messages in {time.monotonic() - started_at:.3f}s')
+    return exported
+
+
+def read_source(args):
+    if args.legacy:
+        yield from records_from_legacy(args.legacy)
+    elif args.columnar:
+        with open(args.columnar, 'rb') as f:
+            yield from read_columnar(f)
+    else:
+        store = HistoryStore(args.log_path, readonly=True)
+        try:
+            yield from records_from_store(store)
+        finally:
+            store.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(name)s:%(message)s')
+
+    parser = configargparse.ArgParser(
+        default_config_files=['settings/settings.ini'],
+        ignore_unknown_config_file_keys=True,
+        description='Export dvmn chat history for analytics',
+    )
+    parser.add_argument('-c', '--config', is_config_file=True, help='config file path')
+    parser.add_argument('--log_path', help='path to chat history directory')
+    parser.add_argument('--legacy', help='export old history.txt instead of history directory')
+    parser.add_argument('--columnar', help='convert columnar export instead of history directory')
+    parser.add_argument('--format', type=ExportFormat, choices=list(ExportFormat), default=ExportFormat.NDJSON,
+                        help='output format')
+    parser.add_argument('--output', default='-', help='output file, ndjson can be written to stdout with -')
+    args = parser.parse_args()
+
+    if not (args.log_path or args.legacy or args.columnar):
+        parser.error('one of --log_path, --legacy or --columnar is required')
+    if args.format is ExportFormat.COLUMNAR and args.output == '-':
+        parser.error('columnar export needs --output file')
+
+    export_history(read_source(args), args.output, args.format)
@@ -1,20 +1,108 @@
 import asyncio
+import contextlib
 import logging
-from datetime import datetime
+import multiprocessing
+import os
+import time
 
-import aiofiles as aiofiles
 import configargparse
+from anyio import create_task_group
 
-from messenger.connection import get_connection
+from messenger.archiver import archive_endpoints, parse_endpoint, shard_endpoints, READ_TIMEOUT
+from messenger.batch_writer import FsyncPolicy
+from messenger.export import ExportFormat, open_writer
+from messenger.connection import CONNECTION_IDS, get_connection
+from messenger.framing import read_frame
+from messenger.history_store import HistoryStore, HistoryLocked
+from messenger.metrics import serve_metrics, watch_queues
+from messenger.msg_history import save_messages
+from messenger.pipeline import run_pipeline
+from messenger.queues import MonitoredQueue
+from messenger.replay import configure as configure_traffic, REAL_TIME
+from messenger.retention import enforce_retention, policy_from_args
+from messenger.search_index import SearchIndex, INDEX_FILENAME
 
+WORKER_RESTART_DELAY = 5
 
-async def listen_chat(host, port, log_path):
+
+async def listen_chat(host, port, saving_queue):
     async with get_connection(host, port) as (reader, writer):
-        async with aiofiles.open(log_path, mode='a') as f:
-            while message := await reader.readline():
-                text = f'[{datetime.now().strftime("%d.%m.%y %H:%M")}]: {message.decode()}'
-                logging.info(text)
-                await f.write(text)
+        conn_id = next(CONNECTION_IDS)
+        while message := await read_frame(reader, conn_id):
+            logging.info('%s', message)
+            await saving_queue.put(message)
+
+
+async def main(args):
+    store = HistoryStore(args.log_path, args.segment_size, args.compress_history)
+    search_index = None
+    if args.search_index:
+        search_index = SearchIndex(os.path.join(args.log_path, INDEX_FILENAME))
+        search_index.catch_up(store)
+    exporter = open_writer(args.export_path, args.export_format, append=True) if args.export_path else None
+    saving_queue = MonitoredQueue('saving', args.saving_queue_size)
+    try:
+        async with create_task_group() as tg:
+            if args.metrics_port:
+                watch_queues([saving_queue])
+                await tg.start(serve_metrics, args.metrics_host, args.metrics_port)
+            await tg.start(save_messages, store, saving_queue, args.fsync, search_index, exporter)
+            retention_policy = policy_from_args(args)
+            if any(retention_policy):
+                await tg.start(enforce_retention, store, retention_policy, search_index)
+            await listen_chat(args.host, args.port, saving_queue)
+            tg.cancel_scope.cancel()
+    finally:
+        store.close()
+        if search_index:
+            search_index.close()
+        if exporter:
+            exporter.close()
+
+
+def run_shard(endpoints, args, metrics_port=None):
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(archive_endpoints(
+            endpoints,
+            args.log_path,
+            args.metrics_host,
+            metrics_port,
+            segment_size=args.segment_size,
+            compress_history=args.compress_history,
+            fsync_policy=args.fsync,
+            saving_queue_size=args.saving_queue_size,
+            search_index=args.search_index,
+            read_timeout=args.read_timeout,
+            retention_policy=policy_from_args(args),
+        ))
+
+
+def run_daemon(args):
+    shards = shard_endpoints(args.endpoint, args.workers)
+    if len(shards) == 1:
+        run_shard(shards[0], args, args.metrics_port)
+        return
+
+    # every worker has its own event loop and serves its own metrics on the next port
+    workers = [None] * len(shards)
+    try:
+        while True:
+            for number, shard in enumerate(shards):
+                if workers[number] and workers[number].is_alive():
+                    continue
+                if workers[number]:
+                    logging.warning('worker %s exited with code %s, restart it', number, workers[number].exitcode)
+                metrics_port = args.metrics_port + number if args.metrics_port else None
+                workers[number] = multiprocessing.Process(target=run_shard, args=(shard, args, metrics_port),
+                                                          name=f'listener-{number}', daemon=True)
+                workers[number].start()
+                logging.debug('worker %s archives %s', number, ', '.join(endpoint.name for endpoint in shard))
+            time.sleep(WORKER_RESTART_DELAY)
+    finally:
+        for worker in workers:
+            if worker and worker.is_alive():
+                worker.terminate()
+                worker.join()
 
 
 if __name__ == '__main__':
@@ -28,7 +116,70 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--config', is_config_file=True, help='config file path')
     parser.add_argument('--host', required=True, help='chat server url')
     parser.add_argument('--port', required=True, help='chat server port')
-    parser.add_argument('--log_path', required=True, help='path to chat logs')
+    parser.add_argument('--log_path', required=True, help='path to chat history directory')
+    parser.add_argument('--segment_size', type=int, default=16 * 1024 * 1024, help='history segment size in bytes')
+    parser.add_argument('--compress_history', action='store_true', help='compress sealed history segments')
+    parser.add_argument('--max_history_age', type=float, help='remove history segments older than this many days')
+    parser.add_argument('--max_history_size', type=int, help='remove oldest segments while history is bigger, bytes')
+    parser.add_argument('--compact_after', type=float,
+                        help='compress segments older than this many days and drop empty and watchdog lines')
+    parser.add_argument('--fsync', type=FsyncPolicy, choices=list(FsyncPolicy), default=FsyncPolicy.NEVER,
+                        help='when to fsync history to disk')
+    parser.add_argument('--export_path', help='also append every saved message to this file for analytics')
+    parser.add_argument('--export_format', type=ExportFormat, choices=list(ExportFormat),
+                        default=ExportFormat.NDJSON, help='format of --export_path')
+    parser.add_argument('--metrics_host', default='127.0.0.1', help='host to serve metrics on')
+    parser.add_argument('--metrics_port', type=int, help='serve metrics on this port, metrics are off without it')
+    parser.add_argument('--saving_queue_size', type=int, default=10000,
+                        help='messages waiting to be saved before reading from server pauses')
+    parser.add_argument('--search_index', action='store_true', help='keep search index of history up to date')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='write history, index and export in worker processes, the main one only reads the chat')
+    parser.add_argument('--record', help='record raw traffic with the chat server to this file')
+    parser.add_argument('--replay', help='read chat traffic from a file made with --record instead of the network')
+    parser.add_argument('--replay_speed', type=float, default=REAL_TIME,
+                        help='replay N times faster than recorded, 0 for as fast as possible')
+    parser.add_argument('--endpoint', type=parse_endpoint, action='append',
+                        help='archive name=host:port into log_path/name, can be repeated')
+    parser.add_argument('--workers', type=int, default=1, help='processes to share endpoints between')
+    parser.add_argument('--read_timeout', type=float, default=READ_TIMEOUT,
+                        help='with --endpoint or --pipeline reconnect after this many seconds of silence')
     args = parser.parse_args()
 
-    asyncio.run(listen_chat(args.host, args.port, args.log_path))
+    if args.endpoint:
+        if args.export_path:
+            parser.error('--export_path works with a single chat only')
+        if args.pipeline:
+            parser.error('--pipeline works with a single chat only')
+        if args.record or args.replay:
+            parser.error('--record and --replay work with a single chat only')
+        with contextlib.suppress(KeyboardInterrupt):
+            run_daemon(args)
+    else:
+        recorder = configure_traffic(args.record, args.replay, args.replay_speed)
+        try:
+            if args.pipeline:
+                with contextlib.suppress(KeyboardInterrupt):
+                    asyncio.run(run_pipeline(
+                        args.host,
+                        args.port,
+                        args.log_path,
+                        segment_size=args.segment_size,
+                        compress_history=args.compress_history,
+                        fsync_policy=args.fsync,
+                        search_index=args.search_index,
+                        export_path=args.export_path,
+                        export_format=args.export_format,
+                        saving_queue_size=args.saving_queue_size,
+                        metrics_host=args.metrics_host,
+                        metrics_port=args.metrics_port,
+                        retention_policy=policy_from_args(args),
+                        read_timeout=args.read_timeout,
+                    ))
+            else:
+                asyncio.run(main(args))
+        except HistoryLocked as e:
+            parser.error(f'{e}, run the second listener with another --log_path')
+        finally:
+            if recorder:
+                recorder.close()
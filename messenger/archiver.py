@@ -0,0 +1,102 @@
+import logging
+import os
+import re
+from collections import namedtuple
+
+from anyio import create_task_group, ExceptionGroup, TASK_STATUS_IGNORED
+
+from messenger import metrics
+from messenger.batch_writer import FsyncPolicy
+from messenger.connection import ReconnectManager
+from messenger.framing import Message
+from messenger.history_store import HistoryStore, DEFAULT_SEGMENT_SIZE
+from messenger.liveness import Channel, LivenessTracker
+from messenger.msg_history import save_messages
+from messenger.queues import MonitoredQueue
+from messenger.resume import ResumeTracker, read_resumed
+from messenger.retention import enforce_retention, RetentionPolicy
+from messenger.search_index import SearchIndex, INDEX_FILENAME
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT = re.compile(r'^(?:(?P<name>[\w.-]+)=)?(?P<host>[^=]+):(?P<port>\d+)$')
+SAVING_QUEUE_SIZE = 10000
+READ_TIMEOUT = 60
+
+Endpoint = namedtuple('Endpoint', 'name host port')
+
+
+def parse_endpoint(spec):
+    match = ENDPOINT.match(spec.strip())
+    if not match:
+        raise ValueError(f'endpoint must look like name=host:port, got {spec!r}')
+    name = match.group('name') or f"{match.group('host')}_{match.group('port')}"
+    return Endpoint(name, match.group('host'), int(match.group('port')))
+
+
+class EndpointArchiver:
+    def __init__(self, endpoint, archive_path, segment_size=DEFAULT_SEGMENT_SIZE, compress_history=False,
+                 fsync_policy=FsyncPolicy.NEVER, saving_queue_size=SAVING_QUEUE_SIZE, search_index=False,
+                 read_timeout=READ_TIMEOUT, retention_policy=RetentionPolicy()):
+        self.endpoint = endpoint
+        self.log_path = os.path.join(archive_path, endpoint.name)
+        self.segment_size = segment_size
+        self.compress_history = compress_history
+        self.fsync_policy = fsync_policy
+        self.with_search_index = search_index
+        self.read_timeout = read_timeout
+        self.retention_policy = retention_policy
+
+        self.saving_queue = MonitoredQueue(endpoint.name, saving_queue_size)
+        self.reconnector = ReconnectManager(endpoint.name, exceptions=(ConnectionError, ExceptionGroup, OSError),
+                                            logger=logger)
+        self.resume = ResumeTracker()
+        self.archived = metrics.registry.counter('messenger_endpoint_messages_total', 'Messages archived per endpoint',
+                                                 {'endpoint': endpoint.name})
+
+    async def read_endpoint(self):
+        liveness = LivenessTracker(channels=(Channel.READ,), timeout=self.read_timeout)
+        await read_resumed(self.endpoint.host, self.endpoint.port, liveness, self.resume, self.archive,
+                           self.reconnector.connected)
+
+    async def archive(self, message):
+        await self.saving_queue.put(message)
+        if metrics.enabled and isinstance(message, Message):
+            self.archived.inc()
+
+    async def run(self, task_status=TASK_STATUS_IGNORED):
+        os.makedirs(self.log_path, exist_ok=True)
+        store = HistoryStore(self.log_path, self.segment_size, self.compress_history)
+        search_index = None
+        if self.with_search_index:
+            search_index = SearchIndex(os.path.join(self.log_path, INDEX_FILENAME))
+            search_index.catch_up(store)
+        self.resume.seed(store.last(self.resume.window))
+        logger.debug('archive %s:%s to %s', self.endpoint.host, self.endpoint.port, self.log_path)
+        try:
+            async with create_task_group() as tg:
+                await tg.start(save_messages, store, self.saving_queue, self.fsync_policy, search_index)
+                if any(self.retention_policy):
+                    await tg.start(enforce_retention, store, self.retention_policy, search_index)
+                tg.start_soon(self.reconnector.run, self.read_endpoint)
+                task_status.started()
+        finally:
+            store.close()
+            if search_index:
+                search_index.close()
+
+
+async def archive_endpoints(endpoints, archive_path, metrics_host=None, metrics_port=None,
+                            task_status=TASK_STATUS_IGNORED, **options):
+    archivers = [EndpointArchiver(endpoint, archive_path, **options) for endpoint in endpoints]
+    async with create_task_group() as tg:
+        if metrics_port:
+            metrics.watch_queues([archiver.saving_queue for archiver in archivers])
+            await tg.start(metrics.serve_metrics, metrics_host, metrics_port)
+        for archiver in archivers:
+            await tg.start(archiver.run)
+        task_status.started()
+
+
+def shard_endpoints(endpoints, workers):
+    return [endpoints[worker::workers] for worker in range(workers) if endpoints[worker::workers]]
@@ -1,11 +1,14 @@
 import json
 import logging
 
+from anyio import to_thread
+
+from messenger import metrics
+
 from messenger.connection import get_connection
+from messenger.credentials import get_credentials
 from messenger.messages import send_message, read_message, LINE_FEED
-from messenger.token_storage import save_token_to_file
 
-AUTH_PATH = 'settings/auth.ini'
 logger = logging.getLogger('sender')
 
 
@@ -14,40 +17,73 @@ class UnknownToken(Exception):
         return 'Unknown token. Check it out or register it again.'
 
 
+class UnknownOutcome(Exception):
+    # the username has reached the server, so the account may exist although its token never came back
+    def __init__(self, username, error):
+        self.username = username
+        self.error = error
+
+    def __str__(self):
+        return f'registration of {self.username} may have succeeded, no usable answer: {self.error!r}'
+
+
 async def authorise(reader, writer, token):
-    text = f'{token}{LINE_FEED}'
-    await send_message(writer, text)
+    with metrics.timed(metrics.AUTH_SECONDS):
+        text = f'{token}{LINE_FEED}'
+        await send_message(writer, text)
 
-    message = await read_message(reader)
-    if message == f'null{LINE_FEED}':
-        logger.error('Неизвестный токен. Проверьте его или зарегистрируйте заново.')
-        raise UnknownToken()
+        message = await read_message(reader)
+        if message == f'null{LINE_FEED}':
+            logger.error('Неизвестный токен. Проверьте его или зарегистрируйте заново.')
+            # the account stays in the file, only this process stops using the token
+            get_credentials().reject(token)
+            raise UnknownToken()
 
-    user = json.loads(message)
-    nickname = user['nickname']
-    logger.debug(f'Выполнена авторизация. Пользователь {nickname}')
+        user = json.loads(message)
+        nickname = user['nickname']
+        logger.debug('Выполнена авторизация. Пользователь %s', nickname)
 
-    await read_message(reader)
+        await read_message(reader)
 
     return nickname
 
 
-async def register(host, port, username):
+async def request_account(host, port, username, pipelined=False):
+    # connection errors before the username is sent are safe to retry, later ones raise UnknownOutcome
     async with get_connection(host, port) as (reader, writer):
-        await read_message(reader)
+        if not pipelined:
+            await read_message(reader)
 
-        text = f'{LINE_FEED}'
-        await send_message(writer, text)
+            text = f'{LINE_FEED}'
+            await send_message(writer, text)
 
-        await read_message(reader)
+            await read_message(reader)
 
-        text = f'{username}{LINE_FEED}'
-        await send_message(writer, text)
+        try:
+            if pipelined:
+                # the server reads lines in order, so both answers go out before its prompts arrive
+                await send_message(writer, f'{LINE_FEED}{username}{LINE_FEED}')
+                await read_message(reader)
+                await read_message(reader)
+            else:
+                text = f'{username}{LINE_FEED}'
+                await send_message(writer, text)
 
-        message = await read_message(reader)
+            message = await read_message(reader)
+        except (ConnectionError, OSError) as e:
+            raise UnknownOutcome(username, e) from e
+
+    if not message:
+        raise UnknownOutcome(username, ConnectionError('server closed connection before sending the account'))
+    try:
+        user = json.loads(message)
+        return user['nickname'], user['account_hash']
+    except (ValueError, KeyError) as e:
+        raise UnknownOutcome(username, e) from e
 
-    user = json.loads(message)
-    token = user['account_hash']
-    await save_token_to_file(AUTH_PATH, token)
+
+async def register(host, port, username):
+    nickname, token = await request_account(host, port, username)
+    await to_thread.run_sync(get_credentials().put, nickname, token)
 
     return token
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from enum import Enum
+
+from anyio import CancelScope, TASK_STATUS_IGNORED, get_cancelled_exc_class, to_thread
+from async_timeout import timeout
+
+from messenger import metrics
+from messenger.export import record_from_text
+from messenger.framing import Message
+from messenger.history_store import FLAG_GAP, pack_flags
+from messenger.resume import GapMarker
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 64 * 1024
+MAX_BATCH_DELAY = 0.05
+FSYNC_INTERVAL = 1
+
+
+class FsyncPolicy(Enum):
+    NEVER = 'never'
+    BATCH = 'batch'
+    INTERVAL = 'interval'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class BatchWriter:
+    def __init__(self, store, max_batch_size=MAX_BATCH_SIZE, max_delay=MAX_BATCH_DELAY,
+                 fsync_policy=FsyncPolicy.NEVER, fsync_interval=FSYNC_INTERVAL, search_index=None, exporter=None):
+        self.store = store
+        self.search_index = search_index
+        self.exporter = exporter
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self._last_fsync = time.monotonic()
+
+    def write_batch(self, messages):
+        with metrics.timed(metrics.HISTORY_WRITE_SECONDS):
+            self._write_batch(messages)
+        if metrics.enabled:
+            metrics.MESSAGES_SAVED.inc(len(messages))
+
+    def _write_batch(self, messages):
+        for message in messages:
+            if isinstance(message, Message):
+                timestamp, text, conn_id = message.wall_time, message.text, message.conn_id
+                offset = self.store.append(message.line_bytes, timestamp, pack_flags(conn_id=conn_id))
+            elif isinstance(message, GapMarker):
+                self.store.append(str(message), message.wall_time, FLAG_GAP)
+                continue
+            else:
+                timestamp, text, conn_id = time.time(), message, 0
+                offset = self.store.append(message, timestamp)
+            if self.search_index:
+                self.search_index.add(offset, timestamp, text)
+            if self.exporter:
+                self.exporter.write(record_from_text(text, timestamp, conn_id))
+        if self.search_index:
+            self.search_index.flush()
+        if self.exporter:
+            self.exporter.flush()
+
+        if self.fsync_policy is FsyncPolicy.BATCH:
+            self.store.fsync()
+        elif self.fsync_policy is FsyncPolicy.INTERVAL and time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self.store.fsync()
+            self._last_fsync = time.monotonic()
+        else:
+            self.store.flush()
+
+    async def collect_batch(self, queue, batch):
+        batch.append(await queue.get())
+        batch_size = len(batch[0])
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+        while batch_size < self.max_batch_size:
+            if queue.empty():
+                delay = deadline - asyncio.get_running_loop().time()
+                if delay <= 0:
+                    break
+                try:
+                    async with timeout(delay):
+                        message = await queue.get()
+                except asyncio.TimeoutError:
+                    break
+            else:
+                message = queue.get_nowait()
+            batch.append(message)
+            batch_size += len(message)
+
+    async def run(self, queue, task_status=TASK_STATUS_IGNORED):
+        task_status.started()
+        batch = []
+        try:
+            while True:
+                await self.collect_batch(queue, batch)
+                pending, batch = batch, []
+                await to_thread.run_sync(self.write_batch, pending)
+        except get_cancelled_exc_class():
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            if batch:
+                logger.debug('flush %s messages before exit', len(batch))
+                with CancelScope(shield=True):
+                    await to_thread.run_sync(self.write_batch, batch)
+            raise
@@ -1,19 +1,19 @@
 import asyncio
 import logging
-import time
 from asyncio import Event
-from datetime import datetime
 from enum import Enum
 
 from anyio import create_task_group, TASK_STATUS_IGNORED, get_cancelled_exc_class, ExceptionGroup
-from async_timeout import timeout
 
-from messenger.connection import get_connection, reconnect
-from messenger.messages import read_message, submit_message
+from messenger.connection import get_connection, ReconnectManager
+from messenger.messages import read_confirmations, read_message, submit_message, submit_messages
+from messenger.liveness import Channel, LivenessTracker
 from messenger.auth_tools import UnknownToken, authorise
+from messenger.resume import read_resumed
 
 watchdog_logger = logging.getLogger('watchdog')
-TIMEOUT_IN_SECONDS = 5
+CONNECTION_ERRORS = (ConnectionError, ExceptionGroup, OSError)
+UNKNOWN_NICKNAME = 'неизвестно'
 
 
 class ReadConnectionStateChanged(Enum):
@@ -39,112 +39,111 @@ class NicknameReceived:
         self.nickname = nickname
 
 
-async def read_msgs(host, port, messages_queue, saving_queue, status_updates_queue, watchdog_queue,
-                    task_status=TASK_STATUS_IGNORED):
-    try:
-        task_status.started()
-        status_updates_queue.put_nowait(ReadConnectionStateChanged.INITIATED)
-        async with get_connection(host, port) as connection:
-            status_updates_queue.put_nowait(ReadConnectionStateChanged.ESTABLISHED)
-            reader, writer = connection
+async def read_msgs(host, port, messages_queue, saving_queue, status_updates_queue, liveness, reconnector=None,
+                    resume=None):
+    async def deliver(message):
+        await messages_queue.put(message)
+        await saving_queue.put(message)
 
-            while True:
-                try:
-                    async with timeout(TIMEOUT_IN_SECONDS) as cm:
-                        message = await reader.readline()
-                        text = f'[{datetime.now().strftime("%d.%m.%y %H:%M:%S")}]: {message.strip().decode()}'
-                        messages_queue.put_nowait(text)
-                        saving_queue.put_nowait(text)
-                        await add_watchdog_alive(watchdog_queue, 'New message in chat')
-                except asyncio.TimeoutError:
-                    if cm.expired:
-                        await add_watchdog_elapsed(watchdog_queue, TIMEOUT_IN_SECONDS, source='read')
-    except get_cancelled_exc_class():
+    def connected():
+        status_updates_queue.put_nowait(ReadConnectionStateChanged.ESTABLISHED)
+        if reconnector:
+            reconnector.connected()
+
+    status_updates_queue.put_nowait(ReadConnectionStateChanged.INITIATED)
+    try:
+        await read_resumed(host, port, liveness, resume, deliver, connected)
+    finally:
         status_updates_queue.put_nowait(ReadConnectionStateChanged.CLOSED)
-        raise
 
 
-async def send_msgs(host, port, token, sending_queue, status_updates_queue, watchdog_queue, token_error_event: Event,
-                    task_status=TASK_STATUS_IGNORED):
+async def send_msgs(host, port, token, sending_queue, status_updates_queue, liveness, token_error_event: Event,
+                    reconnector=None, task_status=TASK_STATUS_IGNORED):
     try:
         task_status.started()
         status_updates_queue.put_nowait(SendingConnectionStateChanged.INITIATED)
         async with get_connection(host, port) as connection:
             status_updates_queue.put_nowait(SendingConnectionStateChanged.ESTABLISHED)
             reader, writer = connection
+            liveness.touch(Channel.SEND)
             await read_message(reader)
 
             try:
-                await add_watchdog_alive(watchdog_queue, 'Prompt before auth')
                 nickname = await authorise(reader, writer, token)
-                await add_watchdog_alive(watchdog_queue, 'Authorization done')
-                status_updates_queue.put_nowait(NicknameReceived(nickname))
             except UnknownToken:
                 token_error_event.set()
+                raise
+            status_updates_queue.put_nowait(NicknameReceived(nickname))
+            liveness.disarm(Channel.SEND)
+            if reconnector:
+                reconnector.connected()
 
+            sending_queue.reconnected()
             async with create_task_group() as tg:
-                await tg.start(send_msg_from_queue, writer, sending_queue, watchdog_queue)
-                await tg.start(send_watchdog_msg, writer, watchdog_queue)
+                await tg.start(send_msg_from_queue, writer, sending_queue, liveness)
+                tg.start_soon(read_confirmations, reader, lambda: confirm_sent(sending_queue, liveness))
+                await tg.start(send_watchdog_msg, writer, liveness)
 
     except get_cancelled_exc_class():
         status_updates_queue.put_nowait(SendingConnectionStateChanged.CLOSED)
-        status_updates_queue.put_nowait(NicknameReceived('неизвестно'))
+        status_updates_queue.put_nowait(NicknameReceived(UNKNOWN_NICKNAME))
         raise
 
 
-async def send_msg_from_queue(writer, sending_queue, watchdog_queue, task_status=TASK_STATUS_IGNORED):
-    task_status.started()
-    while message := await sending_queue.get():
-        try:
-            async with timeout(TIMEOUT_IN_SECONDS) as cm:
-                await submit_message(writer, message)
-                await add_watchdog_alive(watchdog_queue, 'Message sent')
-        except asyncio.TimeoutError:
-            if cm.expired:
-                await add_watchdog_elapsed(watchdog_queue, TIMEOUT_IN_SECONDS, source='send')
-
-
-async def send_watchdog_msg(writer, watchdog_queue, task_status=TASK_STATUS_IGNORED):
+async def send_msg_from_queue(writer, outbox, liveness, task_status=TASK_STATUS_IGNORED):
     task_status.started()
     while True:
-        try:
-            async with timeout(TIMEOUT_IN_SECONDS) as cm:
-                await submit_message(writer, '')
-                await add_watchdog_alive(watchdog_queue, 'Watchdog message sent')
-        except asyncio.TimeoutError:
-            if cm.expired:
-                await add_watchdog_elapsed(watchdog_queue, TIMEOUT_IN_SECONDS, source='WD')
-        await asyncio.sleep(1)
+        batch = await outbox.take_batch()
+        # sending has a deadline only while messages wait for the server's confirmations
+        liveness.touch(Channel.SEND)
+        await submit_messages(writer, [message.text for message in batch])
 
 
-async def add_watchdog_alive(watchdog_queue, text):
-    watchdog_text = f'[{int(time.time())}] Connection is alive. {text}'
-    watchdog_queue.put_nowait(watchdog_text)
+def confirm_sent(outbox, liveness):
+    outbox.confirm()
+    if outbox.in_flight:
+        liveness.touch(Channel.SEND)
+    else:
+        liveness.disarm(Channel.SEND)
 
 
-async def add_watchdog_elapsed(watchdog_queue, seconds, source):
-    watchdog_text = f'[{int(time.time())}] {seconds}s timeout is elapsed from {source}'
-    watchdog_queue.put_nowait(watchdog_text)
-
-
-async def watch_for_connection(watchdog_queue, task_status=TASK_STATUS_IGNORED):
+async def send_watchdog_msg(writer, liveness, task_status=TASK_STATUS_IGNORED):
     task_status.started()
     while True:
-        message = await watchdog_queue.get()
-        watchdog_logger.debug(message)
-        if 'timeout is elapsed' in message:
-            raise ConnectionError
+        await submit_message(writer, '')
+        liveness.touch(Channel.PING)
+        await asyncio.sleep(1)
 
 
-@reconnect(exceptions=(ConnectionError, ExceptionGroup, OSError), logger=watchdog_logger)
-async def handle_connection(host, port, sender_port, token, messages_queue, sending_queue, saving_queue,
-                            status_updates_queue, token_error_event, task_status=TASK_STATUS_IGNORED):
-    watchdog_queue = asyncio.Queue()
+async def run_read_channel(host, port, messages_queue, saving_queue, status_updates_queue, reconnector, resume=None):
+    liveness = LivenessTracker(channels=(Channel.READ,), events_queue=status_updates_queue)
+    await read_msgs(host, port, messages_queue, saving_queue, status_updates_queue, liveness, reconnector, resume)
+
+
+async def run_send_channel(host, port, token, sending_queue, status_updates_queue, token_error_event, reconnector):
+    liveness = LivenessTracker(channels=(Channel.PING,), events_queue=status_updates_queue)
     try:
         async with create_task_group() as tg:
-            await tg.start(send_msgs, host, sender_port, token, sending_queue, status_updates_queue, watchdog_queue,
-                           token_error_event)
-            await tg.start(read_msgs, host, port, messages_queue, saving_queue, status_updates_queue, watchdog_queue)
-            await tg.start(watch_for_connection, watchdog_queue)
+            await tg.start(send_msgs, host, port, token, sending_queue, status_updates_queue, liveness,
+                           token_error_event, reconnector)
+            await tg.start(liveness.watch)
+    except UnknownToken:
+        # nothing is sent or acknowledged without a valid token, the outbox keeps the messages for the next start
+        status_updates_queue.put_nowait(SendingConnectionStateChanged.CLOSED)
     except ExceptionGroup as e:
-        raise ConnectionError
+        raise ConnectionError(f'{host}:{port} failed') from e
+
+
+async def handle_connection(host, port, sender_port, token, messages_queue, sending_queue, saving_queue,
+                            status_updates_queue, token_error_event, resume=None, task_status=TASK_STATUS_IGNORED):
+    # reading and sending reconnect independently, a failure of one does not break the other
+    read_reconnector = ReconnectManager('read', exceptions=CONNECTION_ERRORS, logger=watchdog_logger,
+                                        status_queue=status_updates_queue)
+    send_reconnector = ReconnectManager('send', exceptions=CONNECTION_ERRORS, logger=watchdog_logger,
+                                        status_queue=status_updates_queue)
+    async with create_task_group() as tg:
+        tg.start_soon(send_reconnector.run, run_send_channel, host, sender_port, token, sending_queue,
+                      status_updates_queue, token_error_event, send_reconnector)
+        tg.start_soon(read_reconnector.run, run_read_channel, host, port, messages_queue, saving_queue,
+                      status_updates_queue, read_reconnector, resume)
+        task_status.started()
@@ -1,50 +1,196 @@
 import asyncio
 import functools
+import itertools
 import logging
+import os
+import random
 import textwrap
+import time
+from collections import deque
 from contextlib import asynccontextmanager, suppress
+from enum import Enum
+
+from messenger import metrics
 
 logger = logging.getLogger(__name__)
 
+UNIX_SOCKET_PREFIX = 'unix:'
+RECOVERY_SAMPLES = 100
+RETRY_MESSAGE = textwrap.dedent("""\
+    Function: %s
+    Exception: %s
+    Retrying in %.2f seconds!""")
+
+# history index flags keep 24 bits of a connection id: the upper bits tell runs apart, the lower ones count
+# connections within a run. Ids of different runs may still clash, so they are not unique
+CONN_ID_BITS = 24
+RUN_ID_BITS = 12
+RUN_ID = (os.getpid() ^ int(time.time())) % (1 << RUN_ID_BITS)
+
+
+def make_connection_id(number):
+    counter_bits = CONN_ID_BITS - RUN_ID_BITS
+    return RUN_ID << counter_bits | number % (1 << counter_bits)
+
+
+# every connection to the chat gets its own id, it is saved with messages read from the connection
+CONNECTION_IDS = map(make_connection_id, itertools.count(1))
+# messenger.replay sets these to record the traffic or to read it from a recording instead of the network
+recorder = None
+replay = None
+
 
 @asynccontextmanager
 async def get_connection(host, port):
     try:
-        logger.debug(f'open connection to {host}:{port}')
-        reader, writer = await asyncio.open_connection(host, port)
+        logger.debug('open connection to %s:%s', host, port)
+        if replay:
+            reader, writer = await replay.open_connection(host, port)
+        elif recorder:
+            path = host[len(UNIX_SOCKET_PREFIX):] if host.startswith(UNIX_SOCKET_PREFIX) else None
+            reader, writer = await recorder.open_connection(host, port, path)
+        elif host.startswith(UNIX_SOCKET_PREFIX):
+            reader, writer = await asyncio.open_unix_connection(host[len(UNIX_SOCKET_PREFIX):])
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
         yield reader, writer
     finally:
         with suppress(UnboundLocalError):
-            logger.debug(f'close connection {host}:{port}')
+            logger.debug('close connection %s:%s', host, port)
             writer.close()
             await writer.wait_closed()
 
 
+class CircuitState(Enum):
+    CLOSED = 'в норме'
+    RETRYING = 'переподключаемся'
+    OPEN = 'пауза после серии ошибок'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class ReconnectStatus:
+    def __init__(self, name, state, delay=0, failures=0, recovery_seconds=None):
+        self.name = name
+        self.state = state
+        self.delay = delay
+        self.failures = failures
+        self.recovery_seconds = recovery_seconds
+
+    def __str__(self):
+        if self.state is CircuitState.CLOSED:
+            if self.recovery_seconds is None:
+                return str(self.state)
+            return f'{self.state}, восстановлено за {self.recovery_seconds:.1f}с'
+        return f'{self.state}, повтор через {self.delay:.1f}с, ошибок подряд: {self.failures}'
+
+
+class ReconnectManager:
+    def __init__(
+            self,
+            name: str = None,
+            start_sleep_time: float = 0.1,
+            factor: float = 2,
+            border_sleep_time: float = 10,
+            stable_after: float = 30,
+            failure_threshold: int = 10,
+            cooldown: float = 30,
+            exceptions: tuple = Exception,
+            logger: logging.Logger = None,
+            status_queue: asyncio.Queue = None,
+    ):
+        self.name = name
+        self.exceptions = exceptions
+        self.start_sleep_time = start_sleep_time
+        self.factor = factor
+        self.border_sleep_time = border_sleep_time
+        self.stable_after = stable_after
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.logger = logger
+        self.status_queue = status_queue
+
+        self.delay = start_sleep_time
+        self.failures = 0
+        self.reconnects = 0
+        self.outage_started_at = None
+        self.recovery_times = deque(maxlen=RECOVERY_SAMPLES)
+
+    def next_delay(self):
+        # decorrelated jitter: clients that failed together do not come back together
+        self.delay = min(self.border_sleep_time, random.uniform(self.start_sleep_time, self.delay * self.factor))
+        return self.delay
+
+    def reset(self):
+        self.delay = self.start_sleep_time
+        self.failures = 0
+
+    def connected(self):
+        recovery_seconds = None
+        if self.outage_started_at is not None:
+            recovery_seconds = time.monotonic() - self.outage_started_at
+            self.recovery_times.append(recovery_seconds)
+            self.outage_started_at = None
+            if self.logger:
+                self.logger.debug('%s recovered in %.3fs, stats: %s', self.name, recovery_seconds, self.stats())
+        self._publish(CircuitState.CLOSED, recovery_seconds=recovery_seconds)
+
+    def stats(self):
+        recovery_times = sorted(self.recovery_times) or [None]
+        return {
+            'name': self.name,
+            'reconnects': self.reconnects,
+            'failures_in_row': self.failures,
+            'recovery_median_seconds': recovery_times[len(recovery_times) // 2],
+            'recovery_max_seconds': recovery_times[-1],
+        }
+
+    def _publish(self, state, delay=0, recovery_seconds=None):
+        if self.status_queue is not None:
+            self.status_queue.put_nowait(ReconnectStatus(self.name, state, delay, self.failures, recovery_seconds))
+
+    async def run(self, func, *args, **kwargs):
+        while True:
+            started_at = time.monotonic()
+            try:
+                return await func(*args, **kwargs)
+            except self.exceptions as e:
+                if time.monotonic() - started_at >= self.stable_after:
+                    self.reset()
+                if self.outage_started_at is None:
+                    self.outage_started_at = time.monotonic()
+                self.failures += 1
+                self.reconnects += 1
+                if metrics.enabled:
+                    metrics.reconnects(self.name).inc()
+
+                if self.failures >= self.failure_threshold:
+                    # the circuit stays open: after the cooldown a single failure opens it again
+                    state, delay = CircuitState.OPEN, self.cooldown
+                    self.delay = self.start_sleep_time
+                else:
+                    state, delay = CircuitState.RETRYING, self.next_delay()
+                self._publish(state, delay)
+                if self.logger:
+                    self.logger.debug(RETRY_MESSAGE, func.__name__, e, delay)
+                await asyncio.sleep(delay)
+
+
 def reconnect(
         start_sleep_time: float = 0.1,
-        factor: int = 2,
+        factor: float = 2,
         border_sleep_time: float = 10,
         exceptions: tuple = Exception,
-        logger: logging.Logger = None
+        logger: logging.Logger = None,
+        **manager_options
 ):
     def wrapper(func):
         @functools.wraps(func)
         async def wrapped(*args, **kwargs):
-            _tries = 1
-            _delay = start_sleep_time
-            while True:
-                try:
-                    return await func(*args, **kwargs)
-                except exceptions as e:
-                    _tries += 1
-                    _delay = min(start_sleep_time * (factor ** _tries), border_sleep_time)
-                    msg = f"""\
-                    Function: {func.__name__}
-                    Exception: {e}
-                    Retrying in {_delay} seconds!"""
-                    if logger:
-                        logger.debug(textwrap.dedent(msg))
-                    await asyncio.sleep(_delay)
+            manager = ReconnectManager(func.__name__, start_sleep_time, factor, border_sleep_time,
+                                       exceptions=exceptions, logger=logger, **manager_options)
+            return await manager.run(func, *args, **kwargs)
 
         return wrapped
 
@@ -0,0 +1,153 @@
+import asyncio
+import tkinter as tk
+from collections import deque
+
+from anyio import to_thread
+
+WINDOW_SIZE = 1000
+PAGE_SIZE = 200
+FRAME_INTERVAL = 1 / 60
+
+
+def join_runs(lines, leading_newline=False, trailing_newline=False):
+    # arguments for a single Text.insert: text, tags, text, tags, ...
+    chunks = []
+    for number, line in enumerate(lines):
+        if number or leading_newline:
+            chunks.extend(('\n', ()))
+        chunks.extend(line.runs)
+    if trailing_newline:
+        chunks.extend(('\n', ()))
+    return chunks
+
+
+class ConversationView:
+    def __init__(self, panel, formatter, window_size=WINDOW_SIZE, page_size=PAGE_SIZE):
+        self.panel = panel
+        self.formatter = formatter
+        self.window_size = window_size
+        self.page_size = page_size
+
+        self.recent = deque(maxlen=window_size)
+        # history offsets of rendered lines, None for messages received in this session
+        self.offsets = deque()
+        self.detached = False
+        self.history_exhausted = False
+        self.older_requested = asyncio.Event()
+        self.scroll_top = 0.0
+
+        panel['yscrollcommand'] = self.on_scroll
+
+    @property
+    def is_at_bottom(self):
+        return self.panel.yview()[1] >= 1.0
+
+    def on_scroll(self, first, last):
+        self.panel.vbar.set(first, last)
+        first, last = float(first), float(last)
+        # older pages are loaded when the user scrolls up to the top, not when a short conversation fits the panel
+        scrolled_up = first < self.scroll_top
+        self.scroll_top = first
+        scrollable = last - first < 1.0
+        if scrollable and scrolled_up and first <= 0.0 and self.offsets and not self.history_exhausted:
+            self.older_requested.set()
+        if self.detached and last >= 1.0 and first > 0.0:
+            self.attach()
+
+    def append(self, items):
+        self.recent.extend(items)
+        if self.detached:
+            return
+
+        follow = self.is_at_bottom
+        self.panel['state'] = 'normal'
+        self._insert_bottom(items)
+        overflow = len(self.offsets) - self.window_size
+        if overflow > 0 and (follow or overflow > self.window_size):
+            self._delete_top(overflow)
+        if follow:
+            self.panel.yview(tk.END)
+        self.panel['state'] = 'disabled'
+
+    def prepend(self, records):
+        if not records:
+            self.history_exhausted = True
+            return
+
+        self.panel['state'] = 'normal'
+        self.panel.insert('1.0', *join_runs(records, trailing_newline=bool(self.offsets)))
+        self.offsets.extendleft(record.offset for record in reversed(records))
+        overflow = len(self.offsets) - 2 * self.window_size
+        if overflow > 0:
+            self._delete_bottom(overflow)
+            self.detached = True
+        self.panel.yview(f'{len(records) + 1}.0')
+        self.panel['state'] = 'disabled'
+
+    def replace(self, records, keep_lines):
+        self.panel['state'] = 'normal'
+        self.panel.delete('1.0', tk.END)
+        self.offsets.clear()
+        self.panel['state'] = 'disabled'
+        self.prepend(records)
+        self.panel.yview(f'{max(len(records) - keep_lines, 0) + 1}.0')
+
+    def attach(self):
+        self.detached = False
+        self.history_exhausted = False
+        self.panel['state'] = 'normal'
+        self.panel.delete('1.0', tk.END)
+        self.offsets.clear()
+        self._insert_bottom(list(self.recent))
+        self.panel.yview(tk.END)
+        self.panel['state'] = 'disabled'
+
+    def read_page(self, history, count, before=None):
+        return self.formatter.format_batch(history.last(count, before))
+
+    async def load_older(self, history):
+        top_offset = self.offsets[0] if self.offsets else None
+        if top_offset is not None:
+            self.prepend(await to_thread.run_sync(self.read_page, history, self.page_size, top_offset))
+            return
+        # the top line was received in this session, so its history offset is unknown:
+        # re-read the rendered lines from history together with the previous page
+        rendered = len(self.offsets)
+        records = await to_thread.run_sync(self.read_page, history, rendered + self.page_size)
+        if len(records) <= rendered:
+            self.history_exhausted = True
+            return
+        self.replace(records, rendered)
+
+    async def prefetch(self, history, limit):
+        # the last screenful is already shown, older messages are added above it page by page
+        while len(self.offsets) < limit and not self.history_exhausted and not self.detached:
+            if not self.offsets:
+                await asyncio.sleep(FRAME_INTERVAL)
+                continue
+            top_offset = self.offsets[0]
+            if top_offset is None:
+                return
+            count = min(self.page_size, limit - len(self.offsets))
+            records = await to_thread.run_sync(self.read_page, history, count, top_offset)
+            follow = self.is_at_bottom
+            self.prepend(records)
+            if follow:
+                self.panel.yview(tk.END)
+            await asyncio.sleep(FRAME_INTERVAL)
+
+    def _insert_bottom(self, items):
+        if not items:
+            return
+        self.panel.insert(tk.END, *join_runs(items, leading_newline=bool(self.offsets)))
+        self.offsets.extend(item.offset for item in items)
+
+    def _delete_top(self, count):
+        self.panel.delete('1.0', f'{count + 1}.0')
+        for _ in range(count):
+            self.offsets.popleft()
+
+    def _delete_bottom(self, count):
+        self.panel.delete(f'{len(self.offsets) - count}.end', tk.END)
+        for _ in range(count):
+            self.offsets.pop()
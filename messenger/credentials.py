@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+AUTH_PATH = 'settings/auth.ini'
+ACCOUNTS_PATH = 'settings/accounts.json'
+LOCK_SUFFIX = '.lock'
+# differs from any stat result, including None for a missing file
+NOT_LOADED = object()
+
+
+class CredentialStore:
+    def __init__(self, path=ACCOUNTS_PATH, legacy_path=AUTH_PATH):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.accounts = {}
+        self.default = None
+        self._version = NOT_LOADED
+        self._lock = threading.Lock()
+        # tokens the server has answered "null" to, they are not returned again in this process
+        self.rejected = set()
+
+    @contextmanager
+    def _file_lock(self):
+        # other processes, e.g. several sender.py, write the same file
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock, open(self.path + LOCK_SUFFIX, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _stat_version(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _refresh(self):
+        # a stat call is enough to notice that another process has changed the file
+        version = self._stat_version()
+        if version == self._version:
+            return
+        accounts, default = {}, None
+        if version is not None:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            accounts, default = data.get('accounts', {}), data.get('default')
+        elif os.path.exists(self.legacy_path):
+            with open(self.legacy_path, 'r') as f:
+                token = f.readline().strip()
+            if token:
+                accounts, default = {'': token}, ''
+        self.accounts, self.default, self._version = accounts, default, version
+
+    def _write(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, tmp_path = tempfile.mkstemp(dir=directory, prefix='.accounts')
+        try:
+            with os.fdopen(descriptor, 'w') as f:
+                json.dump({'default': self.default, 'accounts': self.accounts}, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._version = self._stat_version()
+
+    def get(self, nickname=None):
+        with self._lock:
+            self._refresh()
+            if nickname is None:
+                nickname = self.default
+            token = self.accounts.get(nickname)
+            return None if token in self.rejected else token
+
+    def nicknames(self):
+        with self._lock:
+            self._refresh()
+            return [nickname for nickname in self.accounts if nickname]
+
+    def put(self, nickname, token, make_default=True):
+        self.update({nickname: token}, default=nickname if make_default else None)
+
+    def update(self, accounts, default=None):
+        with self._file_lock():
+            self._version = NOT_LOADED
+            self._refresh()
+            self.accounts.update(accounts)
+            # the token from auth.ini has no nickname, it is replaced by the first named account
+            if '' in self.accounts and self.accounts[''] in accounts.values():
+                del self.accounts['']
+            if default is not None or self.default not in self.accounts:
+                self.default = default if default is not None else next(iter(self.accounts), None)
+            self._write()
+        logger.debug('saved %s accounts to %s', len(accounts), self.path)
+
+    def reject(self, token):
+        # a "null" answer may come from a wrong host or a test server, so the token is never deleted from disk
+        with self._lock:
+            self.rejected.add(token)
+            nicknames = [nickname or 'default account' for nickname, known in self.accounts.items() if known == token]
+        logger.warning('server did not accept the token of %s, remove it from %s if it is really dead',
+                       ', '.join(nicknames) or 'unknown account', self.path)
+
+
+_stores = {}
+
+
+def get_credentials(path=ACCOUNTS_PATH):
+    # one store per file in a process, so every caller shares the cache
+    if path not in _stores:
+        _stores[path] = CredentialStore(path)
+    return _stores[path]
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import namedtuple
+from enum import Enum
+
+from messenger.framing import split_line
+from messenger.history_store import FLAG_GAP, conn_id_of, parse_legacy_timestamp
+
+logger = logging.getLogger(__name__)
+
+ExportRecord = namedtuple('ExportRecord', 'timestamp author body conn_id')
+
+COLUMNAR_MAGIC = b'SCHCOL1\n'
+# records in the chunk, size of the columns before and after compression
+CHUNK_HEADER = struct.Struct('<III')
+CHUNK_SIZE = 4096
+# an unfinished chunk is written on flush once it is this old or this big, small chunks compress badly
+CHUNK_MAX_AGE = 5
+CHUNK_FLUSH_SIZE = 64 * 1024
+NO_AUTHOR = -1
+
+
+class ExportFormat(Enum):
+    NDJSON = 'ndjson'
+    COLUMNAR = 'columnar'
+
+    def __str__(self):
+        return str(self.value)
+
+
+def record_from_text(text, timestamp, conn_id=0):
+    _, author, body = split_line(text)
+    return ExportRecord(timestamp, author, body, conn_id)
+
+
+def records_from_store(store):
+    for record in store.tail():
+        if record.flags & FLAG_GAP:
+            continue
+        yield record_from_text(record.text, record.timestamp, conn_id_of(record.flags))
+
+
+def records_from_legacy(filepath):
+    # lines without a timestamp get the time of the line before them
+    timestamp = os.path.getmtime(filepath)
+    with open(filepath, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            timestamp = parse_legacy_timestamp(line) or timestamp
+            yield record_from_text(line, timestamp)
+
+
+def little_endian(column):
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+
+class NdjsonWriter:
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, record):
+        self.file.write(json.dumps(record._asdict(), ensure_ascii=False))
+        self.file.write('\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+
+
+class ColumnarWriter:
+    def __init__(self, file, chunk_size=CHUNK_SIZE, compression_level=6, max_chunk_age=CHUNK_MAX_AGE,
+                 flush_size=CHUNK_FLUSH_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+        self.max_chunk_age = max_chunk_age
+        self.flush_size = flush_size
+        if not file.tell():
+            file.write(COLUMNAR_MAGIC)
+        self._reset()
+
+    def _reset(self):
+        self.timestamps = array('d')
+        self.conn_ids = array('I')
+        self.author_sizes = array('i')
+        self.body_sizes = array('I')
+        self.authors = bytearray()
+        self.bodies = bytearray()
+        self.started_at = None
+
+    def write(self, record):
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+        self.timestamps.append(record.timestamp or 0)
+        self.conn_ids.append(record.conn_id or 0)
+        if record.author is None:
+            self.author_sizes.append(NO_AUTHOR)
+        else:
+            author = record.author.encode()
+            self.author_sizes.append(len(author))
+            self.authors += author
+        body = record.body.encode()
+        self.body_sizes.append(len(body))
+        self.bodies += body
+        if len(self.timestamps) >= self.chunk_size:
+            self.write_chunk()
+
+    def write_chunk(self):
+        count = len(self.timestamps)
+        if not count:
+            return
+        columns = b''.join([
+            little_endian(self.timestamps).tobytes(),
+            little_endian(self.conn_ids).tobytes(),
+            little_endian(self.author_sizes).tobytes(),
+            little_endian(self.body_sizes).tobytes(),
+            self.authors,
+            self.bodies,
+        ])
+        compressed = zlib.compress(columns, self.compression_level)
+        self.file.write(CHUNK_HEADER.pack(count, len(columns), len(compressed)))
+        self.file.write(compressed)
+        self._reset()
+
+    def flush(self):
+        # records of an unfinished chunk live only in memory, so it is not kept there for long
+        if self.started_at is not None:
+            size = len(self.authors) + len(self.bodies)
+            if size >= self.flush_size or time.monotonic() - self.started_at >= self.max_chunk_age:
+                self.write_chunk()
+        self.file.flush()
+
+    def close(self):
+        self.write_chunk()
+        self.file.close()
+
+
+def read_column(data, position, typecode, count):
+    column = array(typecode)
+    column.frombytes(data[position:position + count * column.itemsize])
+    return little_endian(column), position + count * column.itemsize
+
+
+def read_columnar(file):
+    if file.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError('not a columnar history export')
+    while header := file.read(CHUNK_HEADER.size):
+        if len(header) < CHUNK_HEADER.size:
+            logger.debug('columnar export ends with a partial chunk header')
+            return
+        count, size, compressed_size = CHUNK_HEADER.unpack(header)
+        data = zlib.decompress(file.read(compressed_size))
+        if len(data) != size:
+            raise ValueError('broken chunk in columnar history export')
+        timestamps, position = read_column(data, 0, 'd', count)
+        conn_ids, position = read_column(data, position, 'I', count)
+        author_sizes, position = read_column(data, position, 'i', count)
+        body_sizes, position = read_column(data, position, 'I', count)
+        body_position = position + sum(author_size for author_size in author_sizes if author_size != NO_AUTHOR)
+        for timestamp, conn_id, author_size, body_size in zip(timestamps, conn_ids, author_sizes, body_sizes):
+            author = None
+            if author_size != NO_AUTHOR:
+                author = data[position:position + author_size].decode()
+                position += author_size
+            body = data[body_position:body_position + body_size].decode()
+            body_position += body_size
+            yield ExportRecord(timestamp, author, body, conn_id)
+
+
+def read_ndjson(file):
+    for line in file:
+        yield ExportRecord(**json.loads(line))
+
+
+def open_writer(path, export_format, append=False):
+    if export_format is ExportFormat.NDJSON:
+        file = sys.stdout if path == '-' else open(path, 'a' if append else 'w', encoding='utf-8')
+        return NdjsonWriter(file)
+    return ColumnarWriter(open(path, 'ab' if append else 'wb'))
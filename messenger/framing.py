@@ -0,0 +1,106 @@
+import re
+import time
+
+from messenger import metrics
+
+TIMESTAMP_FORMAT = '%d.%m.%y %H:%M:%S'
+# how often the difference between wall and monotonic clocks is measured again
+CLOCK_CHECK_INTERVAL = 1
+
+# a history line: an optional "[time]: " stamp, an optional "author: " and the text of the message
+LINE = re.compile(r'^(\[[^\]]*\]: )?(?:([^:\n]{1,64}): )?(.*)$', re.S)
+
+# monotonic time of the last check and wall clock minus monotonic clock at that moment
+_clock_offset = (None, 0.0)
+
+
+def wall_clock_offset():
+    # monotonic clock does not jump, but the chat shows wall clock time, which NTP or a suspend may move
+    global _clock_offset
+    checked_at, offset = _clock_offset
+    now = time.monotonic()
+    if checked_at is None or now - checked_at >= CLOCK_CHECK_INTERVAL:
+        offset = time.time() - now
+        # one assignment, so other threads see either the old pair or the new one
+        _clock_offset = (now, offset)
+    return offset
+
+
+class TimestampFormatter:
+    def __init__(self, fmt=TIMESTAMP_FORMAT):
+        self.fmt = fmt
+        # second, prefix and its bytes are replaced together, the formatter is shared between threads
+        self._cache = (None, '', b'')
+
+    def _get(self, wall_time):
+        second = int(wall_time)
+        cache = self._cache
+        if cache[0] != second:
+            prefix = f'[{time.strftime(self.fmt, time.localtime(second))}]: '
+            cache = (second, prefix, prefix.encode())
+            self._cache = cache
+        return cache
+
+    def prefix(self, wall_time):
+        return self._get(wall_time)[1]
+
+    def prefix_bytes(self, wall_time):
+        return self._get(wall_time)[2]
+
+
+formatter = TimestampFormatter()
+
+
+def split_line(line):
+    # the stamp is empty and the author is None when the line has none
+    stamp, author, body = LINE.match(line).groups()
+    return stamp or '', author, body
+
+
+def strip_timestamp(line):
+    return line[len(split_line(line)[0]):]
+
+
+class Message:
+    __slots__ = ('raw', 'received_at', 'conn_id', '_text', '_line')
+
+    def __init__(self, raw, received_at=None, conn_id=0):
+        self.raw = raw
+        self.received_at = time.monotonic() if received_at is None else received_at
+        self.conn_id = conn_id
+        self._text = None
+        self._line = None
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __str__(self):
+        if self._line is None:
+            self._line = formatter.prefix(self.wall_time) + self.text
+        return self._line
+
+    def __repr__(self):
+        return f'Message({self.raw!r}, {self.received_at!r}, {self.conn_id!r})'
+
+    @property
+    def wall_time(self):
+        return self.received_at + wall_clock_offset()
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.raw.rstrip().decode(errors='replace')
+        return self._text
+
+    @property
+    def line_bytes(self):
+        # the decoded text, so a broken byte from the server never reaches the history as invalid UTF-8
+        return formatter.prefix_bytes(self.wall_time) + self.text.encode()
+
+
+async def read_frame(reader, conn_id=0):
+    raw = await reader.readline()
+    if metrics.enabled:
+        metrics.BYTES_RECEIVED.inc(len(raw))
+        metrics.MESSAGES_RECEIVED.inc()
+    return Message(raw, conn_id=conn_id)
@@ -4,30 +4,36 @@ from asyncio import Event
 from tkinter import messagebox
 from tkinter.scrolledtext import ScrolledText
 
-from anyio import create_task_group, TASK_STATUS_IGNORED
+from anyio import create_task_group, TASK_STATUS_IGNORED, to_thread
 
-from messenger import chat_client
+from messenger import chat_client, metrics
+from messenger.connection import ReconnectStatus
+from messenger.conversation import ConversationView, FRAME_INTERVAL
+from messenger.liveness import Channel, HealthEvent
+from messenger.rendering import LineFormatter, configure_tags, format_messages
+from messenger.search_index import find_messages
+from messenger.tk_loop import FrameScheduler, TkAppClosed, TkLoopMode, run_tk
 
-
-class TkAppClosed(Exception):
-    pass
+RECONNECT_CHANNEL_NAMES = {'read': 'чтения', 'send': 'отправки'}
+BATCH_SIZE = 500
+RENDER_CHUNK_SIZE = 100
+STATUS_LABELS = 3 + len(RECONNECT_CHANNEL_NAMES)
 
 
 def process_new_message(input_field, sending_queue):
     text = input_field.get()
-    sending_queue.put_nowait(text)
+    try:
+        sending_queue.put_nowait(text)
+    except asyncio.QueueFull:
+        # keep the text in the field, so the user can send it again when the queue is free
+        return
     input_field.delete(0, tk.END)
 
 
-async def update_tk(root_frame, interval=1 / 120, task_status=TASK_STATUS_IGNORED):
-    task_status.started()
-    while True:
-        try:
-            root_frame.update()
-        except tk.TclError:
-            # if application has been destroyed/closed
-            raise TkAppClosed()
-        await asyncio.sleep(interval)
+def process_search_query(search_field, search_queue):
+    query = search_field.get()
+    if query.strip():
+        search_queue.put_nowait(query)
 
 
 async def show_token_error_message(token_error_event: Event, task_status=TASK_STATUS_IGNORED):
@@ -38,25 +44,67 @@ async def show_token_error_message(token_error_event: Event, task_status=TASK_ST
         raise TkAppClosed()
 
 
-async def update_conversation_history(panel, messages_queue, task_status=TASK_STATUS_IGNORED):
+async def update_conversation_history(view, rendered_queue, scheduler, task_status=TASK_STATUS_IGNORED):
     task_status.started()
+    pending = []
+
+    def show_pending():
+        # a flood is inserted chunk by chunk, so the frame deadline is checked between chunks
+        batch = pending[:RENDER_CHUNK_SIZE]
+        del pending[:RENDER_CHUNK_SIZE]
+        # the view scrolls down only if the user has not scrolled up to read older messages
+        with metrics.span('render'):
+            view.append(batch)
+        return bool(pending)
+
     while True:
-        msg = await messages_queue.get()
+        pending.extend(await rendered_queue.get())
+        while not rendered_queue.empty():
+            pending.extend(rendered_queue.get_nowait())
+        scheduler.schedule('conversation', show_pending)
+        # keep the formatter waiting until the frame shows what is collected
+        if len(pending) >= BATCH_SIZE:
+            await scheduler.next_frame()
+
 
-        panel['state'] = 'normal'
-        if panel.index('end-1c') != '1.0':
-            panel.insert('end', '\n')
-        panel.insert('end', msg)
-        # TODO сделать промотку умной, чтобы не мешала просматривать историю сообщений
-        # ScrolledText.frame
-        # ScrolledText.vbar
-        panel.yview(tk.END)
-        panel['state'] = 'disabled'
+async def load_older_messages(view, history, history_limit=0, task_status=TASK_STATUS_IGNORED):
+    task_status.started()
+    if history.end_offset:
+        await view.prefetch(history, history_limit)
+    while True:
+        await view.older_requested.wait()
+        view.older_requested.clear()
+        await view.load_older(history)
 
 
-async def update_status_panel(status_labels, status_updates_queue, task_status=TASK_STATUS_IGNORED):
+async def show_search_results(root_frame, search_queue, history, search_index,
+                              task_status=TASK_STATUS_IGNORED):
     task_status.started()
-    nickname_label, read_label, write_label = status_labels
+    while True:
+        query = await search_queue.get()
+        records = await to_thread.run_sync(find_messages, search_index, history, query)
+
+        results_window = tk.Toplevel(root_frame)
+        results_window.title(f'Поиск: {query}')
+        results_panel = ScrolledText(results_window, wrap='none')
+        results_panel.pack(fill="both", expand=True)
+        text = '\n'.join(record.text for record in reversed(records) if record)
+        results_panel.insert(tk.END, text or 'Ничего не найдено')
+        results_panel['state'] = 'disabled'
+
+
+def set_label_text(label, text):
+    def update():
+        label['text'] = text
+    return update
+
+
+async def update_status_panel(status_labels, status_updates_queue, scheduler, formatter=None,
+                              task_status=TASK_STATUS_IGNORED):
+    task_status.started()
+    nickname_label, read_label, write_label, *reconnect_labels = status_labels
+    # each channel reconnects on its own, so each keeps its own line
+    reconnect_labels = dict(zip(RECONNECT_CHANNEL_NAMES, reconnect_labels))
 
     read_label['text'] = f'Чтение: нет соединения'
     write_label['text'] = f'Отправка: нет соединения'
@@ -64,14 +112,29 @@ async def update_status_panel(status_labels, status_updates_queue, task_status=T
 
     while True:
         msg = await status_updates_queue.get()
+        # a label shows only the latest state, states replaced within a frame are never drawn
         if isinstance(msg, chat_client.ReadConnectionStateChanged):
-            read_label['text'] = f'Чтение: {msg}'
+            scheduler.schedule(read_label, set_label_text(read_label, f'Чтение: {msg}'))
 
         if isinstance(msg, chat_client.SendingConnectionStateChanged):
-            write_label['text'] = f'Отправка: {msg}'
+            scheduler.schedule(write_label, set_label_text(write_label, f'Отправка: {msg}'))
 
         if isinstance(msg, chat_client.NicknameReceived):
-            nickname_label['text'] = f'Имя пользователя: {msg.nickname}'
+            text = f'Имя пользователя: {msg.nickname}'
+            scheduler.schedule(nickname_label, set_label_text(nickname_label, text))
+            if formatter and msg.nickname != chat_client.UNKNOWN_NICKNAME:
+                formatter.set_nickname(msg.nickname)
+
+        if isinstance(msg, HealthEvent) and not msg.alive:
+            # the channel is about to be reconnected, its state message comes next
+            label, title = (read_label, 'Чтение') if msg.channel is Channel.READ else (write_label, 'Отправка')
+            text = f'{title}: сервер молчит {msg.idle_seconds:.1f}с'
+            scheduler.schedule(label, set_label_text(label, text))
+
+        if isinstance(msg, ReconnectStatus) and msg.name in reconnect_labels:
+            label = reconnect_labels[msg.name]
+            text = f'Связь {RECONNECT_CHANNEL_NAMES[msg.name]}: {msg}'
+            scheduler.schedule(label, set_label_text(label, text))
 
 
 def create_status_panel(root_frame):
@@ -81,20 +144,17 @@ def create_status_panel(root_frame):
     connections_frame = tk.Frame(status_frame)
     connections_frame.pack(side="left")
 
-    nickname_label = tk.Label(connections_frame, height=1, fg='grey', font='arial 10', anchor='w')
-    nickname_label.pack(side="top", fill=tk.X)
-
-    status_read_label = tk.Label(connections_frame, height=1, fg='grey', font='arial 10', anchor='w')
-    status_read_label.pack(side="top", fill=tk.X)
+    # nickname, reading, sending and reconnect state of both channels
+    labels = []
+    for _ in range(STATUS_LABELS):
+        label = tk.Label(connections_frame, height=1, fg='grey', font='arial 10', anchor='w')
+        label.pack(side="top", fill=tk.X)
+        labels.append(label)
+    return labels
 
-    status_write_label = tk.Label(connections_frame, height=1, fg='grey', font='arial 10', anchor='w')
-    status_write_label.pack(side="top", fill=tk.X)
 
-    return nickname_label, status_read_label, status_write_label
-
-
-async def draw(messages_queue, sending_queue, status_updates_queue, token_error_event: Event,
-               task_status=TASK_STATUS_IGNORED):
+async def draw(messages_queue, sending_queue, status_updates_queue, token_error_event: Event, history=None,
+               tk_mode=TkLoopMode.EVENTS, search_index=None, history_limit=0, task_status=TASK_STATUS_IGNORED):
     task_status.started()
     root = tk.Tk()
 
@@ -105,6 +165,20 @@ async def draw(messages_queue, sending_queue, status_updates_queue, token_error_
 
     status_labels = create_status_panel(root_frame)
 
+    search_queue = asyncio.Queue()
+    if search_index:
+        search_frame = tk.Frame(root_frame)
+        search_frame.pack(side="top", fill=tk.X)
+
+        search_field = tk.Entry(search_frame)
+        search_field.pack(side="left", fill=tk.X, expand=True)
+        search_field.bind("<Return>", lambda event: process_search_query(search_field, search_queue))
+
+        search_button = tk.Button(search_frame)
+        search_button["text"] = "Найти"
+        search_button["command"] = lambda: process_search_query(search_field, search_queue)
+        search_button.pack(side="left")
+
     input_frame = tk.Frame(root_frame)
     input_frame.pack(side="bottom", fill=tk.X)
 
@@ -120,9 +194,21 @@ async def draw(messages_queue, sending_queue, status_updates_queue, token_error_
 
     conversation_panel = ScrolledText(root_frame, wrap='none')
     conversation_panel.pack(side="top", fill="both", expand=True)
+    configure_tags(conversation_panel)
+    formatter = LineFormatter()
+    conversation_view = ConversationView(conversation_panel, formatter)
+    # a couple of formatted batches are enough to keep the panel busy
+    rendered_queue = asyncio.Queue(maxsize=2)
+    scheduler = FrameScheduler(FRAME_INTERVAL)
 
     async with create_task_group() as tg:
-        await tg.start(update_tk, root_frame)
-        await tg.start(update_conversation_history, conversation_panel, messages_queue)
-        await tg.start(update_status_panel, status_labels, status_updates_queue)
+        await tg.start(run_tk, root_frame, tk_mode)
+        await tg.start(scheduler.run)
+        await tg.start(format_messages, formatter, messages_queue, rendered_queue, BATCH_SIZE)
+        await tg.start(update_conversation_history, conversation_view, rendered_queue, scheduler)
+        if history:
+            await tg.start(load_older_messages, conversation_view, history, history_limit)
+        if search_index:
+            await tg.start(show_search_results, root_frame, search_queue, history, search_index)
+        await tg.start(update_status_panel, status_labels, status_updates_queue, scheduler, formatter)
         await tg.start(show_token_error_message, token_error_event)
@@ -0,0 +1,348 @@
+import gzip
+import logging
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# timestamp, offset in the whole history, length of the line with line feed, flags
+INDEX_RECORD = struct.Struct('<dQII')
+
+SEGMENT_SUFFIX = '.log'
+COMPRESSED_SUFFIX = '.log.gz'
+INDEX_SUFFIX = '.idx'
+WRITER_LOCK = 'writer.lock'
+
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# the record is not a chat message but a note that messages may be missing before it
+FLAG_GAP = 1
+# the lowest byte of flags is for flags, the rest keeps id of the connection the message came from
+CONN_ID_SHIFT = 8
+FLAGS_LIMIT = 1 << 32
+
+LEGACY_LINE = re.compile(r'^\[(\d\d\.\d\d\.\d\d \d\d:\d\d(?::\d\d)?)\]')
+
+HistoryRecord = namedtuple('HistoryRecord', 'offset timestamp text flags')
+
+
+class HistoryLocked(Exception):
+    pass
+
+
+def lock_writer(path):
+    # the open lock file or None when another process holds it, closing the file releases the lock
+    lock_file = open(path, 'a')
+    if not fcntl:
+        return lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+class Segment:
+    def __init__(self, directory, base_offset, compressed=False):
+        self.base_offset = base_offset
+        self.compressed = compressed
+        name = f'{base_offset:020d}'
+        self.log_path = os.path.join(directory, name + (COMPRESSED_SUFFIX if compressed else SEGMENT_SUFFIX))
+        self.index_path = os.path.join(directory, name + INDEX_SUFFIX)
+
+    def __len__(self):
+        try:
+            return os.path.getsize(self.index_path) // INDEX_RECORD.size
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def size(self):
+        return sum(os.path.getsize(path) for path in (self.log_path, self.index_path) if os.path.exists(path))
+
+    def read_index(self, start, stop):
+        if stop <= start:
+            return []
+        with open(self.index_path, 'rb') as f:
+            f.seek(start * INDEX_RECORD.size)
+            data = f.read((stop - start) * INDEX_RECORD.size)
+        return list(INDEX_RECORD.iter_unpack(data))
+
+    def index_entry(self, position):
+        return self.read_index(position, position + 1)[0]
+
+    def bisect(self, key, value):
+        # first position whose timestamp (key=0) or offset (key=1) is not less than value
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.index_entry(middle)[key] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def open_log(self):
+        if self.compressed:
+            return gzip.open(self.log_path, 'rb')
+        return open(self.log_path, 'rb')
+
+    def read_records(self, entries):
+        if not entries:
+            return []
+        records = []
+        with self.open_log() as f:
+            f.seek(entries[0][1] - self.base_offset)
+            for timestamp, offset, length, flags in entries:
+                if f.tell() != offset - self.base_offset:
+                    f.seek(offset - self.base_offset)
+                # histories written before line_bytes was decoded may hold invalid UTF-8
+                line = f.read(length).decode(errors='replace')
+                records.append(HistoryRecord(offset, timestamp, line.rstrip('\n'), flags))
+        return records
+
+    def compress(self):
+        compressed_path = self.log_path + '.gz'
+        tmp_path = compressed_path + '.tmp'
+        with open(self.log_path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, compressed_path)
+        os.remove(self.log_path)
+        self.log_path = compressed_path
+        self.compressed = True
+
+
+class HistoryStore:
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, compress_sealed=False, readonly=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compress_sealed = compress_sealed
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._log = None
+        self._index = None
+        self._writer_lock = None
+        # readonly store may be opened by other processes while chat or listener writes the history
+        if not readonly:
+            self._lock_writer()
+        self.segments = self._load_segments()
+        if not readonly:
+            self._open_active_segment()
+
+    def _lock_writer(self):
+        # offsets come from the end of the active segment, a second writer would corrupt the index
+        self._writer_lock = lock_writer(os.path.join(self.directory, WRITER_LOCK))
+        if self._writer_lock is None:
+            raise HistoryLocked(f'history in {self.directory} is written by another process')
+
+    def _load_segments(self):
+        segments = {}
+        for name in os.listdir(self.directory):
+            if name.endswith(COMPRESSED_SUFFIX):
+                base_offset, compressed = name[:-len(COMPRESSED_SUFFIX)], True
+            elif name.endswith(SEGMENT_SUFFIX):
+                base_offset, compressed = name[:-len(SEGMENT_SUFFIX)], False
+            else:
+                continue
+            if base_offset.isdigit():
+                segments[int(base_offset)] = Segment(self.directory, int(base_offset), compressed)
+        return [segments[base_offset] for base_offset in sorted(segments)]
+
+    def _open_active_segment(self):
+        if not self.segments or self.segments[-1].compressed:
+            self.segments.append(Segment(self.directory, self.end_offset))
+        active = self.segments[-1]
+        self._repair(active)
+        self._log = open(active.log_path, 'ab')
+        self._index = open(active.index_path, 'ab')
+
+    @staticmethod
+    def _repair(segment):
+        # drop what was written after the last complete index record, e.g. after a crash
+        open(segment.log_path, 'ab').close()
+        open(segment.index_path, 'ab').close()
+        records_count = len(segment)
+        with open(segment.index_path, 'r+b') as f:
+            f.truncate(records_count * INDEX_RECORD.size)
+        log_size = 0
+        if records_count:
+            _, offset, length, _ = segment.index_entry(records_count - 1)
+            log_size = offset - segment.base_offset + length
+        if os.path.getsize(segment.log_path) != log_size:
+            logger.warning('truncate broken history segment %s', segment.log_path)
+            with open(segment.log_path, 'r+b') as f:
+                f.truncate(log_size)
+
+    @property
+    def end_offset(self):
+        if not self.segments:
+            return 0
+        segment = self.segments[-1]
+        if self._log is not None and not self._log.closed:
+            return segment.base_offset + self._log.tell()
+        records_count = len(segment)
+        if not records_count:
+            return segment.base_offset
+        _, offset, length, _ = segment.index_entry(records_count - 1)
+        return offset + length
+
+    def append(self, text, timestamp=None, flags=0):
+        data = text + b'\n' if isinstance(text, bytes) else f'{text}\n'.encode()
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            if self._log.tell() and self._log.tell() + len(data) > self.segment_size:
+                self.rotate()
+            offset = self.segments[-1].base_offset + self._log.tell()
+            self._log.write(data)
+            self._index.write(INDEX_RECORD.pack(timestamp, offset, len(data), flags))
+        return offset
+
+    def flush(self):
+        if self._log is None:
+            return
+        # the lock keeps a half-written record out of the files readers see
+        with self._lock:
+            self._log.flush()
+            self._index.flush()
+
+    def fsync(self):
+        self.flush()
+        os.fsync(self._log.fileno())
+        os.fsync(self._index.fileno())
+
+    def rotate(self):
+        end_offset = self.end_offset
+        self._log.close()
+        self._index.close()
+        sealed = self.segments[-1]
+        logger.debug('seal history segment %s', sealed.log_path)
+        if self.compress_sealed:
+            sealed.compress()
+        self.segments.append(Segment(self.directory, end_offset))
+        self._log = open(self.segments[-1].log_path, 'ab')
+        self._index = open(self.segments[-1].index_path, 'ab')
+
+    def remove_segment(self, segment):
+        # a new list, so generators walking the old one are not disturbed
+        with self._lock:
+            self.segments = [known for known in self.segments if known is not segment]
+        for path in (segment.log_path, segment.index_path):
+            os.remove(path)
+        logger.debug('removed history segment %s', segment.log_path)
+
+    def replace_segment(self, segment, log_path, index_path):
+        # only sealed segments are replaced, the active one keeps being appended to
+        old_log_path = segment.log_path
+        new_log_path = os.path.join(self.directory, f'{segment.base_offset:020d}{COMPRESSED_SUFFIX}')
+        with self._lock:
+            os.replace(log_path, new_log_path)
+            os.replace(index_path, segment.index_path)
+            segment.log_path, segment.compressed = new_log_path, True
+        if old_log_path != new_log_path:
+            os.remove(old_log_path)
+
+    def close(self):
+        if self._log is not None and not self._log.closed:
+            self.flush()
+            self._log.close()
+            self._index.close()
+        if self._writer_lock is not None:
+            # closing the file releases the lock
+            self._writer_lock.close()
+
+    def last(self, count, before=None):
+        self.flush()
+        records = []
+        for segment in reversed(self.segments):
+            if count <= len(records):
+                break
+            if before is not None and segment.base_offset >= before:
+                continue
+            stop = len(segment) if before is None else segment.bisect(1, before)
+            start = max(stop - (count - len(records)), 0)
+            records[:0] = segment.read_records(segment.read_index(start, stop))
+        return records
+
+    def between(self, start_time, end_time):
+        self.flush()
+        for segment in self.segments:
+            records_count = len(segment)
+            if not records_count:
+                continue
+            if segment.index_entry(records_count - 1)[0] < start_time:
+                continue
+            if segment.index_entry(0)[0] > end_time:
+                break
+            start = segment.bisect(0, start_time)
+            stop = segment.bisect(0, end_time + 1e-6)
+            yield from segment.read_records(segment.read_index(start, stop))
+
+    def tail(self, offset=0, batch_size=1000):
+        self.flush()
+        for segment in self.segments:
+            if segment is not self.segments[-1] and self._next_base(segment) <= offset:
+                continue
+            position = segment.bisect(1, offset)
+            while entries := segment.read_index(position, position + batch_size):
+                yield from segment.read_records(entries)
+                position += len(entries)
+
+    def _next_base(self, segment):
+        return self.segments[self.segments.index(segment) + 1].base_offset
+
+    def read_at(self, offset):
+        for segment in reversed(self.segments):
+            if segment.base_offset <= offset:
+                break
+        else:
+            return None
+        self.flush()
+        position = segment.bisect(1, offset)
+        entries = segment.read_index(position, position + 1)
+        if not entries or entries[0][1] != offset:
+            return None
+        return segment.read_records(entries)[0]
+
+    def import_file(self, filepath):
+        fallback_timestamp = os.path.getmtime(filepath)
+        imported = 0
+        with open(filepath, 'r') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                self.append(line, parse_legacy_timestamp(line) or fallback_timestamp)
+                imported += 1
+        self.flush()
+        logger.debug('imported %s messages from %s', imported, filepath)
+        return imported
+
+
+def pack_flags(flags=0, conn_id=0):
+    return (conn_id << CONN_ID_SHIFT) % FLAGS_LIMIT | flags
+
+
+def conn_id_of(flags):
+    return flags >> CONN_ID_SHIFT
+
+
+def parse_legacy_timestamp(line):
+    match = LEGACY_LINE.match(line)
+    if not match:
+        return None
+    stamp = match.group(1)
+    fmt = '%d.%m.%y %H:%M:%S' if stamp.count(':') == 2 else '%d.%m.%y %H:%M'
+    return datetime.strptime(stamp, fmt).timestamp()
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import time
+from enum import Enum
+
+from anyio import TASK_STATUS_IGNORED
+
+logger = logging.getLogger('watchdog')
+
+TIMEOUT_IN_SECONDS = 5
+
+
+class Channel(Enum):
+    READ = 'read'
+    SEND = 'send'
+    PING = 'ping'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class HealthEvent:
+    __slots__ = ('channel', 'alive', 'idle_seconds')
+
+    def __init__(self, channel, alive, idle_seconds):
+        self.channel = channel
+        self.alive = alive
+        self.idle_seconds = idle_seconds
+
+    def __str__(self):
+        state = 'alive' if self.alive else 'timeout is elapsed'
+        return f'{self.channel}: {state}, idle for {self.idle_seconds:.1f}s'
+
+
+class ConnectionTimeout(ConnectionError):
+    def __init__(self, channel):
+        super().__init__(f'{TIMEOUT_IN_SECONDS}s timeout is elapsed from {channel}')
+        self.channel = channel
+
+
+class LivenessTracker:
+    def __init__(self, channels=(Channel.READ, Channel.PING), timeout=TIMEOUT_IN_SECONDS, events_queue=None):
+        self.timeout = timeout
+        self.events_queue = events_queue
+        now = time.monotonic()
+        # channels without a deadline, e.g. sending while there is nothing to send, are not in the dict
+        self.last_seen = {channel: now for channel in channels}
+
+    def touch(self, channel):
+        self.last_seen[channel] = time.monotonic()
+
+    def disarm(self, channel):
+        self.last_seen.pop(channel, None)
+
+    def snapshot(self):
+        now = time.monotonic()
+        return [HealthEvent(channel, now - seen < self.timeout, now - seen) for channel, seen in self.last_seen.items()]
+
+    def _publish(self, event):
+        if self.events_queue is not None:
+            self.events_queue.put_nowait(event)
+
+    async def watch(self, task_status=TASK_STATUS_IGNORED):
+        task_status.started()
+        while True:
+            if not self.last_seen:
+                await asyncio.sleep(self.timeout)
+                continue
+
+            channel, seen = min(self.last_seen.items(), key=lambda item: item[1])
+            idle_seconds = time.monotonic() - seen
+            if idle_seconds < self.timeout:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('; '.join(str(event) for event in self.snapshot()))
+                await asyncio.sleep(self.timeout - idle_seconds)
+                continue
+
+            event = HealthEvent(channel, False, idle_seconds)
+            logger.debug(event)
+            self._publish(event)
+            raise ConnectionTimeout(channel)
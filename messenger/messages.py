@@ -1,18 +1,27 @@
 import logging
 
+from messenger import metrics
+from messenger.framing import read_frame
+
 logger = logging.getLogger(__name__)
 
+# the server answers every non-empty message with this line, in the order it has read the messages
+MESSAGE_SENT = b'Message send'
+
 
 async def send_message(writer, text):
-    writer.write(text.encode())
-    logger.debug(f'send: {text.rstrip(LINE_FEED)}')
+    data = text.encode()
+    writer.write(data)
+    if metrics.enabled:
+        metrics.BYTES_SENT.inc(len(data))
+        metrics.MESSAGES_SENT.inc()
+    logger.debug('send: %s', text.rstrip(LINE_FEED))
     await writer.drain()
 
 
 async def read_message(reader):
-    received_data = await reader.readline()
-    message = received_data.decode()
-    logger.debug(f'receive: {message.rstrip(LINE_FEED)}')
+    message = (await read_frame(reader)).raw.decode(errors='replace')
+    logger.debug('receive: %s', message.rstrip(LINE_FEED))
     return message
 
 
@@ -21,4 +30,23 @@ async def submit_message(writer, message):
     await send_message(writer, text)
 
 
+async def submit_messages(writer, messages):
+    # one write and one drain for all messages that are ready
+    data = ''.join(f'{message}{LINE_FEED}{LINE_FEED}' for message in messages).encode()
+    writer.write(data)
+    if metrics.enabled:
+        metrics.BYTES_SENT.inc(len(data))
+        metrics.MESSAGES_SENT.inc(len(messages))
+    logger.debug('send %s messages', len(messages))
+    await writer.drain()
+
+
+async def read_confirmations(reader, on_confirmed):
+    # a message is delivered only when its confirmation is read, written bytes may still die in a socket buffer
+    while line := await reader.readline():
+        if line.startswith(MESSAGE_SENT):
+            on_confirmed()
+    raise ConnectionError('server closed connection')
+
+
 LINE_FEED = '\n'
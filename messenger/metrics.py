@@ -0,0 +1,250 @@
+import asyncio
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import nullcontext
+
+from anyio import TASK_STATUS_IGNORED
+
+logger = logging.getLogger(__name__)
+
+# the hot path checks this flag before touching any metric, so disabled metrics cost one attribute lookup
+enabled = False
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+JSON_CONTENT_TYPE = 'application/json'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{value}"' for key, value in labels)
+    return f'{{{pairs}}}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.value = 0
+        # history writers and indexers count from worker threads
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+    def as_dict(self):
+        return self.value
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.callback = callback
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, self.labels, self.callback() if self.callback else self.value
+
+    def as_dict(self):
+        return self.callback() if self.callback else self.value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.sum += value
+            self.count += 1
+
+    def _snapshot(self):
+        # buckets, sum and count of one moment, a scrape must not see an observation half applied
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def samples(self):
+        counts, total, count = self._snapshot()
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            yield f'{self.name}_bucket', self.labels + (('le', bound),), cumulative
+        yield f'{self.name}_sum', self.labels, total
+        yield f'{self.name}_count', self.labels, count
+
+    def as_dict(self):
+        counts, total, count = self._snapshot()
+        return {
+            'count': count,
+            'sum': round(total, 6),
+            'buckets': dict(zip((str(bound) for bound in self.buckets + ('+Inf',)), counts)),
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, labels, **options):
+        labels = tuple(sorted(labels.items())) if labels else ()
+        key = (name, labels)
+        with self._lock:
+            if key not in self.metrics:
+                self.metrics[key] = cls(name, help_text, labels, **options)
+            return self.metrics[key]
+
+    def _items(self):
+        with self._lock:
+            return list(self.metrics.items())
+
+    def counter(self, name, help_text, labels=None):
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, labels=None, callback=None):
+        return self._get(Gauge, name, help_text, labels, callback=callback)
+
+    def histogram(self, name, help_text, labels=None, buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def to_prometheus(self):
+        lines = []
+        described = set()
+        for metric in sorted((metric for _, metric in self._items()), key=lambda metric: metric.name):
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f'# HELP {metric.name} {metric.help_text}')
+                lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        dump = {}
+        for (name, labels), metric in sorted(self._items(), key=lambda item: item[0]):
+            dump[f'{name}{format_labels(labels)}'] = metric.as_dict()
+        return json.dumps(dump, indent=2)
+
+
+registry = Registry()
+
+BYTES_RECEIVED = registry.counter('messenger_received_bytes_total', 'Bytes read from the chat server')
+MESSAGES_RECEIVED = registry.counter('messenger_received_messages_total', 'Lines read from the chat server')
+BYTES_SENT = registry.counter('messenger_sent_bytes_total', 'Bytes written to the chat server')
+MESSAGES_SENT = registry.counter('messenger_sent_messages_total', 'Writes to the chat server')
+MESSAGES_SAVED = registry.counter('messenger_saved_messages_total', 'Messages written to history')
+HISTORY_WRITE_SECONDS = registry.histogram('messenger_history_write_seconds', 'Time to write a batch to history')
+SEND_LATENCY_SECONDS = registry.histogram('messenger_send_latency_seconds',
+                                          'Time from putting a message to the outbox to its confirmation by the server')
+GUI_FRAME_SECONDS = registry.histogram('messenger_gui_frame_seconds', 'Time to apply widget updates of a frame')
+GUI_UPDATES_DROPPED = registry.counter('messenger_gui_updates_dropped_total',
+                                       'Widget updates replaced by newer ones before they were shown')
+AUTH_SECONDS = registry.histogram('messenger_auth_seconds', 'Time from sending a token to the welcome line')
+
+
+def reconnects(channel):
+    return registry.counter('messenger_reconnects_total', 'Reconnects after connection errors', {'channel': channel})
+
+
+class Span:
+    __slots__ = ('histogram', 'started_at')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.started_at)
+
+
+NO_SPAN = nullcontext()
+
+
+def timed(histogram):
+    return Span(histogram) if enabled else NO_SPAN
+
+
+def span(stage):
+    if not enabled:
+        return NO_SPAN
+    return Span(registry.histogram('messenger_stage_seconds', 'Time spent in a processing stage', {'stage': stage}))
+
+
+def watch_queues(queues):
+    for queue in queues:
+        labels = {'queue': queue.name}
+        registry.gauge('messenger_queue_depth', 'Items waiting in a queue', labels, queue.qsize)
+        registry.gauge('messenger_queue_high_water_mark', 'Largest queue depth seen', labels,
+                       lambda queue=queue: queue.high_water_mark)
+        registry.gauge('messenger_queue_dropped', 'Items dropped from a full queue', labels,
+                       lambda queue=queue: queue.dropped)
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+async def answer_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode(errors='replace').split()
+        path = parts[1] if len(parts) > 1 else '/'
+        if path.endswith('.json'):
+            body, content_type, status = registry.to_json().encode(), JSON_CONTENT_TYPE, '200 OK'
+        elif path == '/metrics':
+            body, content_type, status = registry.to_prometheus().encode(), PROMETHEUS_CONTENT_TYPE, '200 OK'
+        else:
+            body, content_type, status = b'not found\n', 'text/plain', '404 Not Found'
+        writer.write(
+            f'HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n'.encode()
+            + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host, port, task_status=TASK_STATUS_IGNORED):
+    enable()
+    server = await asyncio.start_server(answer_metrics_request, host, port)
+    logger.debug('metrics are served on http://%s:%s/metrics and /metrics.json', host, port)
+    task_status.started()
+    async with server:
+        await server.serve_forever()
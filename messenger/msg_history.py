@@ -1,21 +1,27 @@
 import logging
 
-import aiofiles
-from anyio import TASK_STATUS_IGNORED
+from anyio import TASK_STATUS_IGNORED, to_thread
 
+from messenger import metrics
+from messenger.batch_writer import BatchWriter, FsyncPolicy
 
-async def save_messages(filepath, queue, task_status=TASK_STATUS_IGNORED):
-    task_status.started()
-    async with aiofiles.open(filepath, mode='a') as f:
-        while True:
-            message = await queue.get()
-            await f.write(f'{message}\n')
+HISTORY_LIMIT = 500
+SCREEN_LINES = 50
+
+
+async def save_messages(store, queue, fsync_policy=FsyncPolicy.NEVER, search_index=None, exporter=None,
+                        task_status=TASK_STATUS_IGNORED):
+    writer = BatchWriter(store, fsync_policy=fsync_policy, search_index=search_index, exporter=exporter)
+    await writer.run(queue, task_status=task_status)
 
 
-async def read_history(filepath, queue, task_status=TASK_STATUS_IGNORED):
+async def read_history(store, queue, limit=HISTORY_LIMIT, task_status=TASK_STATUS_IGNORED):
     logging.debug('read msgs from history')
-    async with aiofiles.open(filepath, mode='r') as f:
-        while msg := await f.readline():
-            queue.put_nowait(msg.strip())
+    if queue.maxsize:
+        limit = min(limit, queue.maxsize)
+    with metrics.span('read_history'):
+        records = await to_thread.run_sync(store.last, limit)
+    for record in records:
+        queue.put_nowait(record)
     logging.debug('read msgs from history finish')
     task_status.started()
@@ -0,0 +1,200 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import struct
+import time
+from collections import deque
+
+from anyio import TASK_STATUS_IGNORED, to_thread
+
+from messenger import metrics
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_FILENAME = 'outbox.journal'
+ACK_FILENAME = 'outbox.ack'
+# offset in the journal up to which messages are confirmed by the server
+ACK_RECORD = struct.Struct('<Q')
+MAX_BATCH_SIZE = 64 * 1024
+COMPACT_SIZE = 1024 * 1024
+LATENCY_SAMPLES = 100
+
+
+class OutgoingMessage:
+    __slots__ = ('text', 'end_offset', 'enqueued_at')
+
+    def __init__(self, text, end_offset, enqueued_at=None):
+        self.text = text
+        self.end_offset = end_offset
+        self.enqueued_at = time.monotonic() if enqueued_at is None else enqueued_at
+
+
+class Outbox:
+    def __init__(self, directory, maxsize=0, fsync=False, name='sending'):
+        self.name = name
+        self.maxsize = maxsize
+        self.fsync = fsync
+        self.journal_path = os.path.join(directory, OUTBOX_FILENAME)
+        self.ack_path = os.path.join(directory, ACK_FILENAME)
+        os.makedirs(directory, exist_ok=True)
+
+        # typed messages wait in unwritten until the journal task has them on disk, only then they are sent
+        self.unwritten = []
+        self.writing = []
+        self.pending = deque()
+        # the first in_flight pending messages are written to the connection and wait for confirmations
+        self.in_flight = 0
+        self.has_unsent = asyncio.Event()
+        self.needs_sync = asyncio.Event()
+        self.acked_offset = None
+        self.high_water_mark = 0
+        self.dropped = 0
+        self.sent = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+        self._load()
+        self._journal = open(self.journal_path, 'ab')
+        self._ack = open(self.ack_path, 'r+b' if os.path.exists(self.ack_path) else 'w+b')
+
+    def _load(self):
+        acked = 0
+        if os.path.exists(self.ack_path):
+            with open(self.ack_path, 'rb') as f:
+                data = f.read(ACK_RECORD.size)
+            if len(data) == ACK_RECORD.size:
+                (acked,) = ACK_RECORD.unpack(data)
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as f:
+            # the journal may have been compacted after the ack offset was written
+            if acked > os.path.getsize(self.journal_path):
+                acked = 0
+            f.seek(acked)
+            offset = acked
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                self.pending.append(OutgoingMessage(json.loads(line), offset))
+        if offset != os.path.getsize(self.journal_path):
+            logger.warning('truncate broken outbox journal %s', self.journal_path)
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(offset)
+        if self.pending:
+            logger.debug('%s unsent messages loaded from %s', len(self.pending), self.journal_path)
+            self.has_unsent.set()
+
+    def qsize(self):
+        return len(self.unwritten) + len(self.writing) + len(self.pending)
+
+    def full(self):
+        return 0 < self.maxsize <= self.qsize()
+
+    def empty(self):
+        return not self.qsize()
+
+    def put_nowait(self, text):
+        # called from Tk callbacks, so the disk is left to the journal task
+        if not text:
+            return
+        if self.full():
+            raise asyncio.QueueFull
+        self.unwritten.append(OutgoingMessage(text, None))
+        self.high_water_mark = max(self.high_water_mark, self.qsize())
+        self.needs_sync.set()
+
+    async def run(self, task_status=TASK_STATUS_IGNORED):
+        # the only place that touches the files while the loop runs
+        task_status.started()
+        while True:
+            await self.needs_sync.wait()
+            self.needs_sync.clear()
+            self.writing, self.unwritten = self.unwritten, []
+            acked, self.acked_offset = self.acked_offset, None
+            await to_thread.run_sync(self._sync, self.writing, acked)
+            if self.writing:
+                self.pending.extend(self.writing)
+                self.writing = []
+                self.has_unsent.set()
+
+    def _sync(self, batch, acked):
+        if acked is not None:
+            self._ack.seek(0)
+            self._ack.write(ACK_RECORD.pack(acked))
+            self._ack.flush()
+            if self.fsync:
+                os.fsync(self._ack.fileno())
+            # nothing unsent is left in the journal when everything up to its end is acknowledged
+            if acked == self._journal.tell() >= COMPACT_SIZE:
+                self._compact()
+        if not batch:
+            return
+        for message in batch:
+            self._journal.write(json.dumps(message.text, ensure_ascii=False).encode() + b'\n')
+            message.end_offset = self._journal.tell()
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    async def take_batch(self, max_batch_size=MAX_BATCH_SIZE):
+        # messages stay in the outbox until the server confirms them, so a broken connection sends them again
+        await self.has_unsent.wait()
+        batch = []
+        batch_size = 0
+        for message in itertools.islice(self.pending, self.in_flight, None):
+            if batch and batch_size + len(message.text) > max_batch_size:
+                break
+            batch.append(message)
+            batch_size += len(message.text)
+        self.in_flight += len(batch)
+        if self.in_flight == len(self.pending):
+            self.has_unsent.clear()
+        return batch
+
+    def reconnected(self):
+        # confirmations of the old connection never come, its messages are sent again and may arrive twice
+        self.in_flight = 0
+        if self.pending:
+            self.has_unsent.set()
+
+    def confirm(self):
+        # the server confirms messages one by one in the order they were written
+        if not self.in_flight:
+            return
+        message = self.pending.popleft()
+        self.in_flight -= 1
+        latency = time.monotonic() - message.enqueued_at
+        self.latencies.append(latency)
+        if metrics.enabled:
+            metrics.SEND_LATENCY_SECONDS.observe(latency)
+        self.sent += 1
+        self.acked_offset = message.end_offset
+        self.needs_sync.set()
+
+    def _compact(self):
+        self._journal.truncate(0)
+        self._journal.seek(0)
+        self._ack.seek(0)
+        self._ack.write(ACK_RECORD.pack(0))
+        self._ack.flush()
+
+    def stats(self):
+        latencies = sorted(self.latencies) or [None]
+        return {
+            'name': self.name,
+            'depth': self.qsize(),
+            'maxsize': self.maxsize,
+            'high_water_mark': self.high_water_mark,
+            'sent': self.sent,
+            'latency_median_seconds': latencies[len(latencies) // 2],
+            'latency_max_seconds': latencies[-1],
+        }
+
+    def close(self):
+        # messages typed right before closing are kept for the next start
+        batch, self.unwritten = self.unwritten, []
+        self._sync(batch, self.acked_offset)
+        self._journal.close()
+        self._ack.close()
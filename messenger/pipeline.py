@@ -0,0 +1,280 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+import threading
+import time
+from contextlib import suppress
+
+from anyio import create_task_group, ExceptionGroup, TASK_STATUS_IGNORED
+
+from messenger import metrics
+from messenger.archiver import READ_TIMEOUT
+from messenger.batch_writer import BatchWriter, FsyncPolicy
+from messenger.connection import ReconnectManager
+from messenger.export import ExportFormat, open_writer
+from messenger.framing import Message
+from messenger.history_store import HistoryStore, DEFAULT_SEGMENT_SIZE
+from messenger.liveness import Channel, LivenessTracker
+from messenger.metrics import serve_metrics, watch_queues
+from messenger.queues import MonitoredQueue
+from messenger.resume import GapMarker, ResumeTracker, read_resumed
+from messenger.retention import apply_retention, needs_reindex, RetentionPolicy, RETENTION_INTERVAL
+from messenger.search_index import SearchIndex, INDEX_FILENAME
+
+logger = logging.getLogger(__name__)
+
+# received_at, conn_id, length of the raw line
+FRAME_HEADER = struct.Struct('<dII')
+# a gap in the stream goes through the pipe with this conn_id and the time since when messages may be lost
+GAP_FRAME = 0xFFFFFFFF
+GAP_RECORD = struct.Struct('<d')
+STOP = b''
+# the writer process asks the indexer to index the history again after retention has changed it
+REBUILD = 'rebuild'
+SAVING_QUEUE_SIZE = 10000
+STATS_INTERVAL = 10
+WORKER_JOIN_TIMEOUT = 30
+
+# handled messages, their size in bytes, seconds from receiving the last of them to handling it
+STAGE_FIELDS = ('messages', 'bytes', 'lag_seconds')
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        # shared memory, so the main process sees what workers count without asking them
+        self.values = multiprocessing.Array('d', len(STAGE_FIELDS))
+
+    def add(self, messages, size, lag):
+        with self.values.get_lock():
+            self.values[0] += messages
+            self.values[1] += size
+            self.values[2] = lag
+
+    def snapshot(self):
+        with self.values.get_lock():
+            return dict(zip(STAGE_FIELDS, self.values))
+
+
+def pack_batch(messages):
+    parts = []
+    for message in messages:
+        if isinstance(message, GapMarker):
+            parts.append(FRAME_HEADER.pack(message.received_at, GAP_FRAME, GAP_RECORD.size))
+            parts.append(GAP_RECORD.pack(message.lost_since or 0))
+            continue
+        parts.append(FRAME_HEADER.pack(message.received_at, message.conn_id, len(message.raw)))
+        parts.append(message.raw)
+    return b''.join(parts)
+
+
+def unpack_batch(data):
+    messages = []
+    position = 0
+    while position < len(data):
+        received_at, conn_id, size = FRAME_HEADER.unpack_from(data, position)
+        position += FRAME_HEADER.size
+        if conn_id == GAP_FRAME:
+            (lost_since,) = GAP_RECORD.unpack_from(data, position)
+            messages.append(GapMarker(lost_since or None, received_at))
+        else:
+            messages.append(Message(data[position:position + size], received_at, conn_id))
+        position += size
+    return messages
+
+
+class PipeWriter(BatchWriter):
+    # collects batches like BatchWriter, but hands them to the writer process instead of the disk
+    def __init__(self, connection, stats, **options):
+        super().__init__(None, **options)
+        self.connection = connection
+        self.stats = stats
+
+    def write_batch(self, messages):
+        data = pack_batch(messages)
+        self.connection.send_bytes(data)
+        self.stats.add(len(messages), len(data), time.monotonic() - messages[0].received_at)
+
+
+class IndexFeed:
+    # stands in for SearchIndex in the writer process and sends what is written to the indexer process
+    def __init__(self, connection):
+        self.connection = connection
+        self.entries = []
+        # the retention thread sends to the same pipe
+        self._lock = threading.Lock()
+
+    def add(self, offset, timestamp, line):
+        self.entries.append((offset, timestamp, line))
+
+    def flush(self):
+        with self._lock:
+            if self.entries:
+                self.connection.send(self.entries)
+                self.entries = []
+
+    def rebuild(self):
+        with self._lock:
+            self.connection.send(REBUILD)
+
+
+def retain_history(store, policy, index_feed, stopped, interval=RETENTION_INTERVAL):
+    # runs next to the writer loop in the process that owns the history
+    while True:
+        report = apply_retention(store, policy)
+        if index_feed and needs_reindex(report):
+            index_feed.rebuild()
+        if stopped.wait(interval):
+            return
+
+
+def ignore_interrupts():
+    # Ctrl+C reaches the whole process group, workers stop when the main process tells them to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def write_worker(connection, index_connection, log_path, stats, segment_size=DEFAULT_SEGMENT_SIZE,
+                 compress_history=False, fsync_policy=FsyncPolicy.NEVER, export_path=None,
+                 export_format=ExportFormat.NDJSON, retention_policy=RetentionPolicy()):
+    ignore_interrupts()
+    store = HistoryStore(log_path, segment_size, compress_history)
+    exporter = open_writer(export_path, export_format, append=True) if export_path else None
+    index_feed = IndexFeed(index_connection) if index_connection else None
+    writer = BatchWriter(store, fsync_policy=fsync_policy, search_index=index_feed, exporter=exporter)
+    stopped = threading.Event()
+    if any(retention_policy):
+        threading.Thread(target=retain_history, args=(store, retention_policy, index_feed, stopped),
+                         name='retention', daemon=True).start()
+    try:
+        while data := connection.recv_bytes():
+            messages = unpack_batch(data)
+            writer.write_batch(messages)
+            stats.add(len(messages), len(data), time.monotonic() - messages[-1].received_at)
+    finally:
+        stopped.set()
+        store.close()
+        if exporter:
+            exporter.close()
+        if index_connection:
+            index_connection.send(None)
+
+
+def index_worker(connection, log_path, stats):
+    ignore_interrupts()
+    search_index = SearchIndex(os.path.join(log_path, INDEX_FILENAME))
+    try:
+        while entries := connection.recv():
+            if entries == REBUILD:
+                # segments the writer process has removed or compacted are read again from disk
+                search_index.rebuild(HistoryStore(log_path, readonly=True))
+                continue
+            for offset, timestamp, line in entries:
+                search_index.add(offset, timestamp, line)
+            search_index.flush()
+            stats.add(len(entries), sum(len(line) for _, _, line in entries), time.time() - entries[-1][1])
+    finally:
+        search_index.close()
+
+
+def prepare_archive(log_path, segment_size, compress_history, with_search_index, resume):
+    # repair the history and index what was saved without the index before workers open the files
+    store = HistoryStore(log_path, segment_size, compress_history)
+    try:
+        if with_search_index:
+            search_index = SearchIndex(os.path.join(log_path, INDEX_FILENAME))
+            search_index.catch_up(store)
+            search_index.close()
+        # messages the server sends again after a restart are already in history
+        resume.seed(store.last(resume.window))
+    finally:
+        store.close()
+
+
+def watch_stages(stages):
+    for stage in stages:
+        labels = {'stage': stage.name}
+        metrics.registry.gauge('messenger_pipeline_messages_total', 'Messages handled by an archive stage', labels,
+                               lambda stage=stage: stage.snapshot()['messages'])
+        metrics.registry.gauge('messenger_pipeline_bytes_total', 'Bytes handled by an archive stage', labels,
+                               lambda stage=stage: stage.snapshot()['bytes'])
+        metrics.registry.gauge('messenger_pipeline_lag_seconds', 'Age of the last message an archive stage handled',
+                               labels, lambda stage=stage: stage.snapshot()['lag_seconds'])
+
+
+async def log_stage_stats(stages, interval=STATS_INTERVAL, task_status=TASK_STATUS_IGNORED):
+    task_status.started()
+    previous = {stage.name: stage.snapshot() for stage in stages}
+    while True:
+        await asyncio.sleep(interval)
+        for stage in stages:
+            current = stage.snapshot()
+            logger.debug('stage %s: %.1f messages/s, %.1f KiB/s, lag %.3fs', stage.name,
+                         (current['messages'] - previous[stage.name]['messages']) / interval,
+                         (current['bytes'] - previous[stage.name]['bytes']) / interval / 1024,
+                         current['lag_seconds'])
+            previous[stage.name] = current
+
+
+async def receive_messages(host, port, queue, reconnector, resume, read_timeout=READ_TIMEOUT):
+    # nothing but reading the socket happens here, formatting and disk writes are in the workers
+    liveness = LivenessTracker(channels=(Channel.READ,), timeout=read_timeout)
+    await read_resumed(host, port, liveness, resume, queue.put, reconnector.connected)
+
+
+async def run_pipeline(host, port, log_path, segment_size=DEFAULT_SEGMENT_SIZE, compress_history=False,
+                       fsync_policy=FsyncPolicy.NEVER, search_index=False, export_path=None,
+                       export_format=ExportFormat.NDJSON, saving_queue_size=SAVING_QUEUE_SIZE,
+                       metrics_host='127.0.0.1', metrics_port=None, retention_policy=RetentionPolicy(),
+                       read_timeout=READ_TIMEOUT):
+    resume = ResumeTracker()
+    prepare_archive(log_path, segment_size, compress_history, search_index, resume)
+
+    receive_stats, write_stats = StageStats('receive'), StageStats('write')
+    stages = [receive_stats, write_stats]
+    workers = []
+    index_receiver = index_sender = None
+    if search_index:
+        stages.append(StageStats('index'))
+        index_receiver, index_sender = multiprocessing.Pipe(duplex=False)
+        workers.append(multiprocessing.Process(target=index_worker, args=(index_receiver, log_path, stages[-1]),
+                                               name='archive-index'))
+    write_receiver, write_sender = multiprocessing.Pipe(duplex=False)
+    workers.insert(0, multiprocessing.Process(
+        target=write_worker,
+        args=(write_receiver, index_sender, log_path, write_stats, segment_size, compress_history, fsync_policy,
+              export_path, export_format, retention_policy),
+        name='archive-write',
+    ))
+    for worker in workers:
+        worker.start()
+    # only the workers use these ends, a dead worker must break the pipe instead of hanging it
+    for connection in (write_receiver, index_receiver, index_sender):
+        if connection:
+            connection.close()
+
+    saving_queue = MonitoredQueue('saving', saving_queue_size)
+    try:
+        async with create_task_group() as tg:
+            if metrics_port:
+                watch_queues([saving_queue])
+                watch_stages(stages)
+                await tg.start(serve_metrics, metrics_host, metrics_port)
+            await tg.start(log_stage_stats, stages)
+            await tg.start(PipeWriter(write_sender, receive_stats).run, saving_queue)
+            # reconnects like every multi-endpoint archiver, history continues after a resume check
+            reconnector = ReconnectManager('receive', exceptions=(ConnectionError, ExceptionGroup, OSError),
+                                           logger=logger)
+            await reconnector.run(receive_messages, host, port, saving_queue, reconnector, resume, read_timeout)
+            tg.cancel_scope.cancel()
+    finally:
+        with suppress(BrokenPipeError):
+            write_sender.send_bytes(STOP)
+        write_sender.close()
+        for worker in workers:
+            worker.join(WORKER_JOIN_TIMEOUT)
+            if worker.is_alive():
+                logger.warning('%s did not stop, terminate it', worker.name)
+                worker.terminate()
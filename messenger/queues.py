@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import time
+from enum import Enum
+
+from anyio import TASK_STATUS_IGNORED
+
+logger = logging.getLogger(__name__)
+
+STATS_INTERVAL = 30
+
+
+class QueuePolicy(Enum):
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class MonitoredQueue(asyncio.Queue):
+    def __init__(self, name, maxsize=0, policy=QueuePolicy.BLOCK):
+        super().__init__(maxsize)
+        self.name = name
+        self.policy = policy
+        self.high_water_mark = 0
+        self.dropped = 0
+        self.blocked_seconds = 0
+
+    def put_nowait(self, item):
+        if self.policy is QueuePolicy.DROP_OLDEST and self.full():
+            self.get_nowait()
+            self.dropped += 1
+        super().put_nowait(item)
+        self.high_water_mark = max(self.high_water_mark, self.qsize())
+
+    async def put(self, item):
+        if not self.full() or self.policy is QueuePolicy.DROP_OLDEST:
+            return self.put_nowait(item)
+        blocked_at = time.monotonic()
+        try:
+            return await super().put(item)
+        finally:
+            self.blocked_seconds += time.monotonic() - blocked_at
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'depth': self.qsize(),
+            'maxsize': self.maxsize,
+            'high_water_mark': self.high_water_mark,
+            'dropped': self.dropped,
+            'blocked_seconds': round(self.blocked_seconds, 3),
+        }
+
+
+async def log_queue_stats(queues, interval=STATS_INTERVAL, task_status=TASK_STATUS_IGNORED):
+    task_status.started()
+    while True:
+        await asyncio.sleep(interval)
+        for queue in queues:
+            logger.debug('queue stats: %s', queue.stats())
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from collections import deque
+from contextlib import suppress
+from enum import Enum
+
+from anyio import create_task_group, ExceptionGroup, TASK_STATUS_IGNORED
+
+from messenger.archiver import READ_TIMEOUT
+from messenger.connection import get_connection, reconnect
+from messenger.liveness import Channel, LivenessTracker
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_BUFFER_SIZE = 1000
+
+
+class SlowConsumerPolicy(Enum):
+    DROP = 'drop'
+    DISCONNECT = 'disconnect'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class Subscriber:
+    def __init__(self, writer, buffer_size=SUBSCRIBER_BUFFER_SIZE, policy=SlowConsumerPolicy.DROP):
+        self.writer = writer
+        self.name = writer.get_extra_info('peername') or 'unix socket'
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.buffer = deque()
+        self.has_data = asyncio.Event()
+        self.dropped = 0
+        self.sent = 0
+        self.too_slow = False
+
+    def publish(self, data):
+        if self.too_slow:
+            return
+        if len(self.buffer) >= self.buffer_size:
+            if self.policy is SlowConsumerPolicy.DISCONNECT:
+                # pump may be stuck in drain() on a stalled client, so the transport is closed from here
+                logger.warning('disconnect slow subscriber %s', self.name)
+                self.too_slow = True
+                self.buffer.clear()
+                self.writer.transport.abort()
+                self.has_data.set()
+                return
+            self.buffer.popleft()
+            self.dropped += 1
+        self.buffer.append(data)
+        self.has_data.set()
+
+    async def pump(self):
+        while True:
+            await self.has_data.wait()
+            self.has_data.clear()
+            if self.too_slow:
+                return
+            if self.buffer:
+                chunk = b''.join(self.buffer)
+                self.sent += len(self.buffer)
+                self.buffer.clear()
+                self.writer.write(chunk)
+                await self.writer.drain()
+
+
+async def wait_disconnect(reader, cancel_scope):
+    # subscribers only listen, so anything they send is ignored until they disconnect
+    while await reader.read(1024):
+        pass
+    cancel_scope.cancel()
+
+
+class Relay:
+    def __init__(self, host, port, buffer_size=SUBSCRIBER_BUFFER_SIZE, policy=SlowConsumerPolicy.DROP,
+                 read_timeout=READ_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.read_timeout = read_timeout
+        self.subscribers = set()
+
+    def publish(self, data):
+        for subscriber in self.subscribers:
+            subscriber.publish(data)
+
+    @reconnect(exceptions=(ConnectionError, OSError), logger=logger)
+    async def read_upstream(self):
+        # a half-open upstream is silent forever, subscribers would never hear of a reconnect
+        liveness = LivenessTracker(channels=(Channel.READ,), timeout=self.read_timeout)
+        try:
+            async with create_task_group() as tg:
+                await tg.start(liveness.watch)
+                async with get_connection(self.host, self.port) as (reader, writer):
+                    liveness.touch(Channel.READ)
+                    while message := await reader.readline():
+                        liveness.touch(Channel.READ)
+                        self.publish(message)
+                tg.cancel_scope.cancel()
+        except ExceptionGroup as e:
+            raise ConnectionError(f'upstream {self.host}:{self.port} failed') from e
+        raise ConnectionError(f'upstream {self.host}:{self.port} closed connection')
+
+    async def handle_subscriber(self, reader, writer):
+        subscriber = Subscriber(writer, self.buffer_size, self.policy)
+        self.subscribers.add(subscriber)
+        logger.debug('new subscriber %s, %s in total', subscriber.name, len(self.subscribers))
+        try:
+            async with create_task_group() as tg:
+                tg.start_soon(wait_disconnect, reader, tg.cancel_scope)
+                await subscriber.pump()
+                tg.cancel_scope.cancel()
+        except (ConnectionError, OSError) as e:
+            logger.debug('subscriber %s failed: %s', subscriber.name, e)
+        finally:
+            self.subscribers.discard(subscriber)
+            logger.debug('subscriber %s left, sent %s, dropped %s',
+                         subscriber.name, subscriber.sent, subscriber.dropped)
+            writer.close()
+            with suppress(ConnectionError, OSError):
+                await writer.wait_closed()
+
+    async def serve(self, listen_host=None, listen_port=None, unix_socket=None, task_status=TASK_STATUS_IGNORED):
+        servers = []
+        if listen_port:
+            servers.append(await asyncio.start_server(self.handle_subscriber, listen_host, listen_port))
+        if unix_socket:
+            servers.append(await asyncio.start_unix_server(self.handle_subscriber, unix_socket))
+
+        async with create_task_group() as tg:
+            for server in servers:
+                tg.start_soon(server.serve_forever)
+            tg.start_soon(self.read_upstream)
+            task_status.started()
@@ -0,0 +1,126 @@
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+from anyio import TASK_STATUS_IGNORED, to_thread
+
+from messenger.framing import split_line
+from messenger.history_store import FLAG_GAP, HistoryRecord
+from messenger.resume import GapMarker
+
+NICKNAME_COLORS = ('#1f77b4', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#17becf', '#bcbd22')
+CACHE_SIZE = 4000
+BATCH_SIZE = 500
+
+MENTION = re.compile(r'@[\w.-]+')
+
+
+class RenderedLine:
+    __slots__ = ('text', 'offset', 'runs')
+
+    def __init__(self, text, offset, runs):
+        self.text = text
+        self.offset = offset
+        # pieces of the line with their tags, ready for one Text.insert call
+        self.runs = runs
+
+
+def author_tag(author):
+    # crc32 is stable between runs, so a nickname keeps its colour
+    return f'author{zlib.crc32(author.encode()) % len(NICKNAME_COLORS)}'
+
+
+def configure_tags(panel):
+    for number, color in enumerate(NICKNAME_COLORS):
+        panel.tag_configure(f'author{number}', foreground=color)
+    panel.tag_configure('timestamp', foreground='grey')
+    panel.tag_configure('mention', background='#fff3a0')
+    panel.tag_configure('gap', foreground='#d62728')
+
+
+def nickname_pattern(nickname):
+    # the nickname is highlighted as a whole word, not inside longer words
+    return re.compile(rf'(?<!\w){re.escape(nickname)}(?!\w)') if nickname else None
+
+
+class LineFormatter:
+    def __init__(self, nickname=None, cache_size=CACHE_SIZE):
+        self.nickname = nickname
+        self.cache_size = cache_size
+        self._nickname_pattern = nickname_pattern(nickname)
+        # runs by the line without its timestamp, so repeated messages share an entry
+        self._cache = OrderedDict()
+        # new messages and history pages are formatted in different worker threads
+        self._lock = threading.Lock()
+
+    def set_nickname(self, nickname):
+        with self._lock:
+            if nickname != self.nickname:
+                self.nickname = nickname
+                self._nickname_pattern = nickname_pattern(nickname)
+                self._cache.clear()
+
+    def _mentions(self, body):
+        spans = [match.span() for match in MENTION.finditer(body)]
+        if self._nickname_pattern:
+            spans.extend(match.span() for match in self._nickname_pattern.finditer(body))
+        spans.sort()
+        merged = []
+        for start, end in spans:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def _runs(self, author, body):
+        runs = []
+        if author:
+            runs.extend((author, (author_tag(author),), ': ', ()))
+        position = 0
+        for start, end in self._mentions(body):
+            if start > position:
+                runs.extend((body[position:start], ()))
+            runs.extend((body[start:end], ('mention',)))
+            position = end
+        if position < len(body) or not runs:
+            runs.extend((body[position:], ()))
+        return tuple(runs)
+
+    def format(self, item):
+        if isinstance(item, HistoryRecord):
+            text, offset, gap = item.text, item.offset, item.flags & FLAG_GAP
+        else:
+            text, offset, gap = str(item), None, isinstance(item, GapMarker)
+
+        if gap:
+            return RenderedLine(text, offset, (text, ('gap',)))
+        stamp, author, body = split_line(text)
+        key = text[len(stamp):]
+        with self._lock:
+            runs = self._cache.get(key)
+            if runs is None:
+                runs = self._runs(author, body)
+                self._cache[key] = runs
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(key)
+        if stamp:
+            runs = (stamp, ('timestamp',)) + runs
+        return RenderedLine(text, offset, runs)
+
+    def format_batch(self, items):
+        return [self.format(item) for item in items]
+
+
+async def format_messages(formatter, messages_queue, rendered_queue, batch_size=BATCH_SIZE,
+                          task_status=TASK_STATUS_IGNORED):
+    # lines are parsed and split into tagged runs in a worker thread, the Tk loop only inserts them
+    task_status.started()
+    while True:
+        batch = [await messages_queue.get()]
+        while len(batch) < batch_size and not messages_queue.empty():
+            batch.append(messages_queue.get_nowait())
+        await rendered_queue.put(await to_thread.run_sync(formatter.format_batch, batch))
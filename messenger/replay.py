@@ -0,0 +1,213 @@
+import asyncio
+import itertools
+import logging
+import struct
+import time
+from collections import defaultdict, deque
+from enum import IntEnum
+
+from messenger import connection
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SCHREC1\n'
+# nanoseconds since the recording started, connection number, event, size of data
+EVENT_HEADER = struct.Struct('<QIBI')
+REAL_TIME = 1
+AS_FAST_AS_POSSIBLE = 0
+# replayed bytes the client has not read yet, feeding waits above it like a socket with a full buffer
+FEED_LIMIT = 256 * 1024
+# monotonic clock of the recording process when it started, maps recorded times to the replay
+CLOCK_RECORD = struct.Struct('<Q')
+
+
+class Event(IntEnum):
+    OPEN = 0
+    READ = 1
+    WRITE = 2
+    EOF = 3
+    CLOCK = 4
+
+
+class Recorder:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.started_at = time.monotonic_ns()
+        self.numbers = itertools.count(1)
+        self.write_event(0, Event.CLOCK, CLOCK_RECORD.pack(self.started_at))
+
+    def write_event(self, number, event, data=b''):
+        self.file.write(EVENT_HEADER.pack(time.monotonic_ns() - self.started_at, number, event, len(data)))
+        self.file.write(data)
+
+    async def open_connection(self, host, port, path=None):
+        number = next(self.numbers)
+        self.write_event(number, Event.OPEN, f'{host}:{port}'.encode())
+
+        loop = asyncio.get_running_loop()
+        reader = TappedReader(self, number)
+        # the reader is tapped before the socket is connected, so no bytes arrive past the recorder
+        if path:
+            transport, protocol = await loop.create_unix_connection(lambda: asyncio.StreamReaderProtocol(reader), path)
+        else:
+            transport, protocol = await loop.create_connection(lambda: asyncio.StreamReaderProtocol(reader), host, port)
+        return reader, TappedWriter(self, number, transport, protocol, reader, loop)
+
+    def close(self):
+        self.file.close()
+        logger.debug('traffic is recorded to %s', self.path)
+
+
+class TappedReader(asyncio.StreamReader):
+    # the protocol feeds bytes when they arrive, so timestamps do not depend on how fast the client reads
+    def __init__(self, recorder, number):
+        super().__init__()
+        self.recorder = recorder
+        self.number = number
+
+    def feed_data(self, data):
+        self.recorder.write_event(self.number, Event.READ, data)
+        super().feed_data(data)
+
+    def feed_eof(self):
+        self.recorder.write_event(self.number, Event.EOF)
+        super().feed_eof()
+
+
+class TappedWriter(asyncio.StreamWriter):
+    def __init__(self, recorder, number, transport, protocol, reader, loop):
+        super().__init__(transport, protocol, reader, loop)
+        self.recorder = recorder
+        self.number = number
+
+    def write(self, data):
+        self.recorder.write_event(self.number, Event.WRITE, data)
+        super().write(data)
+
+
+def read_events(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a chat traffic recording')
+        while len(header := f.read(EVENT_HEADER.size)) == EVENT_HEADER.size:
+            elapsed, number, event, size = EVENT_HEADER.unpack(header)
+            data = f.read(size)
+            # the recording process may have been killed in the middle of an event
+            if len(data) < size:
+                break
+            yield elapsed, number, Event(event), data
+
+
+class RecordedConnection:
+    __slots__ = ('opened_at', 'chunks', 'eof')
+
+    def __init__(self, opened_at):
+        self.opened_at = opened_at
+        self.chunks = []
+        self.eof = False
+
+
+class ReplayTransport:
+    # the reader pauses and resumes it by its limit, the same flow control that stops a real socket
+    def __init__(self):
+        self.reading = asyncio.Event()
+        self.reading.set()
+
+    def pause_reading(self):
+        self.reading.clear()
+
+    def resume_reading(self):
+        self.reading.set()
+
+
+class ReplayWriter:
+    # drops what the client writes, the recording already has the server's answers
+    def __init__(self, replay, feeding):
+        self.replay = replay
+        self.feeding = feeding
+
+    def write(self, data):
+        self.replay.bytes_written += len(data)
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+    def is_closing(self):
+        return self.feeding.done()
+
+    def close(self):
+        self.feeding.cancel()
+
+    async def wait_closed(self):
+        await asyncio.wait([self.feeding])
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+class Replay:
+    def __init__(self, path, speed=REAL_TIME):
+        self.path = path
+        self.speed = speed
+        self.bytes_written = 0
+        # connections to every host:port in the order the client opened them while recording
+        self.connections = defaultdict(deque)
+        self.recorded_started_at = None
+        # local monotonic time that stands for the start of the recording, by the last connection to an address
+        self.origins = {}
+        by_number = {}
+        for elapsed, number, event, data in read_events(path):
+            if event is Event.CLOCK:
+                (self.recorded_started_at,) = CLOCK_RECORD.unpack(data)
+            elif event is Event.OPEN:
+                by_number[number] = RecordedConnection(elapsed)
+                self.connections[data.decode()].append(by_number[number])
+            elif event is Event.READ:
+                by_number[number].chunks.append((elapsed, data))
+            elif event is Event.EOF:
+                by_number[number].eof = True
+
+    async def open_connection(self, host, port):
+        address = f'{host}:{port}'
+        try:
+            recorded = self.connections[address].popleft()
+        except IndexError:
+            raise ConnectionRefusedError(f'{self.path} has no more connections to {host}:{port}')
+        # the reader pauses the transport above twice its limit
+        reader = asyncio.StreamReader(limit=FEED_LIMIT // 2)
+        transport = ReplayTransport()
+        reader.set_transport(transport)
+        return reader, ReplayWriter(self, asyncio.create_task(self.feed(address, recorded, reader, transport)))
+
+    def local_time(self, recorded_at, address):
+        # when the replay delivers what happened at recorded_at (monotonic ns of the recording process)
+        origin = self.origins.get(address)
+        if origin is None or self.recorded_started_at is None or not self.speed:
+            return None
+        return origin + (recorded_at - self.recorded_started_at) / self.speed
+
+    async def feed(self, address, recorded, reader, transport):
+        started_at = time.monotonic_ns()
+        self.origins[address] = started_at - recorded.opened_at / self.speed if self.speed else None
+        for elapsed, data in recorded.chunks:
+            if self.speed:
+                delay = started_at + (elapsed - recorded.opened_at) / self.speed - time.monotonic_ns()
+                if delay > 0:
+                    await asyncio.sleep(delay / 1e9)
+            await transport.reading.wait()
+            reader.feed_data(data)
+            if not self.speed:
+                await asyncio.sleep(0)
+        if recorded.eof:
+            reader.feed_eof()
+
+
+def configure(record_path=None, replay_path=None, replay_speed=REAL_TIME):
+    # every get_connection in this process reads the recording and/or writes one
+    if replay_path:
+        connection.replay = Replay(replay_path, replay_speed)
+    if record_path:
+        connection.recorder = Recorder(record_path)
+    return connection.recorder
@@ -0,0 +1,125 @@
+import logging
+import time
+from collections import deque
+
+from anyio import create_task_group, ExceptionGroup
+
+from messenger.connection import CONNECTION_IDS, get_connection
+from messenger.framing import formatter, read_frame, strip_timestamp, wall_clock_offset, TIMESTAMP_FORMAT
+from messenger.history_store import FLAG_GAP
+from messenger.liveness import Channel
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_WINDOW = 1000
+
+
+class GapMarker:
+    __slots__ = ('lost_since', 'received_at')
+
+    def __init__(self, lost_since, received_at=None):
+        self.lost_since = lost_since
+        self.received_at = time.monotonic() if received_at is None else received_at
+
+    def __len__(self):
+        return len(self.text)
+
+    def __str__(self):
+        return formatter.prefix(self.wall_time) + self.text
+
+    @property
+    def text(self):
+        since = 'неизвестно'
+        if self.lost_since:
+            since = time.strftime(TIMESTAMP_FORMAT, time.localtime(self.lost_since))
+        return f'*** возможно пропущены сообщения с {since} ***'
+
+    @property
+    def wall_time(self):
+        return self.received_at + wall_clock_offset()
+
+
+class ResumeTracker:
+    def __init__(self, window=FINGERPRINT_WINDOW):
+        self.fingerprints = deque()
+        self.known = {}
+        self.window = window
+        self.resuming = False
+        self.overlap_found = False
+        self.last_message_at = None
+        self.pending_gap = None
+        self.duplicates = 0
+        self.gaps = 0
+
+    def _remember(self, fingerprint):
+        self.fingerprints.append(fingerprint)
+        self.known[fingerprint] = self.known.get(fingerprint, 0) + 1
+        if len(self.fingerprints) > self.window:
+            oldest = self.fingerprints.popleft()
+            self.known[oldest] -= 1
+            if not self.known[oldest]:
+                del self.known[oldest]
+
+    def seed(self, records):
+        for record in records:
+            if record.flags & FLAG_GAP:
+                continue
+            self._remember(hash(strip_timestamp(record.text).encode()))
+        if records:
+            self.last_message_at = records[-1].timestamp
+
+    def reconnected(self):
+        # the server may send recent messages again, they are dropped until the first new one
+        self.resuming = bool(self.fingerprints)
+        self.overlap_found = False
+
+    def accept(self, message):
+        fingerprint = hash(message.raw.rstrip())
+        if self.resuming:
+            if fingerprint in self.known:
+                self.overlap_found = True
+                self.duplicates += 1
+                return False
+            self.resuming = False
+            if not self.overlap_found:
+                # nothing we already had was replayed, so messages sent while we were away are lost
+                self.gaps += 1
+                self.pending_gap = GapMarker(self.last_message_at, message.received_at)
+                logger.debug('gap in history since %s, gaps in total: %s', self.last_message_at, self.gaps)
+        self._remember(fingerprint)
+        self.last_message_at = message.wall_time
+        return True
+
+    def pop_gap(self):
+        gap, self.pending_gap = self.pending_gap, None
+        return gap
+
+
+async def read_resumed(host, port, liveness, resume, deliver, on_connected=None):
+    # one connection: silence longer than the liveness timeout breaks it, a replayed overlap is dropped
+    # and a gap marker is delivered before the first new message if nothing from the overlap came again
+    try:
+        async with create_task_group() as tg:
+            await tg.start(liveness.watch)
+            async with get_connection(host, port) as (reader, writer):
+                conn_id = next(CONNECTION_IDS)
+                liveness.touch(Channel.READ)
+                if on_connected:
+                    on_connected()
+                if resume:
+                    resume.reconnected()
+                while message := await read_frame(reader, conn_id):
+                    liveness.touch(Channel.READ)
+                    if resume and not resume.accept(message):
+                        continue
+                    gap = resume.pop_gap() if resume else None
+                    # full queues hold the reader back instead of growing, waiting for them is not a dead connection
+                    liveness.disarm(Channel.READ)
+                    if gap:
+                        await deliver(gap)
+                    await deliver(message)
+                    liveness.touch(Channel.READ)
+            tg.cancel_scope.cancel()
+    except ExceptionGroup as e:
+        raise ConnectionError(f'{host}:{port} failed') from e
+    raise ConnectionError(f'{host}:{port} closed connection')
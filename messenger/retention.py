@@ -0,0 +1,127 @@
+import asyncio
+import gzip
+import logging
+import os
+import re
+import time
+from collections import namedtuple
+
+from anyio import TASK_STATUS_IGNORED, to_thread
+
+from messenger.history_store import FLAG_GAP, INDEX_RECORD
+from messenger.framing import strip_timestamp
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+RETENTION_INTERVAL = 60 * 60
+# index records read at once, memory does not grow with the segment size
+INDEX_CHUNK = 4096
+TMP_SUFFIX = '.tmp'
+
+# connection notes old versions of the chat wrote next to messages, and lines without text
+JUNK_LINE = re.compile(r'^(?:\[\d+\] (?:Connection is alive\.|\d+s timeout is elapsed)|\s*$)')
+
+# seconds and bytes, None switches a limit off
+RetentionPolicy = namedtuple('RetentionPolicy', 'max_age max_size compact_after', defaults=(None, None, None))
+RetentionReport = namedtuple('RetentionReport', 'removed compacted dropped freed')
+
+
+def policy_from_args(args):
+    return RetentionPolicy(
+        args.max_history_age * DAY if args.max_history_age else None,
+        args.max_history_size,
+        args.compact_after * DAY if args.compact_after else None,
+    )
+
+
+def is_junk(text):
+    return bool(JUNK_LINE.match(strip_timestamp(text)))
+
+
+def newest_timestamp(segment):
+    records_count = len(segment)
+    if not records_count:
+        return None
+    return segment.index_entry(records_count - 1)[0]
+
+
+def compact_segment(store, segment):
+    # records keep their order and timestamps, offsets move closer to the segment start
+    log_path = os.path.join(store.directory, f'{segment.base_offset:020d}.compact{TMP_SUFFIX}')
+    index_path = segment.index_path + TMP_SUFFIX
+    size_before = segment.size
+    dropped = 0
+    position = 0
+    try:
+        with segment.open_log() as src, gzip.open(log_path, 'wb') as log, open(index_path, 'wb') as index:
+            for start in range(0, len(segment), INDEX_CHUNK):
+                for timestamp, offset, length, flags in segment.read_index(start, start + INDEX_CHUNK):
+                    # the log is written in index order, so it is read without seeking
+                    data = src.read(length)
+                    if not flags & FLAG_GAP and is_junk(data.decode(errors='replace').rstrip('\n')):
+                        dropped += 1
+                        continue
+                    log.write(data)
+                    index.write(INDEX_RECORD.pack(timestamp, segment.base_offset + position, length, flags))
+                    position += length
+    except BaseException:
+        for path in (log_path, index_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    store.replace_segment(segment, log_path, index_path)
+    logger.debug('compacted %s, dropped %s lines', segment.log_path, dropped)
+    return dropped, size_before - segment.size
+
+
+def needs_reindex(report):
+    return bool(report.removed or report.compacted)
+
+
+def apply_retention(store, policy, now=None):
+    now = time.time() if now is None else now
+    removed = compacted = dropped = freed = 0
+    # the last segment is the one being appended to, it is never touched
+    sealed = store.segments[:-1]
+
+    total_size = sum(segment.size for segment in store.segments)
+    for segment in sealed:
+        newest = newest_timestamp(segment)
+        too_old = policy.max_age and newest is not None and newest < now - policy.max_age
+        too_big = policy.max_size and total_size > policy.max_size
+        if not (too_old or too_big):
+            continue
+        size = segment.size
+        store.remove_segment(segment)
+        total_size -= size
+        removed += 1
+        freed += size
+
+    if policy.compact_after:
+        for segment in store.segments[:-1]:
+            newest = newest_timestamp(segment)
+            if segment.compressed or newest is None or newest >= now - policy.compact_after:
+                continue
+            segment_dropped, segment_freed = compact_segment(store, segment)
+            compacted += 1
+            dropped += segment_dropped
+            freed += segment_freed
+
+    report = RetentionReport(removed, compacted, dropped, freed)
+    if removed or compacted:
+        logger.info('history retention: %s', report)
+    return report
+
+
+async def enforce_retention(store, policy, search_index=None, interval=RETENTION_INTERVAL,
+                            task_status=TASK_STATUS_IGNORED):
+    task_status.started()
+    if search_index:
+        await to_thread.run_sync(search_index.ready.wait)
+    while True:
+        report = await to_thread.run_sync(apply_retention, store, policy)
+        # removed messages must leave the index and compacted segments have new offsets
+        if needs_reindex(report) and search_index:
+            await to_thread.run_sync(search_index.rebuild, store)
+        await asyncio.sleep(interval)
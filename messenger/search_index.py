@@ -0,0 +1,390 @@
+import bisect
+import heapq
+import logging
+import os
+import re
+import struct
+import threading
+from array import array
+
+from messenger import metrics
+from messenger.framing import split_line
+from messenger.history_store import FLAG_GAP, lock_writer
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = 'search.idx'
+LOCK_SUFFIX = '.lock'
+TMP_SUFFIX = '.tmp'
+TIME_SUFFIX = '.time'
+SEARCH_LIMIT = 100
+
+# offset in the history and timestamp of every indexed message, in the order of offsets
+TIME_RECORD = struct.Struct('<Qd')
+# records whose timestamp bounds are kept in memory together
+TIME_BLOCK = 1024
+
+WORD = re.compile(r'\w+')
+
+
+def parse_query(query):
+    # "@nick some words" looks for messages of authors starting with "nick"
+    words, author = [], None
+    for word in query.split():
+        if word.startswith('@') and len(word) > 1:
+            author = word[1:]
+        else:
+            words.append(word)
+    return words, author
+
+
+def parse_entry(line):
+    # None for a line torn by a crash
+    if not line.endswith(b'\n'):
+        return None
+    try:
+        offset, timestamp, author, words = line.decode().rstrip('\n').split('\t')
+        return int(offset), float(timestamp), author, words.split()
+    except ValueError:
+        return None
+
+
+class IndexLocked(Exception):
+    pass
+
+
+def contains(offsets, offset):
+    position = bisect.bisect_left(offsets, offset)
+    return position < len(offsets) and offsets[position] == offset
+
+
+class TimeIndex:
+    # records are read from disk like history segment indexes, only timestamp bounds of blocks stay in memory
+    def __init__(self, path, writable=False, truncate=False):
+        self.path = path
+        self.writable = writable
+        self.saved = 0
+        # added but not flushed yet, a readonly index keeps here what it has indexed itself
+        self.unsaved = []
+        self.block_min = array('d')
+        self.block_max = array('d')
+        self._file = None
+        if writable:
+            self._file = open(path, 'w+b' if truncate else 'a+b')
+        elif os.path.exists(path):
+            self._file = open(path, 'rb')
+
+    def __len__(self):
+        return self.saved + len(self.unsaved)
+
+    def __getitem__(self, position):
+        # the offset, so bisect can look for offsets in the index on disk
+        return self.record(position)[0]
+
+    @property
+    def next_offset(self):
+        return self.record(len(self) - 1)[0] + 1 if len(self) else 0
+
+    def load(self, limit=None):
+        self.saved, self.unsaved = 0, []
+        self.block_min, self.block_max = array('d'), array('d')
+        if not self._file:
+            return 0
+        count = os.fstat(self._file.fileno()).st_size // TIME_RECORD.size
+        if limit is not None:
+            count = min(count, limit)
+        if self.writable and os.fstat(self._file.fileno()).st_size != count * TIME_RECORD.size:
+            logger.warning('truncate broken search time index %s', self.path)
+            self._file.truncate(count * TIME_RECORD.size)
+        self.saved = count
+        for start in range(0, count, TIME_BLOCK):
+            timestamps = [timestamp for _, timestamp in self.read(start, min(start + TIME_BLOCK, count))]
+            self.block_min.append(min(timestamps))
+            self.block_max.append(max(timestamps))
+        return count
+
+    def read(self, start, stop):
+        records = []
+        if start < self.saved:
+            self._file.seek(start * TIME_RECORD.size)
+            data = self._file.read((min(stop, self.saved) - start) * TIME_RECORD.size)
+            records = list(TIME_RECORD.iter_unpack(data))
+        if stop > self.saved:
+            records += self.unsaved[max(start - self.saved, 0):stop - self.saved]
+        return records
+
+    def record(self, position):
+        return self.read(position, position + 1)[0]
+
+    def append(self, offset, timestamp):
+        if len(self) % TIME_BLOCK:
+            self.block_min[-1] = min(self.block_min[-1], timestamp)
+            self.block_max[-1] = max(self.block_max[-1], timestamp)
+        else:
+            self.block_min.append(timestamp)
+            self.block_max.append(timestamp)
+        self.unsaved.append((offset, timestamp))
+
+    def flush(self):
+        if not self.writable or not self.unsaved:
+            return
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(b''.join(TIME_RECORD.pack(*record) for record in self.unsaved))
+        self._file.flush()
+        self.saved += len(self.unsaved)
+        self.unsaved = []
+
+    def timestamp_of(self, offset):
+        return self.record(bisect.bisect_left(self, offset))[1]
+
+    def position_range(self, since, until):
+        # timestamps may go backwards, e.g. when the clock is set back, so blocks are skipped only by their bounds
+        if not len(self):
+            return None
+        if since is None and until is None:
+            return 0, len(self) - 1
+        since = float('-inf') if since is None else since
+        until = float('inf') if until is None else until
+        blocks = range(len(self.block_min))
+        first = self._find(since, until, blocks)
+        if first is None:
+            return None
+        return first, self._find(since, until, reversed(blocks), backwards=True)
+
+    def _find(self, since, until, blocks, backwards=False):
+        for block in blocks:
+            if self.block_max[block] < since or self.block_min[block] > until:
+                continue
+            start = block * TIME_BLOCK
+            records = self.read(start, min(start + TIME_BLOCK, len(self)))
+            positions = range(len(records))
+            for position in reversed(positions) if backwards else positions:
+                if since <= records[position][1] <= until:
+                    return start + position
+        return None
+
+    def replace(self, path):
+        # takes the place of the index at path, the file is closed while it is moved
+        self.flush()
+        self._file.close()
+        os.replace(self.path, path)
+        self.path = path
+        self._file = open(path, 'a+b')
+
+    def close(self):
+        self.flush()
+        if self._file:
+            self._file.close()
+
+
+class SearchIndex:
+    def __init__(self, path, load=True, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.postings = {}
+        self.authors = {}
+        self._sorted_authors = None
+        # rebuild holds it while swapping the indexes, so a writer thread cannot add offsets in between
+        self._lock = threading.RLock()
+        # searches wait until the journal is read, so the index can be loaded after the window is shown
+        self.ready = threading.Event()
+        self._journal = None
+        self._writer_lock = None
+
+        # readonly index only reads the journal, e.g. search.py next to a running chat
+        if not readonly:
+            self._lock_writer()
+        self.times = TimeIndex(path + TIME_SUFFIX, writable=not readonly)
+        if load:
+            self.load()
+        if not readonly:
+            self._journal = open(path, 'a')
+
+    def _lock_writer(self):
+        self._writer_lock = lock_writer(self.path + LOCK_SUFFIX)
+        if self._writer_lock is None:
+            raise IndexLocked(f'search index {self.path} is written by another process')
+
+    @property
+    def next_offset(self):
+        return self.times.next_offset
+
+    def load(self):
+        # the journal is the source of truth, the time index is cut or completed to match it
+        saved = self.times.load()
+        valid_size = 0
+        count = 0
+        next_offset = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    entry = parse_entry(line)
+                    # offsets must grow for bisect, the rest of the journal is indexed again from history
+                    if entry is None or entry[0] < next_offset:
+                        break
+                    offset, timestamp, author, words = entry
+                    if count >= saved:
+                        self.times.append(offset, timestamp)
+                    self._add(offset, author, words)
+                    next_offset = offset + 1
+                    valid_size += len(line)
+                    count += 1
+            if not self.readonly and valid_size != os.path.getsize(self.path):
+                logger.warning('truncate broken search index %s', self.path)
+                os.truncate(self.path, valid_size)
+        if count < saved:
+            self.times.load(limit=count)
+        self.times.flush()
+        self.ready.set()
+
+    def _add(self, offset, author, words):
+        if author:
+            if author not in self.authors:
+                self.authors[author] = array('Q')
+                self._sorted_authors = None
+            self.authors[author].append(offset)
+        for word in words:
+            self.postings.setdefault(word, array('Q')).append(offset)
+
+    def add(self, offset, timestamp, line):
+        _, author, body = split_line(line)
+        author = (author or '').lower().replace('\t', ' ')
+        words = sorted(set(WORD.findall(body.lower())))
+        with self._lock:
+            if offset < self.next_offset:
+                return
+            self.times.append(offset, timestamp)
+            self._add(offset, author, words)
+            if self._journal:
+                self._journal.write(f'{offset}\t{timestamp}\t{author}\t{" ".join(words)}\n')
+
+    def flush(self):
+        with self._lock:
+            self.times.flush()
+            if self._journal:
+                self._journal.flush()
+
+    def close(self):
+        self.flush()
+        self.times.close()
+        if self._journal:
+            self._journal.close()
+        if self._writer_lock:
+            self._writer_lock.close()
+
+    def catch_up(self, store):
+        # what is saved meanwhile is left to the next call, otherwise a busy writer would keep it going
+        end_offset = store.end_offset
+        added = 0
+        for record in store.tail(self.next_offset):
+            if record.offset >= end_offset:
+                break
+            if record.flags & FLAG_GAP:
+                continue
+            self.add(record.offset, record.timestamp, record.text)
+            added += 1
+        self.flush()
+        if added:
+            logger.debug('indexed %s messages from history', added)
+        return added
+
+    def follow(self, writer, store):
+        # from now on the writer indexes what it saves, what it saved before is read from the history
+        with self._lock:
+            writer.search_index = self
+            return self.catch_up(store)
+
+    def rebuild(self, store):
+        # the new index is built aside, writers and searches keep using the old one meanwhile
+        tmp_path = self.path + TMP_SUFFIX
+        fresh = SearchIndex(tmp_path, load=False, readonly=True)
+        fresh._journal = open(tmp_path, 'w')
+        fresh.times.close()
+        fresh.times = TimeIndex(tmp_path + TIME_SUFFIX, writable=True, truncate=True)
+        try:
+            fresh.catch_up(store)
+            with self._lock:
+                # only messages saved while building are indexed under the lock
+                fresh.catch_up(store)
+                fresh._journal.close()
+                self._journal.close()
+                self.times.close()
+                fresh.times.replace(self.times.path)
+                os.replace(tmp_path, self.path)
+                self.postings, self.authors, self._sorted_authors = fresh.postings, fresh.authors, None
+                self.times = fresh.times
+                self._journal = open(self.path, 'a')
+        except BaseException:
+            fresh._journal.close()
+            fresh.times.close()
+            for path in (tmp_path, tmp_path + TIME_SUFFIX):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        logger.debug('rebuilt search index of %s messages', len(self.times))
+        return len(self.times)
+
+    def _author_postings(self, prefix):
+        if self._sorted_authors is None:
+            self._sorted_authors = sorted(self.authors)
+        position = bisect.bisect_left(self._sorted_authors, prefix)
+        postings = []
+        while position < len(self._sorted_authors) and self._sorted_authors[position].startswith(prefix):
+            postings.append(self.authors[self._sorted_authors[position]])
+            position += 1
+        return postings
+
+    def search(self, words=(), author=None, since=None, until=None, limit=SEARCH_LIMIT):
+        self.ready.wait()
+        with self._lock:
+            position_range = self.times.position_range(since, until)
+            if position_range is None:
+                return []
+            first_offset, last_offset = (self.times[position] for position in position_range)
+            # messages between the first and the last match may still be out of the range if the clock went back
+            check_time = since is not None or until is not None
+            since = float('-inf') if since is None else since
+            until = float('inf') if until is None else until
+
+            filters = []
+            for word in {word.lower() for word in words}:
+                if word not in self.postings:
+                    return []
+                filters.append(self.postings[word])
+            filters.sort(key=len)
+
+            author_postings = None
+            if author:
+                author_postings = self._author_postings(author.lower())
+                if not author_postings:
+                    return []
+
+            if filters:
+                candidates = filters.pop(0)
+            elif author_postings:
+                candidates = array('Q', heapq.merge(*author_postings))
+                author_postings = None
+            else:
+                candidates = self.times
+
+            found = []
+            stop = bisect.bisect_right(candidates, last_offset)
+            start = bisect.bisect_left(candidates, first_offset)
+            for position in range(stop - 1, start - 1, -1):
+                offset = candidates[position]
+                if not all(contains(offsets, offset) for offsets in filters):
+                    continue
+                if author_postings and not any(contains(offsets, offset) for offsets in author_postings):
+                    continue
+                if check_time and not since <= self.times.timestamp_of(offset) <= until:
+                    continue
+                found.append(offset)
+                if len(found) >= limit:
+                    break
+            return found
+
+
+def find_messages(index, store, query, limit=SEARCH_LIMIT):
+    with metrics.span('search'):
+        words, author = parse_query(query)
+        return [store.read_at(offset) for offset in index.search(words, author, limit=limit)]
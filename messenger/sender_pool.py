@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from collections import deque
+
+from anyio import create_task_group, ExceptionGroup
+
+from messenger.auth_tools import UnknownToken, authorise
+from messenger.chat_client import send_watchdog_msg
+from messenger.connection import get_connection, reconnect
+from messenger.liveness import Channel, LivenessTracker
+from messenger.messages import read_confirmations, read_message, submit_message
+
+logger = logging.getLogger('sender')
+
+
+class PooledConnection:
+    def __init__(self, token):
+        self.token = token
+        self.queue = asyncio.Queue()
+        self.nickname = None
+        # written messages wait here for the server's confirmations, which come back in order
+        self.unconfirmed = deque()
+        # unconfirmed messages of a broken connection, sent again before the queue
+        self.retry = deque()
+
+    def reconnected(self):
+        # delivery is at least once: a message written before the break may reach the server twice
+        self.retry.extendleft(reversed(self.unconfirmed))
+        self.unconfirmed.clear()
+
+    async def send_from_queue(self, writer, liveness):
+        while True:
+            message, sent = self.retry.popleft() if self.retry else await self.queue.get()
+            if sent.done():
+                continue
+            self.unconfirmed.append((message, sent))
+            # the deadline runs until the server has confirmed everything written
+            liveness.touch(Channel.SEND)
+            await submit_message(writer, message)
+
+    def confirm(self, liveness):
+        if not self.unconfirmed:
+            return
+        _, sent = self.unconfirmed.popleft()
+        if not sent.done():
+            sent.set_result(None)
+        if self.unconfirmed:
+            liveness.touch(Channel.SEND)
+        else:
+            liveness.disarm(Channel.SEND)
+
+    def fail(self, exc):
+        pending = [*self.retry, *self.unconfirmed]
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for message, sent in pending:
+            if not sent.done():
+                sent.set_exception(exc)
+        self.retry.clear()
+        self.unconfirmed.clear()
+
+
+class SenderPool:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.connections = {}
+        # futures of messages the server has not confirmed yet
+        self.outstanding = set()
+        self._task_group = None
+
+    async def __aenter__(self):
+        self._task_group = create_task_group()
+        await self._task_group.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # closing with replies unread resets the socket and the server may drop what it has not read yet
+        if exc_type is None and self.outstanding:
+            await asyncio.wait(list(self.outstanding))
+        self._task_group.cancel_scope.cancel()
+        return await self._task_group.__aexit__(exc_type, exc_val, exc_tb)
+
+    async def send(self, token, message):
+        connection = self.connections.get(token)
+        if not connection:
+            connection = self.connections[token] = PooledConnection(token)
+            self._task_group.start_soon(self._run_connection, connection)
+
+        sent = asyncio.get_running_loop().create_future()
+        self.outstanding.add(sent)
+        sent.add_done_callback(self.outstanding.discard)
+        connection.queue.put_nowait((message, sent))
+        await sent
+
+    async def _run_connection(self, connection):
+        try:
+            await self._keep_connection(connection)
+        except UnknownToken as e:
+            del self.connections[connection.token]
+            connection.fail(e)
+
+    @reconnect(exceptions=(ConnectionError, ExceptionGroup, OSError), logger=logger)
+    async def _keep_connection(self, connection):
+        async with get_connection(self.host, self.port) as (reader, writer):
+            await read_message(reader)
+            connection.nickname = await authorise(reader, writer, connection.token)
+            connection.reconnected()
+
+            liveness = LivenessTracker(channels=(Channel.PING,))
+            async with create_task_group() as tg:
+                tg.start_soon(connection.send_from_queue, writer, liveness)
+                tg.start_soon(read_confirmations, reader, lambda: connection.confirm(liveness))
+                await tg.start(send_watchdog_msg, writer, liveness)
+                await tg.start(liveness.watch)
@@ -0,0 +1,251 @@
+import _tkinter
+import asyncio
+import logging
+import time
+import tkinter as tk
+from collections import OrderedDict, deque
+from enum import Enum
+
+from anyio import create_task_group, TASK_STATUS_IGNORED
+
+from messenger import metrics
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1 / 120
+PROBE_INTERVAL = 1
+REPORT_INTERVAL = 30
+LATENCY_SAMPLES = 1000
+# share of a frame spent on widget updates, the rest is left to Tk for input and drawing
+FRAME_BUDGET = 0.5
+
+
+class TkAppClosed(Exception):
+    pass
+
+
+class TkLoopMode(Enum):
+    POLL = 'poll'
+    EVENTS = 'events'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class TkLoopStats:
+    def __init__(self, mode):
+        self.mode = mode
+        self.wakeups = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._probes = deque()
+        self.reset()
+
+    def reset(self):
+        self.wakeups = 0
+        self._started_at = time.monotonic()
+        self._cpu_started_at = time.process_time()
+
+    def send_probe(self, root):
+        self._probes.append(time.perf_counter())
+        root.event_generate('<<LatencyProbe>>', when='tail')
+
+    def receive_probe(self, event=None):
+        if self._probes:
+            self.latencies.append(time.perf_counter() - self._probes.popleft())
+
+    def snapshot(self):
+        elapsed = max(time.monotonic() - self._started_at, 1e-9)
+        latencies = sorted(self.latencies)
+        return {
+            'mode': str(self.mode),
+            'cpu_percent': round(100 * (time.process_time() - self._cpu_started_at) / elapsed, 2),
+            'wakeups_per_second': round(self.wakeups / elapsed, 2),
+            'latency_p50_ms': round(1000 * latencies[len(latencies) // 2], 3) if latencies else None,
+            'latency_max_ms': round(1000 * latencies[-1], 3) if latencies else None,
+        }
+
+
+class FrameScheduler:
+    def __init__(self, interval, budget=FRAME_BUDGET):
+        self.interval = interval
+        self.budget = interval * budget
+        # widget updates by key, a newer update of the same widget replaces the one not shown yet
+        self.pending = OrderedDict()
+        self.has_pending = asyncio.Event()
+        self.frame_done = asyncio.Event()
+
+        self.frame_times = deque(maxlen=LATENCY_SAMPLES)
+        self.frames = 0
+        self.applied = 0
+        self.dropped = 0
+        self.over_budget = 0
+
+    def schedule(self, key, update):
+        replaced = self.pending.get(key)
+        if replaced is not None and replaced is not update:
+            self.dropped += 1
+            if metrics.enabled:
+                metrics.GUI_UPDATES_DROPPED.inc()
+        self.pending[key] = update
+        self.has_pending.set()
+
+    def is_pending(self, key):
+        return key in self.pending
+
+    async def next_frame(self):
+        self.frame_done.clear()
+        await self.frame_done.wait()
+
+    def apply_frame(self):
+        started_at = time.perf_counter()
+        deadline = started_at + self.budget
+        while self.pending and time.perf_counter() < deadline:
+            key, update = self.pending.popitem(last=False)
+            # an update that returns True is not finished: the rest waits behind the other widgets
+            if update():
+                self.pending.setdefault(key, update)
+            self.applied += 1
+        if self.pending:
+            self.over_budget += 1
+        else:
+            self.has_pending.clear()
+        frame_time = time.perf_counter() - started_at
+        self.frames += 1
+        self.frame_times.append(frame_time)
+        if metrics.enabled:
+            metrics.GUI_FRAME_SECONDS.observe(frame_time)
+        self.frame_done.set()
+        return frame_time
+
+    def snapshot(self):
+        frame_times = sorted(self.frame_times)
+        return {
+            'frames': self.frames,
+            'applied': self.applied,
+            'dropped': self.dropped,
+            'over_budget': self.over_budget,
+            'frame_p50_ms': round(1000 * frame_times[len(frame_times) // 2], 3) if frame_times else None,
+            'frame_max_ms': round(1000 * frame_times[-1], 3) if frame_times else None,
+        }
+
+    async def run(self, task_status=TASK_STATUS_IGNORED):
+        task_status.started()
+        reported_at = time.monotonic()
+        while True:
+            await self.has_pending.wait()
+            frame_time = self.apply_frame()
+            if logger.isEnabledFor(logging.DEBUG) and time.monotonic() - reported_at >= REPORT_INTERVAL:
+                logger.debug('gui frame stats: %s', self.snapshot())
+                reported_at = time.monotonic()
+            # a slow frame makes the next one wait longer, so Tk keeps up with input during floods
+            await asyncio.sleep(max(self.interval, frame_time))
+
+
+def process_tk_events(root_frame, wait=False):
+    try:
+        if wait:
+            root_frame.tk.dooneevent(_tkinter.ALL_EVENTS)
+        while root_frame.tk.dooneevent(_tkinter.ALL_EVENTS | _tkinter.DONT_WAIT):
+            pass
+        root_frame.winfo_exists()
+    except tk.TclError:
+        # if application has been destroyed/closed
+        raise TkAppClosed()
+
+
+async def update_tk(root_frame, interval=POLL_INTERVAL, stats=None, task_status=TASK_STATUS_IGNORED):
+    task_status.started()
+    while True:
+        try:
+            root_frame.update()
+        except tk.TclError:
+            # if application has been destroyed/closed
+            raise TkAppClosed()
+        if stats:
+            stats.wakeups += 1
+        await asyncio.sleep(interval)
+
+
+def unsupported_loop_reason(loop):
+    # asyncio has no public API for the selector descriptor or the time of the next callback, so the events mode
+    # reads _selector, _ready and _scheduled of the stdlib selector loop. They are checked here once and every other
+    # loop (uvloop, the Windows proactor, a future asyncio with other internals) falls back to polling
+    if not isinstance(loop, asyncio.selector_events.BaseSelectorEventLoop):
+        return f'{type(loop).__name__} is not a selector event loop'
+    if not isinstance(getattr(loop, '_ready', None), deque) or not isinstance(getattr(loop, '_scheduled', None), list):
+        return 'asyncio loop internals have changed'
+    try:
+        loop._selector.fileno()
+    except (AttributeError, NotImplementedError, OSError):
+        return 'the selector has no file descriptor'
+    return None
+
+
+def next_asyncio_deadline(loop):
+    # only for loops unsupported_loop_reason has accepted
+    if loop._ready:
+        return 0
+    if loop._scheduled:
+        return max(loop._scheduled[0].when() - loop.time(), 0)
+    return None
+
+
+async def wait_tk_events(root_frame, stats=None, task_status=TASK_STATUS_IGNORED):
+    loop = asyncio.get_running_loop()
+    reason = unsupported_loop_reason(loop)
+    if reason is None and not hasattr(root_frame.tk, 'createfilehandler'):
+        reason = 'tk has no file handlers on this platform'
+    if reason:
+        logger.debug('event driven tk loop is not supported here (%s), fall back to polling', reason)
+        await update_tk(root_frame, stats=stats, task_status=task_status)
+        return
+
+    # Tk sleeps in its own notifier, which also wakes up when any asyncio socket gets ready
+    selector = loop._selector
+    root_frame.tk.createfilehandler(selector.fileno(), tk.READABLE, lambda fd, mask: None)
+    task_status.started()
+    try:
+        while True:
+            process_tk_events(root_frame)
+            await asyncio.sleep(0)
+
+            deadline = next_asyncio_deadline(loop)
+            if deadline == 0:
+                continue
+            timer = None
+            if deadline is not None:
+                timer = root_frame.after(int(deadline * 1000) + 1, lambda: None)
+            process_tk_events(root_frame, wait=True)
+            if timer:
+                root_frame.after_cancel(timer)
+            if stats:
+                stats.wakeups += 1
+    finally:
+        try:
+            root_frame.tk.deletefilehandler(selector.fileno())
+        except tk.TclError:
+            pass
+
+
+async def report_tk_stats(root_frame, stats, task_status=TASK_STATUS_IGNORED):
+    root_frame.bind('<<LatencyProbe>>', stats.receive_probe)
+    task_status.started()
+    reported_at = time.monotonic()
+    while True:
+        await asyncio.sleep(PROBE_INTERVAL)
+        stats.send_probe(root_frame)
+        if logger.isEnabledFor(logging.DEBUG) and time.monotonic() - reported_at >= REPORT_INTERVAL:
+            logger.debug('tk loop stats: %s', stats.snapshot())
+            reported_at = time.monotonic()
+            stats.reset()
+
+
+async def run_tk(root_frame, mode=TkLoopMode.EVENTS, stats=None, task_status=TASK_STATUS_IGNORED):
+    stats = stats or TkLoopStats(mode)
+    async with create_task_group() as tg:
+        await tg.start(report_tk_stats, root_frame, stats)
+        if mode is TkLoopMode.POLL:
+            await tg.start(update_tk, root_frame, POLL_INTERVAL, stats)
+        else:
+            await tg.start(wait_tk_events, root_frame, stats)
+        task_status.started()
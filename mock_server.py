@@ -0,0 +1,191 @@
+import asyncio
+import contextlib
+import json
+import logging
+import re
+import time
+import uuid
+
+import configargparse
+
+logger = logging.getLogger('mock_server')
+
+GREETING = 'Hello %username%! Enter your personal hash or leave it empty to create new account.\n'
+NICKNAME_PROMPT = 'Enter preferred nickname below:\n'
+WELCOME = 'Welcome to chat! Post your message below. End it with an empty line.\n'
+MESSAGE_SENT = 'Message send. Write more, end message with an empty line.\n'
+
+BENCH_AUTHOR = 'bench'
+BENCH_MESSAGE = re.compile(r'bench (\d+) (\d+)')
+TICK_INTERVAL = 0.01
+MAX_WRITE_BUFFER = 1024 * 1024
+
+
+def make_bench_message(sequence):
+    return f'bench {sequence} {time.monotonic_ns()}'
+
+
+def parse_bench_message(text):
+    # monotonic clock is shared by all processes on the host, so the latency is comparable across them
+    match = BENCH_MESSAGE.search(text)
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+class MockChatServer:
+    def __init__(self, host='127.0.0.1', port=0, sender_port=0, rate=0, latency=0, disconnect_every=0,
+                 duration=None):
+        self.host = host
+        self.port = port
+        self.sender_port = sender_port
+        self.rate = rate
+        self.latency = latency
+        self.disconnect_every = disconnect_every
+        self.duration = duration
+
+        self.accounts = {}
+        self.subscribers = set()
+        self.connections = set()
+        self.received = []
+        self.broadcasted = 0
+        self.has_subscribers = asyncio.Event()
+
+    def add_account(self, nickname):
+        token = str(uuid.uuid4())
+        self.accounts[token] = nickname
+        return token
+
+    def broadcast(self, text):
+        data = f'{text}\n'.encode()
+        self.broadcasted += 1
+        for writer in list(self.subscribers):
+            if writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                logger.debug('drop slow subscriber')
+                writer.close()
+                self.subscribers.discard(writer)
+                continue
+            writer.write(data)
+
+    def send_later(self, writer, data):
+        if self.latency:
+            asyncio.get_running_loop().call_later(self.latency, writer.write, data)
+        else:
+            writer.write(data)
+
+    async def handle_subscriber(self, reader, writer):
+        self.connections.add(writer)
+        self.subscribers.add(writer)
+        self.has_subscribers.set()
+        try:
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            self.connections.discard(writer)
+            writer.close()
+
+    async def handle_sender(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            await self.talk_to_sender(reader, writer)
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def talk_to_sender(self, reader, writer):
+        self.send_later(writer, GREETING.encode())
+        token = (await reader.readline()).decode().strip()
+        if not token:
+            self.send_later(writer, NICKNAME_PROMPT.encode())
+            nickname = (await reader.readline()).decode().strip()
+            token = self.add_account(nickname)
+        elif token not in self.accounts:
+            self.send_later(writer, b'null\n')
+            return
+
+        nickname = self.accounts[token]
+        self.send_later(writer, f'{json.dumps({"nickname": nickname, "account_hash": token})}\n'.encode())
+        self.send_later(writer, WELCOME.encode())
+
+        lines = []
+        while line := await reader.readline():
+            text = line.decode().rstrip('\n')
+            if text:
+                lines.append(text)
+                continue
+            if not lines:
+                continue
+            message = '\n'.join(lines)
+            lines = []
+            self.received.append((nickname, message, time.monotonic_ns()))
+            self.broadcast(f'{nickname}: {message}')
+            self.send_later(writer, MESSAGE_SENT.encode())
+
+    async def generate_messages(self):
+        await self.has_subscribers.wait()
+        started_at = time.monotonic()
+        sequence = 0
+        total = int(self.rate * self.duration) if self.duration else None
+        while total is None or sequence < total:
+            due = int((time.monotonic() - started_at) * self.rate)
+            if total is not None:
+                due = min(due, total)
+            while sequence < due:
+                text = f'{BENCH_AUTHOR}: {make_bench_message(sequence)}'
+                if self.latency:
+                    asyncio.get_running_loop().call_later(self.latency, self.broadcast, text)
+                else:
+                    self.broadcast(text)
+                sequence += 1
+            await asyncio.sleep(TICK_INTERVAL)
+
+    async def force_disconnects(self):
+        while True:
+            await asyncio.sleep(self.disconnect_every)
+            logger.debug(f'force disconnect of {len(self.connections)} connections')
+            for writer in list(self.connections):
+                writer.close()
+
+    async def serve(self, ready=None):
+        read_server = await asyncio.start_server(self.handle_subscriber, self.host, self.port)
+        send_server = await asyncio.start_server(self.handle_sender, self.host, self.sender_port)
+        self.port = read_server.sockets[0].getsockname()[1]
+        self.sender_port = send_server.sockets[0].getsockname()[1]
+        logger.debug(f'mock chat is listening on {self.host}:{self.port}, sender on {self.sender_port}')
+
+        tasks = [asyncio.create_task(read_server.serve_forever()), asyncio.create_task(send_server.serve_forever())]
+        if self.rate:
+            tasks.append(asyncio.create_task(self.generate_messages()))
+        if self.disconnect_every:
+            tasks.append(asyncio.create_task(self.force_disconnects()))
+        if ready:
+            ready.set()
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for writer in list(self.connections):
+                writer.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(name)s:%(message)s')
+
+    parser = configargparse.ArgParser(description='Local stand-in for dvmn chat server')
+    parser.add_argument('--host', default='127.0.0.1', help='host to listen on')
+    parser.add_argument('--port', type=int, default=5000, help='port to read chat from')
+    parser.add_argument('--sender_port', type=int, default=5050, help='port to write to chat')
+    parser.add_argument('--rate', type=float, default=10, help='generated messages per second')
+    parser.add_argument('--latency', type=float, default=0, help='delay before every answer, seconds')
+    parser.add_argument('--disconnect_every', type=float, default=0, help='drop all connections every N seconds')
+    args = parser.parse_args()
+
+    server = MockChatServer(args.host, args.port, args.sender_port, args.rate, args.latency, args.disconnect_every)
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(server.serve())
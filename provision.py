@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import sys
+import time
+from contextlib import suppress
+
+import aiofiles
+import configargparse
+from anyio import CancelScope, create_task_group, to_thread, TASK_STATUS_IGNORED
+from async_timeout import timeout
+
+from messenger.auth_tools import UnknownOutcome, request_account
+from messenger.connection import reconnect
+from messenger.credentials import get_credentials, ACCOUNTS_PATH
+
+logger = logging.getLogger('provision')
+
+CONCURRENCY = 20
+RATE = 50
+REGISTER_TIMEOUT = 60
+SAVE_BATCH = 100
+SAVE_INTERVAL = 1
+
+
+class RateLimiter:
+    # spreads registrations evenly, the server does not see bursts of new connections
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_start = 0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        start = max(now, self.next_start)
+        self.next_start = start + self.interval
+        await asyncio.sleep(start - now)
+
+
+class Provisioner:
+    def __init__(self, host, port, credentials, concurrency=CONCURRENCY, rate=RATE, register_timeout=REGISTER_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.credentials = credentials
+        self.register_timeout = register_timeout
+        self.in_flight = asyncio.Semaphore(concurrency)
+        self.rate_limiter = RateLimiter(rate)
+
+        # registered accounts wait here to be written to the credential file in batches
+        self.unsaved = {}
+        self.has_unsaved = asyncio.Event()
+        self.registered = 0
+        self.skipped = 0
+        self.unknown = 0
+        self.latencies = []
+
+    @reconnect(exceptions=(ConnectionError, OSError), logger=logger)
+    async def request_account(self, username):
+        return await request_account(self.host, self.port, username, pipelined=True)
+
+    async def register(self, username):
+        started_at = time.monotonic()
+        try:
+            async with timeout(self.register_timeout):
+                nickname, token = await self.request_account(username)
+        except UnknownOutcome as e:
+            # retrying could register the name twice, so it is left for the operator to check
+            self.unknown += 1
+            logger.warning('%s', e)
+            return
+        except asyncio.TimeoutError:
+            # connection errors are retried until the deadline, so it may come after the username has been sent
+            self.unknown += 1
+            logger.warning('registration of %s may have succeeded, no answer in %ss', username, self.register_timeout)
+            return
+        finally:
+            self.in_flight.release()
+        self.latencies.append(time.monotonic() - started_at)
+        self.registered += 1
+        self.unsaved[nickname] = token
+        if len(self.unsaved) >= SAVE_BATCH:
+            self.has_unsaved.set()
+
+    async def save_accounts(self, task_status=TASK_STATUS_IGNORED):
+        task_status.started()
+        while True:
+            with suppress(asyncio.TimeoutError):
+                async with timeout(SAVE_INTERVAL):
+                    await self.has_unsaved.wait()
+            await self.flush()
+
+    async def flush(self):
+        self.has_unsaved.clear()
+        if not self.unsaved:
+            return
+        accounts, self.unsaved = self.unsaved, {}
+        await to_thread.run_sync(self.credentials.update, accounts)
+
+    async def provision(self, usernames):
+        # a second run only registers the names that are not in the credential file yet
+        seen = set(await to_thread.run_sync(self.credentials.nicknames))
+        try:
+            async with create_task_group() as tg:
+                await tg.start(self.save_accounts)
+                async with create_task_group() as registrations:
+                    async for username in usernames:
+                        if username in seen:
+                            self.skipped += 1
+                            continue
+                        seen.add(username)
+                        await self.in_flight.acquire()
+                        await self.rate_limiter.wait()
+                        registrations.start_soon(self.register, username)
+                tg.cancel_scope.cancel()
+        finally:
+            # tokens of accounts registered before an interrupt exist only here
+            with CancelScope(shield=True):
+                await self.flush()
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies) or [0]
+        return {
+            'registered': self.registered,
+            'skipped': self.skipped,
+            'unknown': self.unknown,
+            'seconds': round(elapsed, 3),
+            'accounts_per_second': round(self.registered / elapsed, 1) if elapsed > 0 else None,
+            'latency_p50_ms': round(1000 * latencies[len(latencies) // 2], 1),
+            'latency_max_ms': round(1000 * latencies[-1], 1),
+        }
+
+
+async def read_usernames(path):
+    if path == '-':
+        names_file = aiofiles.open(sys.stdin.fileno(), mode='r', closefd=False)
+    else:
+        names_file = aiofiles.open(path, mode='r')
+    async with names_file as f:
+        async for line in f:
+            if username := line.strip():
+                yield username
+
+
+async def generate_usernames(prefix, count):
+    for number in range(1, count + 1):
+        yield f'{prefix}{number}'
+
+
+async def provision_accounts(host, port, usernames, accounts_path=ACCOUNTS_PATH, concurrency=CONCURRENCY,
+                             rate=RATE):
+    provisioner = Provisioner(host, port, get_credentials(accounts_path), concurrency, rate)
+    started_at = time.monotonic()
+    try:
+        await provisioner.provision(usernames)
+    finally:
+        summary = provisioner.summary(time.monotonic() - started_at)
+        logger.info('registered %(registered)s accounts, skipped %(skipped)s, '
+                    'unknown %(unknown)s in %(seconds)ss: %(accounts_per_second)s accounts/s, '
+                    'p50 %(latency_p50_ms)sms, max %(latency_max_ms)sms', summary)
+    return summary
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(name)s:%(message)s')
+
+    parser = configargparse.ArgParser(
+        default_config_files=['settings/settings.ini'],
+        ignore_unknown_config_file_keys=True,
+        description='Register many dvmn chat accounts at once',
+    )
+    parser.add_argument('-c', '--config', is_config_file=True, help='config file path')
+    parser.add_argument('--host', required=True, help='chat server url')
+    parser.add_argument('--sender_port', required=True, help='chat server port')
+    parser.add_argument('--names', help='file with one username per line, - for stdin')
+    parser.add_argument('--prefix', help='register <prefix>1 ... <prefix><count> instead of names from a file')
+    parser.add_argument('--count', type=int, default=100, help='accounts to register with --prefix')
+    parser.add_argument('--accounts_path', default=ACCOUNTS_PATH, help='credential file to add accounts to')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='registrations at the same time')
+    parser.add_argument('--rate', type=float, default=RATE, help='registrations started per second, 0 for no limit')
+    args = parser.parse_args()
+
+    if args.names:
+        usernames = read_usernames(args.names)
+    elif args.prefix:
+        usernames = generate_usernames(args.prefix, args.count)
+    else:
+        parser.error('pass --names or --prefix')
+    with suppress(KeyboardInterrupt):
+        asyncio.run(provision_accounts(args.host, args.sender_port, usernames, args.accounts_path, args.concurrency,
+                                       args.rate))
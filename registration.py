@@ -7,7 +7,7 @@ from asyncio import Event
 import configargparse
 from anyio import create_task_group, TASK_STATUS_IGNORED
 
-from messenger.gui import update_tk, TkAppClosed
+from messenger.gui import run_tk, TkAppClosed, TkLoopMode
 from messenger.auth_tools import register
 
 
@@ -24,7 +24,7 @@ async def register_user(host, port, input_field, event: Event, task_status=TASK_
         event.clear()
 
 
-async def draw(host, port):
+async def draw(host, port, tk_mode=TkLoopMode.EVENTS):
     root = tk.Tk()
 
     root.title('Регистрация в чате Майнкрафтера')
@@ -49,7 +49,7 @@ async def draw(host, port):
     send_button.pack(side='left')
 
     async with create_task_group() as tg:
-        await tg.start(update_tk, root_frame)
+        await tg.start(run_tk, root_frame, tk_mode)
         await tg.start(register_user, host, port, input_field, is_button_pressed)
 
 
@@ -64,6 +64,8 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--config', is_config_file=True, help='config file path')
     parser.add_argument('--host', required=True, help='chat server url')
     parser.add_argument('--sender_port', required=True, help='chat server port')
+    parser.add_argument('--tk_mode', type=TkLoopMode, choices=list(TkLoopMode), default=TkLoopMode.EVENTS,
+                        help='poll tk 120 times per second or wake up on events only')
     args = parser.parse_args()
     with contextlib.suppress(KeyboardInterrupt, TkAppClosed):
-        asyncio.run(draw(args.host, args.sender_port))
+        asyncio.run(draw(args.host, args.sender_port, args.tk_mode))
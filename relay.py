@@ -0,0 +1,36 @@
+import asyncio
+import contextlib
+import logging
+
+import configargparse
+
+from messenger.archiver import READ_TIMEOUT
+from messenger.relay import Relay, SlowConsumerPolicy, SUBSCRIBER_BUFFER_SIZE
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(name)s:%(message)s')
+
+    parser = configargparse.ArgParser(
+        default_config_files=['settings/settings.ini'],
+        ignore_unknown_config_file_keys=True,
+        description='Local relay for dvmn chat: one upstream connection, many local listeners',
+    )
+    parser.add_argument('-c', '--config', is_config_file=True, help='config file path')
+    parser.add_argument('--host', required=True, help='chat server url')
+    parser.add_argument('--port', required=True, help='chat server port')
+    parser.add_argument('--relay_host', default='127.0.0.1', help='host to accept local listeners on')
+    parser.add_argument('--relay_port', type=int, help='port to accept local listeners on')
+    parser.add_argument('--relay_socket', help='unix socket path to accept local listeners on')
+    parser.add_argument('--relay_buffer', type=int, default=SUBSCRIBER_BUFFER_SIZE,
+                        help='messages buffered for every listener')
+    parser.add_argument('--slow_consumer', type=SlowConsumerPolicy, choices=list(SlowConsumerPolicy),
+                        default=SlowConsumerPolicy.DROP, help='drop oldest messages or disconnect slow listeners')
+    parser.add_argument('--read_timeout', type=float, default=READ_TIMEOUT,
+                        help='reconnect to the chat server after this many seconds of silence')
+    args = parser.parse_args()
+    if not args.relay_port and not args.relay_socket:
+        parser.error('pass --relay_port or --relay_socket')
+
+    relay = Relay(args.host, args.port, args.relay_buffer, args.slow_consumer, args.read_timeout)
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(relay.serve(args.relay_host, args.relay_port, args.relay_socket))
@@ -0,0 +1,63 @@
+import logging
+import os
+import time
+from datetime import datetime
+
+import configargparse
+
+from messenger.history_store import HistoryStore
+from messenger.search_index import SearchIndex, IndexLocked, INDEX_FILENAME, SEARCH_LIMIT
+
+
+def search_history(log_path, words, author=None, since=None, until=None, limit=SEARCH_LIMIT, rebuild=False):
+    store = HistoryStore(log_path, readonly=True)
+    # a running chat or listener owns the journal, a search only reads it and indexes the rest in memory
+    index = SearchIndex(os.path.join(log_path, INDEX_FILENAME), load=not rebuild, readonly=not rebuild)
+    try:
+        started_at = time.monotonic()
+        if rebuild:
+            index.rebuild(store)
+        else:
+            index.catch_up(store)
+        logging.debug(f'index is ready in {time.monotonic() - started_at:.3f}s')
+
+        started_at = time.monotonic()
+        offsets = index.search(words, author, since, until, limit)
+        logging.debug(f'found {len(offsets)} messages in {1000 * (time.monotonic() - started_at):.1f}ms')
+        return [store.read_at(offset) for offset in reversed(offsets)]
+    finally:
+        index.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(name)s:%(message)s')
+
+    parser = configargparse.ArgParser(
+        default_config_files=['settings/settings.ini'],
+        ignore_unknown_config_file_keys=True,
+        description='Search in dvmn chat history',
+    )
+    parser.add_argument('-c', '--config', is_config_file=True, help='config file path')
+    parser.add_argument('--log_path', required=True, help='path to chat history directory')
+    parser.add_argument('--author', help='author nickname or its beginning')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='messages since, e.g. 2022-11-30T18:00')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='messages until, e.g. 2022-11-30T19:00')
+    parser.add_argument('--limit', type=int, default=SEARCH_LIMIT, help='show at most this many messages')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild search index from history')
+    parser.add_argument('words', nargs='*', help='words to search')
+    args = parser.parse_args()
+
+    try:
+        records = search_history(
+            args.log_path,
+            args.words,
+            args.author,
+            args.since.timestamp() if args.since else None,
+            args.until.timestamp() if args.until else None,
+            args.limit,
+            args.rebuild,
+        )
+    except IndexLocked as e:
+        parser.error(f'{e}, stop it to rebuild the index')
+    for record in records:
+        print(record.text)
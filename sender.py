@@ -1,24 +1,37 @@
 import asyncio
 import logging
+import sys
+import time
+from contextlib import suppress
 
+import aiofiles
 import configargparse
+from anyio import create_task_group, move_on_after, to_thread
 
-from messenger.token_storage import read_token_from_file
-from messenger.auth_tools import UnknownToken, authorise, register, AUTH_PATH
+from messenger.auth_tools import UnknownToken, authorise, register
+from messenger.credentials import get_credentials
 from messenger.connection import get_connection
 from messenger.messages import read_message, submit_message
+from messenger.sender_pool import SenderPool
 
 logger = logging.getLogger('sender')
 
+MAX_MESSAGES_IN_FLIGHT = 1000
+BATCH_TIMEOUT = 300
 
-async def send_message_from_cli(host, port, message, username=None):
+
+async def get_token(host, port, username=None, account=None):
     if username:
-        token = await register(host, port, username)
-    else:
-        try:
-            token = await read_token_from_file(AUTH_PATH)
-        except FileNotFoundError:
-            raise UnknownToken()
+        return await register(host, port, username)
+    # the store keeps parsed accounts in memory, but still stats and may read the file
+    token = await to_thread.run_sync(get_credentials().get, account)
+    if not token:
+        raise UnknownToken()
+    return token
+
+
+async def send_message_from_cli(host, port, message, username=None, account=None):
+    token = await get_token(host, port, username, account)
 
     async with get_connection(host, port) as (reader, writer):
 
@@ -28,6 +41,57 @@ async def send_message_from_cli(host, port, message, username=None):
         await submit_message(writer, message)
 
 
+def parse_batch_line(line, default_token):
+    # a line is either a bare message or "<token>\t<message>"
+    token, separator, message = line.rstrip('\n').partition('\t')
+    if not separator:
+        return default_token, token
+    return token, message
+
+
+async def send_batch_from_cli(host, port, batch_path, username=None, account=None, batch_timeout=BATCH_TIMEOUT):
+    default_token = None
+    with suppress(UnknownToken):
+        default_token = await get_token(host, port, username, account)
+
+    in_flight = asyncio.Semaphore(MAX_MESSAGES_IN_FLIGHT)
+    read_count = 0
+    sent_count = 0
+
+    async def send(token, message):
+        nonlocal sent_count
+        try:
+            await pool.send(token, message)
+            sent_count += 1
+        finally:
+            in_flight.release()
+
+    started_at = time.monotonic()
+    if batch_path == '-':
+        batch_file = aiofiles.open(sys.stdin.fileno(), mode='r', closefd=False)
+    else:
+        batch_file = aiofiles.open(batch_path, mode='r')
+
+    # while the server is down messages wait for a reconnect, the deadline keeps the batch from hanging forever
+    with move_on_after(batch_timeout or None) as deadline:
+        async with SenderPool(host, port) as pool, batch_file as f, create_task_group() as tg:
+            async for line in f:
+                token, message = parse_batch_line(line, default_token)
+                if not message:
+                    continue
+                if not token:
+                    raise UnknownToken()
+                read_count += 1
+                await in_flight.acquire()
+                tg.start_soon(send, token, message)
+    if deadline.cancel_called:
+        logger.error(f'gave up after {batch_timeout}s, {read_count - sent_count} messages may not have been sent')
+
+    elapsed = time.monotonic() - started_at
+    logger.info(f'sent {sent_count} messages from {len(pool.connections)} accounts in {elapsed:.2f}s')
+    return read_count - sent_count
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(name)s:%(message)s')
 
@@ -39,7 +103,18 @@ if __name__ == '__main__':
     parser.add_argument('--host', required=True, help='chat server url')
     parser.add_argument('--sender_port', required=True, help='chat server port')
     parser.add_argument('-username', help='username for register in chat')
-    parser.add_argument('message', help='message to chat')
+    parser.add_argument('--account', help='nickname of a saved account to send from, the last registered by default')
+    parser.add_argument('--batch', help='file with messages, one per line or "<token>\\t<message>", - for stdin')
+    parser.add_argument('--timeout', type=float, default=BATCH_TIMEOUT,
+                        help='seconds to send the whole --batch, 0 to wait for the server forever')
+    parser.add_argument('message', nargs='?', help='message to chat')
     args = parser.parse_args()
 
-    asyncio.run(send_message_from_cli(args.host, args.sender_port, args.message, args.username))
+    if args.batch:
+        unsent = asyncio.run(send_batch_from_cli(args.host, args.sender_port, args.batch, args.username, args.account,
+                                                 args.timeout))
+        sys.exit(1 if unsent else 0)
+    elif args.message:
+        asyncio.run(send_message_from_cli(args.host, args.sender_port, args.message, args.username, args.account))
+    else:
+        parser.error('pass a message or --batch')
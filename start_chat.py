@@ -1,20 +1,36 @@
 import asyncio
 import contextlib
 import logging
+import os
 
 import configargparse
-from anyio import create_task_group
+from anyio import create_task_group, to_thread, TASK_STATUS_IGNORED
 
 from messenger import gui, chat_client
-from messenger.msg_history import read_history, save_messages
-from messenger.token_storage import read_token_from_file
+from messenger.batch_writer import BatchWriter, FsyncPolicy
+from messenger.credentials import get_credentials
+from messenger.export import ExportFormat, open_writer
+from messenger.history_store import HistoryStore, HistoryLocked
+from messenger.metrics import serve_metrics, watch_queues
+from messenger.tk_loop import TkLoopMode
+from messenger.outbox import Outbox
+from messenger.msg_history import read_history, HISTORY_LIMIT, SCREEN_LINES
+from messenger.resume import ResumeTracker, FINGERPRINT_WINDOW
+from messenger.replay import configure as configure_traffic, REAL_TIME
+from messenger.retention import enforce_retention, policy_from_args
+from messenger.queues import MonitoredQueue, QueuePolicy, log_queue_stats
+from messenger.search_index import SearchIndex, INDEX_FILENAME
 
-AUTH_PATH = 'settings/auth.ini'
 
+async def index_history(store, search_index, writer, task_status=TASK_STATUS_IGNORED):
+    # history is saved from the start, the index reads its journal and then catches up on its own
+    task_status.started()
+    await to_thread.run_sync(search_index.load)
+    await to_thread.run_sync(search_index.catch_up, store)
+    await to_thread.run_sync(search_index.follow, writer, store)
 
-async def main():
-    logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(name)s:%(message)s')
 
+def create_parser():
     parser = configargparse.ArgParser(
         default_config_files=['settings/settings.ini'],
         ignore_unknown_config_file_keys=True,
@@ -24,28 +40,109 @@ async def main():
     parser.add_argument('--host', required=True, help='chat server url')
     parser.add_argument('--port', required=True, help='chat server port')
     parser.add_argument('--sender_port', required=True, help='chat server port')
-    parser.add_argument('--log_path', required=True, help='path to chat logs')
-    args = parser.parse_args()
+    parser.add_argument('--account', help='nickname of a saved account, the last registered by default')
+    parser.add_argument('--log_path', required=True, help='path to chat history directory')
+    parser.add_argument('--segment_size', type=int, default=16 * 1024 * 1024, help='history segment size in bytes')
+    parser.add_argument('--compress_history', action='store_true', help='compress sealed history segments')
+    parser.add_argument('--max_history_age', type=float, help='remove history segments older than this many days')
+    parser.add_argument('--max_history_size', type=int, help='remove oldest segments while history is bigger, bytes')
+    parser.add_argument('--compact_after', type=float,
+                        help='compress segments older than this many days and drop empty and watchdog lines')
+    parser.add_argument('--history_limit', type=int, default=HISTORY_LIMIT, help='messages to show on start')
+    parser.add_argument('--screen_lines', type=int, default=SCREEN_LINES,
+                        help='messages shown before the rest of history is loaded in the background')
+    parser.add_argument('--import_history', help='path to old history.txt to import into empty history')
+    parser.add_argument('--fsync', type=FsyncPolicy, choices=list(FsyncPolicy), default=FsyncPolicy.NEVER,
+                        help='when to fsync history to disk')
+    parser.add_argument('--export_path', help='also append every saved message to this file for analytics')
+    parser.add_argument('--export_format', type=ExportFormat, choices=list(ExportFormat),
+                        default=ExportFormat.NDJSON, help='format of --export_path')
+    parser.add_argument('--tk_mode', type=TkLoopMode, choices=list(TkLoopMode), default=TkLoopMode.EVENTS,
+                        help='poll tk 120 times per second or wake up on events only')
+    parser.add_argument('--messages_queue_size', type=int, default=1000, help='messages waiting to be shown')
+    parser.add_argument('--messages_queue_policy', type=QueuePolicy, choices=list(QueuePolicy),
+                        default=QueuePolicy.DROP_OLDEST, help='what to do when messages are shown too slowly')
+    parser.add_argument('--metrics_host', default='127.0.0.1', help='host to serve metrics on')
+    parser.add_argument('--metrics_port', type=int, help='serve metrics on this port, metrics are off without it')
+    parser.add_argument('--saving_queue_size', type=int, default=10000,
+                        help='messages waiting to be saved before reading from server pauses')
+    parser.add_argument('--sending_queue_size', type=int, default=100, help='messages waiting to be sent')
+    parser.add_argument('--resume_window', type=int, default=FINGERPRINT_WINDOW,
+                        help='recent messages remembered to drop repeats after reconnect')
+    parser.add_argument('--record', help='record raw traffic with the chat server to this file')
+    parser.add_argument('--replay', help='read chat traffic from a file made with --record instead of the network')
+    parser.add_argument('--replay_speed', type=float, default=REAL_TIME,
+                        help='replay N times faster than recorded, 0 for as fast as possible')
+    parser.add_argument('--status_queue_size', type=int, default=100, help='status updates waiting to be shown')
+    return parser
+
 
-    messages_queue = asyncio.Queue()
-    sending_queue = asyncio.Queue()
-    status_updates_queue = asyncio.Queue()
-    saving_queue = asyncio.Queue()
+async def run_chat(args, draw=gui.draw):
+    recorder = configure_traffic(args.record, args.replay, args.replay_speed)
+    store = HistoryStore(args.log_path, args.segment_size, args.compress_history)
+    if args.import_history and not store.end_offset:
+        store.import_file(args.import_history)
+    # the index is read in the background, searches wait for it
+    search_index = SearchIndex(os.path.join(args.log_path, INDEX_FILENAME), load=False)
+    exporter = open_writer(args.export_path, args.export_format, append=True) if args.export_path else None
+    resume = ResumeTracker(args.resume_window)
+    retention_policy = policy_from_args(args)
+
+    messages_queue = MonitoredQueue('messages', args.messages_queue_size, args.messages_queue_policy)
+    # messages typed while the connection is down are kept on disk until they are written to the server
+    sending_queue = Outbox(args.log_path, args.sending_queue_size, args.fsync is not FsyncPolicy.NEVER)
+    status_updates_queue = MonitoredQueue('status', args.status_queue_size, QueuePolicy.DROP_OLDEST)
+    # history must not lose messages, so saving always holds the reader back
+    saving_queue = MonitoredQueue('saving', args.saving_queue_size)
 
     token_error_event = asyncio.Event()
     token = None
 
     try:
-        token = await read_token_from_file(AUTH_PATH)
-    except FileNotFoundError:
-        token_error_event.set()
-
-    async with create_task_group() as tg:
-        await tg.start(read_history, args.log_path, messages_queue)
-        await tg.start(gui.draw, messages_queue, sending_queue, status_updates_queue, token_error_event)
-        await tg.start(save_messages, args.log_path, saving_queue)
-        await tg.start(chat_client.handle_connection, args.host, args.port, args.sender_port, token, messages_queue,
-                       sending_queue, saving_queue, status_updates_queue, token_error_event)
+        async with create_task_group() as tg:
+            # the window comes first, it shows the last screenful and loads older messages itself
+            await tg.start(draw, messages_queue, sending_queue, status_updates_queue, token_error_event, store,
+                           args.tk_mode, search_index, args.history_limit)
+            await tg.start(read_history, store, messages_queue, args.screen_lines)
+            await tg.start(sending_queue.run)
+
+            queues = [messages_queue, sending_queue, status_updates_queue, saving_queue]
+            await tg.start(log_queue_stats, queues)
+            if args.metrics_port:
+                watch_queues(queues)
+                await tg.start(serve_metrics, args.metrics_host, args.metrics_port)
+
+            token = await to_thread.run_sync(get_credentials().get, args.account)
+            if not token:
+                token_error_event.set()
+            # messages the server sends again after a restart are already in history
+            resume.seed(await to_thread.run_sync(store.last, args.resume_window))
+            writer = BatchWriter(store, fsync_policy=args.fsync, exporter=exporter)
+            await tg.start(writer.run, saving_queue)
+            await tg.start(index_history, store, search_index, writer)
+            if any(retention_policy):
+                await tg.start(enforce_retention, store, retention_policy, search_index)
+            await tg.start(chat_client.handle_connection, args.host, args.port, args.sender_port, token,
+                           messages_queue, sending_queue, saving_queue, status_updates_queue, token_error_event, resume)
+    finally:
+        store.close()
+        search_index.close()
+        sending_queue.close()
+        if exporter:
+            exporter.close()
+        if recorder:
+            recorder.close()
+
+
+async def main():
+    logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(name)s:%(message)s')
+
+    parser = create_parser()
+    args = parser.parse_args()
+    try:
+        await run_chat(args)
+    except HistoryLocked as e:
+        parser.error(f'{e}, run the second chat with another --log_path')
 
 
 if __name__ == '__main__':